@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+"""
+Sketch many genomes in one process pool, as `sourmash compute` would
+one at a time.
+
+For each genome, write {genome}.sig with one signature per ksize, named
+after the genome file minus --extension, just as
+
+    sourmash compute -k 21,31,51 --scaled=1000 {genome} -o {genome}.sig \\
+        --merge=$(basename {genome} {extension})
+
+does, so that the gtdbtk Snakefile can sketch a batch of genomes per job
+instead of starting a new Python per genome. Gzipped FASTA is read
+with streaming decompression, by screed.
+
+With --manifest, also write a CSV of genome, signature file, name,
+ksize and md5sum for every signature.
+"""
+import os
+import sys
+import csv
+import argparse
+import multiprocessing
+
+import screed
+import sourmash
+from sourmash import MinHash, DEFAULT_SEED
+from sourmash.logging import error, notify, set_quiet
+
+MANIFEST_FIELDS = ['genome', 'sigfile', 'name', 'ksize', 'md5sum']
+
+
+def sketch_genome(job):
+    """
+    Sketch one genome and save its signatures; run in a worker process.
+    Return (genome, sigfile, [(name, ksize, md5sum), ...], n_sequences).
+    """
+    genome, sigfile, name, args = job
+
+    minhashes = [ MinHash(n=0, ksize=ksize, scaled=args.scaled,
+                          seed=args.seed) for ksize in args.ksizes ]
+
+    n = 0
+    for n, record in enumerate(screed.open(genome), 1):
+        for mh in minhashes:
+            mh.add_sequence(record.sequence, True)
+
+    siglist = [ sourmash.SourmashSignature(mh, filename=genome, name=name)
+                for mh in minhashes ]
+    with open(sigfile, 'wt') as fp:
+        sourmash.save_signatures(siglist, fp)
+
+    return genome, sigfile, \
+      [ (name, sig.minhash.ksize, sig.md5sum()) for sig in siglist ], n
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('genomes', nargs='*', help='genome files')
+    p.add_argument('--from-file',
+                   help='read genome filenames from this file, one per line')
+    p.add_argument('-k', '--ksizes', default='21,31,51',
+                   help='comma-separated list of k-mer sizes (default: %(default)s)')
+    p.add_argument('--scaled', type=float, default=1000)
+    p.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    p.add_argument('--extension', default='',
+                   help='strip this from genome filenames to name signatures')
+    p.add_argument('--manifest', help='write a CSV of signature md5sums')
+    p.add_argument('-f', '--force', action='store_true',
+                   help='recompute signatures that already exist')
+    p.add_argument('-p', '--processes', type=int, default=1)
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet)
+    args.ksizes = [ int(k) for k in args.ksizes.split(',') ]
+    args.scaled = int(args.scaled)
+
+    genomes = list(args.genomes)
+    if args.from_file:
+        with open(args.from_file, 'rt') as fp:
+            genomes += [ line.strip() for line in fp if line.strip() ]
+    if not genomes:
+        error('Error! no genome files given')
+        sys.exit(-1)
+
+    jobs = []
+    manifest_rows = []
+    for genome in genomes:
+        sigfile = genome + '.sig'
+        name = os.path.basename(genome)
+        if args.extension and name.endswith(args.extension):
+            name = name[:-len(args.extension)]
+
+        # existing signatures still go into the manifest.
+        if not args.force and os.path.exists(sigfile):
+            for sig in sourmash.load_signatures(sigfile):
+                manifest_rows.append(dict(genome=genome, sigfile=sigfile,
+                                          name=sig.name(),
+                                          ksize=sig.minhash.ksize,
+                                          md5sum=sig.md5sum()))
+            continue
+        jobs.append((genome, sigfile, name, args))
+
+    notify('sketching {} genomes ({} already done) at k={}, scaled={}',
+           len(jobs), len(genomes) - len(jobs),
+           ",".join(map(str, args.ksizes)), args.scaled)
+
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        results = pool.imap_unordered(sketch_genome, jobs)
+    else:
+        pool = None
+        results = map(sketch_genome, jobs)
+
+    n_seqs = 0
+    for i, (genome, sigfile, sigs, n) in enumerate(results, 1):
+        notify(u'\r\033[K', end=u'')
+        notify('... {} of {}: {} ({} sequences)', i, len(jobs), genome, n,
+               end='\r')
+        n_seqs += n
+        for name, ksize, md5sum in sigs:
+            manifest_rows.append(dict(genome=genome, sigfile=sigfile,
+                                      name=name, ksize=ksize, md5sum=md5sum))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    notify(u'\r\033[K', end=u'')
+    notify('sketched {} sequences from {} genomes', n_seqs, len(jobs))
+
+    if args.manifest:
+        manifest_rows.sort(key=lambda row: (row['genome'], row['ksize']))
+        with open(args.manifest, 'wt') as fp:
+            w = csv.DictWriter(fp, fieldnames=MANIFEST_FIELDS)
+            w.writeheader()
+            w.writerows(manifest_rows)
+        notify('wrote manifest of {} signatures to {}', len(manifest_rows),
+               args.manifest)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+"""
+Compare, per signature, the dict and the uint64 array paths from a
+signature's hashes to its LCA counts, as in the bulk-classify-dig.py and
+bulk-investigate.py hot loops.
+
+The dict path builds a defaultdict of hash -> 1 from get_mins(), leaving
+out confused hashes, and looks each hash up in hashval_to_idx; the array
+path uses lca_vector.minhash_hashvals and remove_hashvals, and looks
+the hashes up with np.searchsorted. For each, we report the mean time
+and the mean peak traced allocation per signature, and check that both
+give the same counts.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+import sourmash
+from lca_stream import load_databases, LINEAGE_SECTIONS
+from lca_vector import LineageCodes, minhash_hashvals, remove_hashvals
+
+
+def dict_path(minhash, confused, lineage_codes):
+    hashvals = defaultdict(int)
+    for hashval in minhash.get_mins():
+        if hashval not in confused:
+            hashvals[hashval] += 1
+    return lineage_codes.lca_id_counts(hashvals)
+
+
+def array_path(minhash, confused, lineage_codes):
+    hashvals = remove_hashvals(minhash_hashvals(minhash), confused)
+    return lineage_codes.lca_id_counts(hashvals)
+
+
+def measure(fn, minhashes, confused, lineage_codes, repeat):
+    "Return (mean seconds, mean peak traced bytes) per signature."
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for mh in minhashes:
+            fn(mh, confused, lineage_codes)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+
+    peaks = []
+    tracemalloc.start()
+    for mh in minhashes:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn(mh, confused, lineage_codes)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    return best / len(minhashes), sum(peaks) / len(peaks)
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('data_dir', help='output directory of make-synthetic-data.py')
+    p.add_argument('-n', '--num-sigs', type=int, default=200,
+                   help='signatures to use (default: %(default)s)')
+    p.add_argument('--confused-fraction', type=float, default=0.01,
+                   help='fraction of the hashes to treat as confused')
+    p.add_argument('--repeat', type=int, default=3,
+                   help='time each path this many times; keep the fastest')
+    p.add_argument('-o', '--output', help='write a JSON report here')
+    args = p.parse_args(args)
+
+    data_dir = os.path.abspath(args.data_dir)
+    dblist, ksize, scaled = load_databases([os.path.join(data_dir,
+                                                         'db.lca.json.gz')],
+                                           sections=LINEAGE_SECTIONS,
+                                           verbose=False)
+    lineage_codes = LineageCodes(dblist)
+
+    sigfiles = sorted(glob.glob(os.path.join(data_dir,
+                                             'dig-unclassified-sigs',
+                                             '*.sig')))[:args.num_sigs]
+    minhashes = [ sourmash.load_one_signature(f, ksize=ksize).minhash
+                  for f in sigfiles ]
+    if not minhashes:
+        print('** no signatures in {}/dig-unclassified-sigs'.format(data_dir))
+        sys.exit(-1)
+
+    # a deterministic sample of the query hashes, as both set and array.
+    all_hashvals = sorted(set([ h for mh in minhashes for h in mh.get_mins() ]))
+    step = max(1, int(1 / args.confused_fraction)) if args.confused_fraction else 0
+    confused_set = set(all_hashvals[::step]) if step else set()
+    confused_array = np.array(sorted(confused_set), dtype=np.uint64)
+
+    start = time.perf_counter()
+    lineage_codes.gather_array(np.zeros(0, dtype=np.uint64))   # builds the index
+    index_seconds = time.perf_counter() - start
+
+    for mh in minhashes:
+        ids1, counts1 = dict_path(mh, confused_set, lineage_codes)
+        ids2, counts2 = array_path(mh, confused_array, lineage_codes)
+        assert np.array_equal(ids1, ids2) and np.array_equal(counts1, counts2)
+
+    dict_seconds, dict_bytes = measure(dict_path, minhashes, confused_set,
+                                       lineage_codes, args.repeat)
+    array_seconds, array_bytes = measure(array_path, minhashes,
+                                         confused_array, lineage_codes,
+                                         args.repeat)
+
+    mean_hashes = sum([ len(mh.get_mins()) for mh in minhashes ]) / len(minhashes)
+    print('{} signatures, {:.0f} hashes each on average; ksize={}, scaled={}'.format(
+          len(minhashes), mean_hashes, ksize, scaled))
+    print('building the hash index took {:.2f}s, once'.format(index_seconds))
+    print('{:8s} {:>12s} {:>14s}'.format('path', 'ms/sig', 'peak KB/sig'))
+    print('{:8s} {:12.3f} {:14.1f}'.format('dict', dict_seconds * 1000,
+                                           dict_bytes / 1024))
+    print('{:8s} {:12.3f} {:14.1f}'.format('array', array_seconds * 1000,
+                                           array_bytes / 1024))
+    print('array path: {:.1f}x faster, {:.1f}x less peak allocation'.format(
+          dict_seconds / array_seconds, dict_bytes / array_bytes))
+
+    if args.output:
+        report = dict(n_signatures=len(minhashes), mean_hashes=mean_hashes,
+                      ksize=ksize, scaled=scaled,
+                      index_seconds=index_seconds,
+                      dict=dict(seconds_per_sig=dict_seconds,
+                                peak_bytes_per_sig=dict_bytes),
+                      array=dict(seconds_per_sig=array_seconds,
+                                 peak_bytes_per_sig=array_bytes))
+        with open(args.output, 'wt') as fp:
+            json.dump(report, fp, indent=2)
+        print('wrote report to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
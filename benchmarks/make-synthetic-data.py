@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+"""
+Generate a deterministic synthetic data set for run-benchmarks.py.
+
+Creates, in the output directory:
+* sigs/ - one scaled signature per synthetic genome;
+* lineages.csv - a seven-rank lineage for each genome;
+* db.lca.json.gz - an LCA database built from them with `sourmash lca index`;
+* db.sbt.json - an SBT built from them with `sourmash index`;
+* dig-input.csv and dig-unclassified-sigs/ - inputs for bulk-classify-dig.py;
+* params.json - the parameters, plus counts used for throughput.
+
+Genomes are grouped into species of two, genera of three species, and so
+on up the taxonomy. Each genome draws --shared-rate of its hashes from a
+pool shared by its genus, and the rest at random; --chimera-rate of the
+genomes also take a quarter of their hashes from a distant genus.
+"""
+import os
+import sys
+import csv
+import json
+import random
+import shutil
+import argparse
+import subprocess
+
+import sourmash
+
+# how many children each rank has, from species up to phylum.
+BRANCHING = [('species', 2), ('genus', 3), ('family', 3), ('order', 2),
+             ('class', 2), ('phylum', 2), ('superkingdom', 4)]
+PREFIXES = {'superkingdom': 'd', 'phylum': 'p', 'class': 'c', 'order': 'o',
+            'family': 'f', 'genus': 'g', 'species': 's'}
+RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus',
+         'species']
+
+
+def make_lineage(genome_idx):
+    "Build a lineage (list of names, superkingdom first) for a genome."
+    names = {}
+    n = genome_idx
+    for rank, branching in BRANCHING:
+        n = n // branching
+        names[rank] = '{}__{}{}'.format(PREFIXES[rank], rank[0].upper(), n)
+    return [ names[rank] for rank in RANKS ]
+
+
+def genus_of(genome_idx):
+    return genome_idx // (BRANCHING[0][1] * BRANCHING[1][1])
+
+
+def make_genome_hashes(args, rng, max_hash):
+    "Return a list of hashval lists, one per genome, and the chimera set."
+    n_genera = genus_of(args.genomes - 1) + 1
+    pools = [ [ rng.randrange(max_hash) for i in range(args.hashes_per_genome) ]
+              for g in range(n_genera) ]
+
+    n_shared = int(args.hashes_per_genome * args.shared_rate)
+    genome_hashes = []
+    chimeras = set()
+    for i in range(args.genomes):
+        hashes = rng.sample(pools[genus_of(i)], n_shared)
+        while len(hashes) < args.hashes_per_genome:
+            hashes.append(rng.randrange(max_hash))
+
+        if rng.random() < args.chimera_rate and n_genera > 1:
+            other = (genus_of(i) + n_genera // 2) % n_genera
+            n_foreign = args.hashes_per_genome // 4
+            hashes[:n_foreign] = rng.sample(pools[other], n_foreign)
+            chimeras.add(i)
+
+        genome_hashes.append(hashes)
+
+    return genome_hashes, chimeras
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('output_dir')
+    p.add_argument('--genomes', type=int, default=200)
+    p.add_argument('--hashes-per-genome', type=int, default=500)
+    p.add_argument('--shared-rate', type=float, default=0.3,
+                   help='fraction of hashes shared within a genus')
+    p.add_argument('--chimera-rate', type=float, default=0.05,
+                   help='fraction of genomes contaminated by a distant genus')
+    p.add_argument('-k', '--ksize', type=int, default=31)
+    p.add_argument('--scaled', type=int, default=1000)
+    p.add_argument('--seed', type=int, default=1)
+    args = p.parse_args(args)
+
+    rng = random.Random(args.seed)
+    max_hash = (2**64 - 1) // args.scaled
+
+    sigdir = os.path.join(args.output_dir, 'sigs')
+    digdir = os.path.join(args.output_dir, 'dig-unclassified-sigs')
+    for dirname in (sigdir, digdir):
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.makedirs(dirname)
+
+    genome_hashes, chimeras = make_genome_hashes(args, rng, max_hash)
+
+    lineages_csv = os.path.join(args.output_dir, 'lineages.csv')
+    dig_csv = os.path.join(args.output_dir, 'dig-input.csv')
+    n_hashes = 0
+    with open(lineages_csv, 'wt') as fp, open(dig_csv, 'wt') as dig_fp:
+        w = csv.writer(fp)
+        w.writerow(['accession'] + RANKS)
+        dig_w = csv.writer(dig_fp)
+
+        for i, hashes in enumerate(genome_hashes):
+            name = 'GENOME{:06d}'.format(i)
+            w.writerow([name] + make_lineage(i))
+
+            mh = sourmash.MinHash(n=0, ksize=args.ksize, scaled=args.scaled)
+            mh.add_many(hashes)
+            n_hashes += len(mh)
+            sig = sourmash.SourmashSignature(mh, name=name,
+                                             filename=name + '.fa')
+
+            sigfile = os.path.join(sigdir, name + '.sig')
+            with open(sigfile, 'wt') as sigfp:
+                sourmash.save_signatures([sig], sigfp)
+
+            # bulk-classify-dig.py reads a header-less CSV of candidates
+            # and their signatures, by md5sum.
+            shutil.copyfile(sigfile,
+                            os.path.join(digdir, sig.md5sum() + '.sig'))
+            dig_w.writerow(['superkingdom', name, name + '.fa', sig.md5sum()])
+
+    print('wrote {} signatures ({} chimeric) to {}'.format(args.genomes,
+                                                           len(chimeras),
+                                                           sigdir))
+
+    sourmash_cmd = [sys.executable, '-m', 'sourmash']
+    subprocess.check_call(sourmash_cmd + ['lca', 'index', lineages_csv,
+        os.path.join(args.output_dir, 'db.lca.json.gz'), sigdir,
+        '--traverse-directory', '-k', str(args.ksize),
+        '--scaled', str(args.scaled), '-q'])
+    subprocess.check_call(sourmash_cmd + ['index',
+        os.path.join(args.output_dir, 'db.sbt.json'), sigdir,
+        '--traverse-directory', '-k', str(args.ksize), '-q'])
+
+    params = vars(args).copy()
+    params['n_hashes'] = n_hashes
+    params['n_chimeras'] = len(chimeras)
+    with open(os.path.join(args.output_dir, 'params.json'), 'wt') as fp:
+        json.dump(params, fp, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
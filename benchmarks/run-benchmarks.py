@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+"""
+Time the classification and oddity scripts on a synthetic data set from
+make-synthetic-data.py, and write a JSON report.
+
+Each scenario runs one script in a subprocess; we record wall time,
+throughput (genomes or hashes per second) and peak RSS of that process.
+With --compare, also print the ratio to an earlier report.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scenario_args(data_dir, outdir):
+    """
+    Return {name: (script, args, count_key)}; 'count_key' names the entry
+    in params.json that throughput is measured against.
+    """
+    db = os.path.join(data_dir, 'db.lca.json.gz')
+    sbt = os.path.join(data_dir, 'db.sbt.json')
+
+    return {
+        'bulk-classify-sbt-with-lca': ('bulk-classify-sbt-with-lca.py',
+            [os.path.join(outdir, 'bench'), db, sbt], 'genomes'),
+        'bulk-classify-dig': ('bulk-classify-dig.py',
+            [os.path.join(outdir, 'dig'), db,
+             os.path.join(data_dir, 'dig-input.csv'), '--threshold', '5'],
+            'genomes'),
+        'extract-high-rank-hashes': ('extract-high-rank-hashes.py',
+            [db, '-o', os.path.join(outdir, 'high-rank-hashes.txt')],
+            'n_hashes'),
+        'find-oddities-2': ('find-oddities-2.py', [db], 'n_hashes'),
+    }
+
+
+def run_one(script, args, cwd):
+    "Run a script; return (wall seconds, peak RSS in MB, return code)."
+    cmd = [sys.executable, os.path.join(SCRIPTS_DIR, script)] + args
+    with open(os.path.join(cwd, script + '.log'), 'wb') as logfp:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=logfp,
+                                stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+    returncode = os.waitstatus_to_exitcode(status)
+    proc.returncode = returncode          # already reaped by wait4
+
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    rss = rusage.ru_maxrss / 1024.
+    if sys.platform == 'darwin':
+        rss /= 1024.
+
+    return wall, rss, returncode
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=SCRIPTS_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline_file):
+    with open(baseline_file, 'rt') as fp:
+        baseline = json.load(fp)
+
+    print('')
+    print('{:30s} {:>10s} {:>10s} {:>8s} {:>8s}'.format('scenario',
+          'wall', 'baseline', 'time x', 'rss x'))
+    for name, result in sorted(report['scenarios'].items()):
+        old = baseline['scenarios'].get(name)
+        if not old:
+            continue
+        print('{:30s} {:10.2f} {:10.2f} {:8.2f} {:8.2f}'.format(name,
+              result['wall_seconds'], old['wall_seconds'],
+              result['wall_seconds'] / old['wall_seconds'],
+              result['peak_rss_mb'] / old['peak_rss_mb']))
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('data_dir', help='output directory of make-synthetic-data.py')
+    p.add_argument('-o', '--output', default='benchmark-report.json')
+    p.add_argument('--scenario', action='append',
+                   help='run only this scenario (may be repeated)')
+    p.add_argument('--repeat', type=int, default=1,
+                   help='run each scenario this many times; keep the fastest')
+    p.add_argument('--compare', help='earlier JSON report to compare against')
+    p.add_argument('--keep', action='store_true',
+                   help='keep the scenario output directory')
+    args = p.parse_args(args)
+
+    data_dir = os.path.abspath(args.data_dir)
+    with open(os.path.join(data_dir, 'params.json'), 'rt') as fp:
+        params = json.load(fp)
+
+    outdir = tempfile.mkdtemp(prefix='bench-')
+
+    # bulk-classify-dig.py finds its signatures under {prefix}-unclassified-sigs
+    os.symlink(os.path.join(data_dir, 'dig-unclassified-sigs'),
+               os.path.join(outdir, 'dig-unclassified-sigs'))
+    scenarios = scenario_args(data_dir, outdir)
+    names = args.scenario or sorted(scenarios)
+
+    report = dict(params=params, git_commit=git_commit(),
+                  python=platform.python_version(), host=platform.node(),
+                  date=time.strftime('%Y-%m-%dT%H:%M:%S'), scenarios={})
+
+    for name in names:
+        script, script_args, count_key = scenarios[name]
+        best = None
+        for i in range(args.repeat):
+            result = run_one(script, script_args, outdir)
+            if best is None or result[0] < best[0]:
+                best = result
+        wall, rss, returncode = best
+
+        if returncode != 0:
+            print('** {} failed with code {}; see {}'.format(name,
+                  returncode, os.path.join(outdir, script + '.log')))
+
+        n_items = params[count_key]
+        report['scenarios'][name] = dict(wall_seconds=wall,
+                                         peak_rss_mb=rss,
+                                         throughput=n_items / wall,
+                                         throughput_unit=count_key + '/sec',
+                                         returncode=returncode)
+        print('{}: {:.2f}s, {:.1f} {}/sec, {:.0f} MB peak RSS'.format(name,
+              wall, n_items / wall, count_key, rss))
+
+    with open(args.output, 'wt') as fp:
+        json.dump(report, fp, indent=2)
+    print('wrote report to {}'.format(args.output))
+
+    if args.compare:
+        compare(report, args.compare)
+
+    if args.keep:
+        print('scenario outputs are in {}'.format(outdir))
+    else:
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -6,6 +6,10 @@ Briefly, this script sorts results classed above order level into two bins
 * those that contain multiple hashes belonging unambiguously to two different
   species, i.e. chimerae.
 * other, e.g. things classed as a single lineage.
+
+Hash-level LCAs are aggregated up to order by default; with several
+--level options, the sorting is done at each of those ranks in one pass,
+and the output files for all but the first level get a -{level} suffix.
 """
 import sourmash
 import sys
@@ -14,29 +18,41 @@ import pprint
 import csv
 import os
 
+import numpy as np
+
 from sourmash.logging import error, debug, set_quiet, notify
 from sourmash.lca import lca_utils
 from sourmash.lca.command_classify import classify_signature
 import argparse
 
+from classify_cache import (ClassifyCache, DEFAULT_MAX_SIZE, file_fingerprint,
+                            lineage_counts_to_json, json_to_lineage_counts)
+from lca_service import LCAClient, aggregate_to_level
+from instrument import Profile, add_profile_args
+from lca_stream import load_databases, LINEAGE_SECTIONS
+from lca_vector import (LineageCodes, LEVELS, minhash_hashvals,
+                        remove_hashvals)
+from csv_io import CSVWriter, add_compress_args, compressed_name, open_text
+
 FILTER_AT='order'
 
 
-def summarize_agg_to_level(hashvals, dblist, threshold, level):
+def summarize_agg_to_level(hashvals, dblist, threshold, level,
+                           lineage_codes=None):
     """
     Classify 'hashvals' using the given list of databases.
 
     Insist on at least 'threshold' counts of a given lineage before taking
     it seriously.
 
+    If 'lineage_codes' (a LineageCodes for 'dblist') is given, use it to
+    compute the LCAs in one vectorized batch.
+
     Return (lineage, counts) where 'lineage' is a tuple of LineagePairs.
     """
-
-    stop_at = []
-    for i in lca_utils.taxlist(include_strain=False):
-        stop_at.append(i)
-        if i == level:
-            break
+    if lineage_codes is not None:
+        ids, counts = lineage_codes.lca_id_counts(hashvals)
+        return lineage_codes.aggregate_to_level(ids, counts, threshold, level)
 
     # gather assignments from across all the databases
     assignments = lca_utils.gather_assignments(hashvals, dblist)
@@ -45,30 +61,7 @@ def summarize_agg_to_level(hashvals, dblist, threshold, level):
     counts = lca_utils.count_lca_for_assignments(assignments)
     debug(counts.most_common())
 
-    # ok, we now have the LCAs for each hashval, and their number
-    # of counts. Now aggregate counts across the tree, up 'til desired
-    # level; stop there.
-    aggregated_counts = defaultdict(int)
-    for lca, count in counts.most_common():
-        if count < threshold:
-            break
-
-        if not lca:
-            aggregated_counts[lca] += count
-            continue
-
-        if lca[-1].rank in stop_at:
-            aggregated_counts[lca] += count
-            continue
-
-        # climb from the lca to the root.
-        while lca:
-            lca = lca[:-1]
-            if lca and lca[-1].rank in stop_at:
-                aggregated_counts[lca] += count
-                break
-
-    return aggregated_counts
+    return aggregate_to_level(counts, threshold, level)
 
 
 def main(args):
@@ -76,87 +69,191 @@ def main(args):
     """
     p = argparse.ArgumentParser()
     p.add_argument('prefix')
-    p.add_argument('lca_db', nargs='+')
+    p.add_argument('lca_db', nargs='*')
     p.add_argument('classify_csv')
     p.add_argument('--scaled', type=float)
     p.add_argument('--threshold', type=int, default=5)
+    p.add_argument('--level', action='append', choices=LEVELS,
+                   help='rank to aggregate to (default: {}); may be repeated'.format(FILTER_AT))
     p.add_argument('-q', '--quiet', action='store_true',
                    help='suppress non-error output')
     p.add_argument('-d', '--debug', action='store_true',
                    help='output debugging output')
     p.add_argument('--confused-hashvals', type=str)
+    p.add_argument('--cache', help='SQLite file for caching summaries')
+    p.add_argument('--cache-size', type=int, default=DEFAULT_MAX_SIZE,
+                   help='maximum number of cached summaries')
+    p.add_argument('--server',
+                   help='use the lca-server.py on this socket instead of loading databases')
+    add_profile_args(p)
+    add_compress_args(p)
     args = p.parse_args(args)
 
+    levels = args.level or [FILTER_AT]
+    if len(set(levels)) != len(levels):
+        error('Error! --level given more than once for the same rank')
+        sys.exit(-1)
+
+    # output files for levels after the first are suffixed with the level.
+    suffixes = dict([ (level, '-' + level) for level in levels[1:] ])
+    suffixes[levels[0]] = ''
+
     dirname = '{}-unclassified-sigs'.format(args.prefix)
-    dirname2 = '{}-unclassified-sigs-chimera.info'.format(args.prefix)
-    try:
-        os.mkdir(dirname2)
-    except:
-        pass
+    dirname2 = {}
+    for level in levels:
+        dirname2[level] = '{}-unclassified-sigs-chimera{}.info'.format(args.prefix, suffixes[level])
+        try:
+            os.mkdir(dirname2[level])
+        except:
+            pass
     set_quiet(args.quiet, args.debug)
+    profile = Profile.from_args(args)
 
     if args.scaled:
         args.scaled = int(args.scaled)
 
-    # load all the databases
-    dblist, ksize, scaled = lca_utils.load_databases(args.lca_db, args.scaled)
+    if args.server and (args.lca_db or args.cache):
+        error('Error! --server cannot be combined with LCA databases or --cache')
+        sys.exit(-1)
 
-    print(ksize, scaled)
+    client = None
+    if args.server:
+        client = LCAClient(args.server)
+        dblist, ksize, scaled = None, client.ksize, client.scaled
+    else:
+        # load all the databases
+        with profile.stage('load_databases'):
+            dblist, ksize, scaled = load_databases(args.lca_db, args.scaled,
+                                                   sections=LINEAGE_SECTIONS)
+        assert len(dblist) == 1
 
-    assert len(dblist) == 1
-    lca_db = dblist[0]
+        with profile.stage('lineage_codes'):
+            lineage_codes = LineageCodes(dblist)
+
+    print(ksize, scaled)
 
     confused_hashvals = set()
     if args.confused_hashvals:
         for i in open(args.confused_hashvals, 'rt'):
             confused_hashvals.add(int(i.strip()))
+    confused_hashvals = np.array(sorted(confused_hashvals), dtype=np.uint64)
+
+    cache = None
+    if args.cache:
+        cache = ClassifyCache(args.cache, args.cache_size)
+
+        # results depend on the filter level and the confused hashvals, too.
+        methods = {}
+        for level in levels:
+            methods[level] = 'dig:{}'.format(level)
+            if args.confused_hashvals:
+                methods[level] += ':' + file_fingerprint(args.confused_hashvals)
 
     ###
 
-    fp = open(args.classify_csv, 'rt')
+    fp = open_text(args.classify_csv)
     r = csv.DictReader(fp, fieldnames=['rank', 'name', 'filename', 'md5sum'])
 
-    fp2 = open('{}-dig.csv'.format(args.prefix), 'wt')
-    w = csv.writer(fp2)
-
-    n = 0
-    m = 0
-    for row in r:
-        if row['rank'] in ('MISSED', 'species', 'genus', 'family', 'order'):
-            continue
-        name = row['name']
-        md5sum = row['md5sum']
-        sig = sourmash.load_one_signature(os.path.join(dirname, md5sum) + '.sig')
-
-        hashvals = defaultdict(int)
-        for hashval in sig.minhash.get_mins():
-            if hashval not in confused_hashvals:
-                hashvals[hashval] += 1
-
-        lineage_counts = summarize_agg_to_level(hashvals, dblist, args.threshold, FILTER_AT)
-
-        if len(lineage_counts) >= 2:
-            print(name)
-            for lineage, count in lineage_counts.items():
-                if lineage:
-                    print('   ', count, ";".join(lca_utils.zip_lineage(lineage)))
+    writers = {}
+    for level in levels:
+        filename = '{}-dig{}.csv'.format(args.prefix, suffixes[level])
+        writers[level] = CSVWriter(compressed_name(filename, args.compress))
+
+    n = defaultdict(int)
+    m = defaultdict(int)
+    with profile.hot_loop():
+        for row in r:
+            if row['rank'] in ('MISSED', 'species', 'genus', 'family', 'order'):
+                continue
+            name = row['name']
+            md5sum = row['md5sum']
+            profile.count('signatures')
+
+            level_counts = {}
+            if cache:
+                for level in levels:
+                    cached = cache.get(md5sum, dblist, args.threshold,
+                                       methods[level])
+                    if cached:
+                        level_counts[level] = json_to_lineage_counts(cached[1])
+
+            missing = [ level for level in levels if level not in level_counts ]
+            if missing:
+                with profile.stage('load_signature'):
+                    sig = sourmash.load_one_signature(os.path.join(dirname, md5sum) + '.sig')
+
+                with profile.stage('gather_hashes'):
+                    hashvals = minhash_hashvals(sig.minhash, scaled)
+                    hashvals = remove_hashvals(hashvals, confused_hashvals)
+
+                # do the LCAs once, then aggregate to each level.
+                with profile.stage('lca'):
+                    if client:
+                        counts = client.lca_counts([hashvals])[0]
+                        for level in missing:
+                            level_counts[level] = aggregate_to_level(counts,
+                                                                     args.threshold,
+                                                                     level)
+                    else:
+                        ids, counts = lineage_codes.lca_id_counts(hashvals)
+                        for level in missing:
+                            level_counts[level] = \
+                              lineage_codes.aggregate_to_level(ids, counts,
+                                                               args.threshold,
+                                                               level)
+
+                if cache:
+                    for level in missing:
+                        lineage_counts = level_counts[level]
+                        status = 'other'
+                        if len(lineage_counts) >= 2:
+                            status = 'chimera'
+                        cache.put(md5sum, dblist, args.threshold, level,
+                                  lineage_counts_to_json(lineage_counts),
+                                  status, methods[level])
+
+            for level in levels:
+                lineage_counts = level_counts[level]
+                w = writers[level]
+
+                if len(lineage_counts) >= 2:
+                    if len(levels) > 1:
+                        print(name, '({})'.format(level))
+                    else:
+                        print(name)
+                    for lineage, count in lineage_counts.items():
+                        if lineage:
+                            print('   ', count, ";".join(lca_utils.zip_lineage(lineage)))
+                        else:
+                            print('   ', count, 'root')
+                    print('----\n')
+
+                    with profile.stage('write_output'):
+                        fp3 = open(os.path.join(dirname2[level], row['md5sum']) + '.txt', 'wt')
+                        for lineage, count in lineage_counts.items():
+                            fp3.write("{} {}\n".format(count, ";".join(lca_utils.zip_lineage(lineage))))
+                        fp3.close()
+
+                    n[level] += 1
+
+                    w.writerow(['chimera', row['name'], row['filename'], row['md5sum']])
                 else:
-                    print('   ', count, 'root')
-            print('----\n')
-
-            fp3 = open(os.path.join(dirname2, row['md5sum']) + '.txt', 'wt')
-            for lineage, count in lineage_counts.items():
-                fp3.write("{} {}\n".format(count, ";".join(lca_utils.zip_lineage(lineage))))
-            fp3.close()
-                
-            n += 1
-
-            w.writerow(['chimera', row['name'], row['filename'], row['md5sum']])
+                    w.writerow(['other', row['name'], row['filename'], row['md5sum']])
+                    m[level] += 1
+
+    fp.close()
+    for level in levels:
+        writers[level].close()
+        if len(levels) > 1:
+            print(level, n[level], m[level])
         else:
-            w.writerow(['other', row['name'], row['filename'], row['md5sum']])
-            m += 1
+            print(n[level], m[level])
+
+    if cache:
+        cache.report()
+        cache.close()
 
-    print(n, m)
+    profile.save()
 
 
 if __name__ == '__main__':
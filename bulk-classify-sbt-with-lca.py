@@ -9,32 +9,317 @@ the lowest taxonomic rank at which something is unambiguously classified,
 and will be "MISSED" if no classification is available.
 
 Also outputs a directory of unclassified signatures.
+
+With --multi-ksize, LCA databases at several ksizes may be given; each
+SBT leaf is loaded once, classified at every ksize, and the spreadsheet
+has per-ksize rank/lineage columns plus an agreement column. This needs
+SBT leaves that store all ksizes, e.g. built from the multi-ksize
+signatures produced by the gtdbtk Snakefile. A leaf that is not well
+classified at some ksize has the signatures for all of its ksizes saved
+together, in a file named after the md5sum in the CSV (that of the
+smallest ksize). This CSV starts with the name, not the rank, and so
+cannot be given to bulk-classify-dig.py, which expects the fixed
+rank,name,filename,md5sum columns; use bulk-grab-sigs.py with
+--rank-column rank_k{ksize} to select from it.
+
+With --save-profiles, the LCA count profile of every signature is
+stored, so that rederive-from-profiles.py can redo the classification
+(and the dig and investigate steps) at other thresholds.
+
+With --coarse-scaled, each signature is first classified on a minhash
+downsampled to that scaled, and is only re-classified at full resolution
+if the coarse result is a disagreement, or is above --coarse-rank.
+
+With --compress, the spreadsheet is written gzip- or zstd-compressed;
+the downstream scripts read either form.
 """
 import sourmash
 import sys
 from collections import defaultdict
 import pprint
-import csv
 import os
+import copy
+from io import BytesIO
 
 from sourmash.logging import error, debug, set_quiet, notify
 from sourmash.lca import lca_utils
 from sourmash.lca.command_classify import classify_signature
 import argparse
 
+from classify_cache import ClassifyCache, DEFAULT_MAX_SIZE
+from lca_service import LCAClient, lca_counts, classify_counts
+from lca_profiles import ProfileStore
+from lca_vector import LineageCodes
+from instrument import Profile, add_profile_args
+from lca_stream import load_databases, LINEAGE_SECTIONS
+from metrics import add_metrics_args, start_metrics_from_args
+from csv_io import CSVWriter, add_compress_args, compressed_name
+
+WELL_CLASSIFIED = ('genus', 'species', 'family', 'order')
+
+RANKS = list(lca_utils.taxlist())
+
+
+class TieredClassifier(object):
+    """
+    Classify coarse-to-fine: first on the signature downsampled to
+    'scaled', then, if that is ambiguous or does not reach 'rank', at
+    full resolution.
+
+    Downsampled hashes can only match database hashes below the same
+    max_hash, so the coarse pass uses the databases as they are, i.e. a
+    downsampled view of them, and works with --cache and --server too.
+    """
+    def __init__(self, classify_fn, scaled, rank, threshold):
+        self.classify_fn = classify_fn
+        self.scaled = scaled
+        self.min_depth = RANKS.index(rank)
+        self.threshold = threshold
+        self.n_coarse = 0
+        self.n_full = 0
+
+    def classify_signature(self, sig, dblist, threshold):
+        if sig.minhash.scaled >= self.scaled:
+            self.n_full += 1
+            return self.classify_fn(sig, dblist, threshold)
+
+        coarse_sig = copy.copy(sig)
+        coarse_sig.minhash = sig.minhash.downsample_scaled(self.scaled)
+        classified_as, why = self.classify_fn(coarse_sig, dblist,
+                                              self.threshold)
+        if why == 'found' and classified_as and \
+           RANKS.index(classified_as[-1].rank) >= self.min_depth:
+            self.n_coarse += 1
+            return classified_as, why
+
+        self.n_full += 1
+        return self.classify_fn(sig, dblist, threshold)
+
+    def report(self):
+        total = self.n_coarse + self.n_full
+        print('resolved at scaled={}: {} of {}'.format(self.scaled,
+                                                       self.n_coarse, total))
+        print('re-classified at full resolution: {} of {}'.format(self.n_full,
+                                                                  total))
+
+
+def load_databases_by_ksize(filenames, scaled):
+    """
+    Load LCA databases that may have different ksizes.
+
+    Return (ksize_to_dblist, scaled), where 'ksize_to_dblist' maps each
+    ksize to the list of databases at that ksize.
+    """
+    ksize_to_dblist = defaultdict(list)
+    scaled_vals = set()
+    for filename in filenames:
+        dblist, ksize, db_scaled = load_databases([filename], scaled,
+                                                  sections=LINEAGE_SECTIONS)
+        ksize_to_dblist[ksize].extend(dblist)
+        scaled_vals.add(db_scaled)
+
+    if len(scaled_vals) > 1:
+        # bring everything down to the coarsest resolution
+        scaled = max(scaled_vals)
+        for dblist in ksize_to_dblist.values():
+            for lca_db in dblist:
+                lca_db.downsample_scaled(scaled)
+    else:
+        scaled = scaled_vals.pop()
+
+    return dict(ksize_to_dblist), scaled
+
+
+def load_leaf_signatures(leaf):
+    """
+    Load all of the signatures stored for this SBT leaf, at any ksize.
+
+    (SigLeaf.data insists on exactly one signature per leaf.)
+    """
+    buf = BytesIO(leaf.storage.load(leaf._path))
+    return list(sourmash.load_signatures(buf))
+
+
+def classify_rank(sig, dblist, threshold, classify_fn=classify_signature):
+    "Classify 'sig' and return (rank, lineage) as written to the CSV."
+    classified_as, why = classify_fn(sig, dblist, threshold)
+
+    if classified_as:
+        return classified_as[-1].rank, classified_as
+    elif why == 'disagree':
+        return 'root', ()
+
+    return 'MISSED', ()
+
+
+def ksize_agreement(lineages):
+    """
+    Compare the lineages assigned at different ksizes.
+
+    Return 'agree' if they are all identical, 'consistent' if they all
+    lie along a single path in the taxonomy (i.e. differ only in depth),
+    'disagree' otherwise, and 'missed' if nothing was classified.
+    """
+    lineages = [ lin for lin in lineages if lin ]
+    if not lineages:
+        return 'missed'
+
+    if len(set(lineages)) == 1:
+        return 'agree'
+
+    tree = lca_utils.build_tree(lineages)
+    lca, reason = lca_utils.find_lca(tree)
+    if reason == 0:
+        return 'consistent'
+
+    return 'disagree'
+
+
+def check_coarse_scaled(coarse_scaled, scaled):
+    "Exit unless --coarse-scaled is coarser than the databases' scaled."
+    if coarse_scaled and coarse_scaled <= scaled:
+        error('Error! --coarse-scaled must be larger than the database scaled {}',
+              scaled)
+        sys.exit(-1)
+
+
+def classify_multi_ksize(args, dirname, classify_fn, profile, metrics):
+    """
+    Classify every leaf of the SBT against databases at several ksizes
+    in a single traversal.
+    """
+    with profile.stage('load_databases'):
+        ksize_to_dblist, scaled = load_databases_by_ksize(args.lca_db,
+                                                          args.scaled)
+    ksizes = list(sorted(ksize_to_dblist))
+
+    print(ksizes, scaled)
+    check_coarse_scaled(args.coarse_scaled, scaled)
+
+    with profile.stage('load_sbt'):
+        sbt_db = sourmash.load_sbt_index(args.sbt)
+    metrics.set_total(sum(1 for leaf in sbt_db.leaves()))
+
+    counts = { ksize: defaultdict(int) for ksize in ksizes }
+    n_missed = defaultdict(int)
+    agreement_counts = defaultdict(int)
+
+    w = CSVWriter(compressed_name('{}-bulk-classify.csv'.format(args.prefix),
+                                  args.compress))
+    header = ["name", "filename", "md5sum"]
+    for ksize in ksizes:
+        header += ["rank_k{}".format(ksize), "lineage_k{}".format(ksize)]
+    header.append("agreement")
+    w.writerow(header)
+
+    n = 0
+    for n, leaf in enumerate(sbt_db.leaves()):
+        if n % 100 == 0:
+            print('...', n)
+
+        profile.count('signatures')
+        ksize_to_sig = {}
+        with profile.stage('load_leaf'):
+            for sig in load_leaf_signatures(leaf):
+                ksize_to_sig.setdefault(sig.minhash.ksize, sig)
+
+        # the leaf signature at the first available ksize names the row.
+        primary = None
+        for ksize in ksizes:
+            if ksize in ksize_to_sig:
+                primary = ksize_to_sig[ksize]
+                break
+        if primary is None:
+            error('no signature in leaf {} matches ksizes {}; skipping',
+                  leaf.name, ksizes)
+            continue
+
+        row = [primary.name(), primary.d.get('filename', ''),
+               primary.md5sum()]
+        lineages = []
+        all_well_classified = True
+        for ksize in ksizes:
+            sig = ksize_to_sig.get(ksize)
+            if sig is None:
+                rank, lineage = 'MISSED', ()
+            else:
+                with profile.stage('classify'):
+                    rank, lineage = classify_rank(sig, ksize_to_dblist[ksize],
+                                                  args.threshold, classify_fn)
+
+            if rank == 'MISSED':
+                n_missed[ksize] += 1
+            elif lineage:
+                counts[ksize][rank] += 1
+            metrics.classified(rank, ksize)
+            if rank not in WELL_CLASSIFIED:
+                all_well_classified = False
+
+            lineages.append(lineage)
+            row += [rank, lca_utils.display_lineage(lineage)]
+
+        agreement = ksize_agreement(lineages)
+        agreement_counts[agreement] += 1
+        row.append(agreement)
+        with profile.stage('write_output'):
+            w.writerow(row)
+
+            # save every ksize, so that any of them can be dug into.
+            if not all_well_classified:
+                md5name = primary.md5sum()
+                siglist = [ ksize_to_sig[ksize] for ksize in ksizes
+                            if ksize in ksize_to_sig ]
+                with open('{}/{}.sig'.format(dirname, md5name), 'wt') as fp2:
+                    sourmash.save_signatures(siglist, fp2)
+        metrics.signature_done()
+
+        if n % 1000 == 0 and n:
+            print('at', n, 'genomes...')
+            for ksize in ksizes:
+                print('k={}:'.format(ksize), list(counts[ksize].items()),
+                      'missed:', n_missed[ksize])
+
+    w.close()
+
+    for ksize in ksizes:
+        print('k={}:'.format(ksize))
+        pprint.pprint(list(counts[ksize].items()))
+        print('missed:', n_missed[ksize], 'of', n)
+    print('agreement across ksizes:')
+    pprint.pprint(list(agreement_counts.items()))
+
 
 def main(args):
     """
     """
     p = argparse.ArgumentParser()
     p.add_argument('prefix')
-    p.add_argument('lca_db', nargs='+')
+    p.add_argument('lca_db', nargs='*')
     p.add_argument('sbt')
     p.add_argument('--scaled', type=float)
+    p.add_argument('--threshold', type=int, default=5)
+    p.add_argument('--multi-ksize', action='store_true',
+                   help='classify against LCA databases at several ksizes in one pass over the SBT')
+    p.add_argument('--cache', help='SQLite file for caching classifications')
+    p.add_argument('--cache-size', type=int, default=DEFAULT_MAX_SIZE,
+                   help='maximum number of cached classifications')
+    p.add_argument('--server',
+                   help='classify using the lca-server.py on this socket instead of loading databases')
+    p.add_argument('--save-profiles',
+                   help='SQLite file to store per-signature LCA count profiles in')
+    p.add_argument('--coarse-scaled', type=float,
+                   help='first classify at this (larger) scaled value')
+    p.add_argument('--coarse-rank', default='genus', choices=RANKS,
+                   help='accept coarse classifications at or below this rank (default: %(default)s)')
+    p.add_argument('--coarse-threshold', type=int,
+                   help='threshold for coarse classification (default: --threshold)')
     p.add_argument('-q', '--quiet', action='store_true',
                    help='suppress non-error output')
     p.add_argument('-d', '--debug', action='store_true',
                    help='output debugging output')
+    add_profile_args(p)
+    add_metrics_args(p)
+    add_compress_args(p)
     args = p.parse_args(args)
 
     dirname = '{}-unclassified-sigs'.format(args.prefix)
@@ -44,61 +329,157 @@ def main(args):
     except:
         print('WARNING: {} already exists.'.format(dirname), file=sys.stderr)
 
-    if not args.lca_db:
+    if not args.lca_db and not args.server:
         error('Error! must specify at least one LCA database with')
         sys.exit(-1)
 
+    if args.server and (args.lca_db or args.cache or args.multi_ksize):
+        error('Error! --server cannot be combined with LCA databases, --cache or --multi-ksize')
+        sys.exit(-1)
+
+    if args.save_profiles and (args.cache or args.multi_ksize or args.coarse_scaled):
+        error('Error! --save-profiles cannot be combined with --cache, --multi-ksize or --coarse-scaled')
+        sys.exit(-1)
+
     set_quiet(args.quiet, args.debug)
+    profile = Profile.from_args(args)
+    metrics = start_metrics_from_args(args, 'bulk-classify-sbt-with-lca')
 
     if args.scaled:
         args.scaled = int(args.scaled)
+    if args.coarse_scaled:
+        args.coarse_scaled = int(args.coarse_scaled)
+        if args.scaled and args.coarse_scaled <= args.scaled:
+            error('Error! --coarse-scaled must be larger than --scaled')
+            sys.exit(-1)
+    if args.coarse_threshold is None:
+        args.coarse_threshold = args.threshold
+
+    classify_fn = classify_signature
+    cache = None
+    if args.cache:
+        cache = ClassifyCache(args.cache, args.cache_size)
+        classify_fn = cache.classify_signature
+
+    tiered = None
+    if args.coarse_scaled:
+        tiered = TieredClassifier(classify_fn, args.coarse_scaled,
+                                  args.coarse_rank, args.coarse_threshold)
+
+    if args.multi_ksize:
+        if tiered:
+            classify_fn = tiered.classify_signature
+        with profile.hot_loop():
+            classify_multi_ksize(args, dirname, classify_fn, profile, metrics)
+        if tiered:
+            tiered.report()
+        if cache:
+            cache.report()
+            cache.close()
+        profile.save()
+        return
 
-    # load all the databases
-    dblist, ksize, scaled = lca_utils.load_databases(args.lca_db, args.scaled)
+    if args.server:
+        client = LCAClient(args.server)
+        classify_fn = client.classify_signature
+        count_fn = lambda sig: \
+          client.lca_counts([client.query_hashvals(sig.minhash)])[0]
+        dblist, ksize, scaled = None, client.ksize, client.scaled
+        databases = client.info()['databases']
+    else:
+        # load all the databases
+        with profile.stage('load_databases'):
+            dblist, ksize, scaled = load_databases(args.lca_db, args.scaled,
+                                                   sections=LINEAGE_SECTIONS)
+        databases = args.lca_db
+        if args.save_profiles:
+            with profile.stage('lineage_codes'):
+                lineage_codes = LineageCodes(dblist)
+            count_fn = lambda sig: \
+              lca_counts(sig.minhash.get_mins(), dblist, lineage_codes)
 
     print(ksize, scaled)
 
-    sbt_db = sourmash.load_sbt_index(args.sbt)
+    store = None
+    if args.save_profiles:
+        store = ProfileStore(args.save_profiles, create=True)
+        store.set_info(ksize=ksize, scaled=scaled,
+                       databases=' '.join(databases))
+
+    if tiered:
+        check_coarse_scaled(args.coarse_scaled, scaled)
+        tiered.classify_fn = classify_fn
+        classify_fn = tiered.classify_signature
+
+    with profile.stage('load_sbt'):
+        sbt_db = sourmash.load_sbt_index(args.sbt)
+    metrics.set_total(sum(1 for leaf in sbt_db.leaves()))
 
     counts = defaultdict(int)
     n_missed = 0
-    fp = open('{}-bulk-classify.csv'.format(args.prefix), 'wt')
-    w = csv.writer(fp)
+    w = CSVWriter(compressed_name('{}-bulk-classify.csv'.format(args.prefix),
+                                  args.compress))
     w.writerow(["rank", "name", "filename", "md5sum", "lineage"])
-    for n, sig in enumerate(sbt_db.signatures()):
-        if n % 100 == 0:
-            print('...', n)
-            fp.flush()
-
-        lineage = ''
-        classified_as, why = classify_signature(sig, dblist, 5)
+    with profile.hot_loop():
+        for n, sig in enumerate(profile.timed_iter('load_leaf',
+                                                   sbt_db.signatures())):
+            if n % 100 == 0:
+                print('...', n)
 
-        if classified_as:
-            rank = classified_as[-1].rank
-            counts[rank] += 1
-            lineage = lca_utils.display_lineage(classified_as)
-        elif why == 'disagree':
-            rank = 'root'
+            profile.count('signatures')
             lineage = ''
-        else:
-            rank = 'MISSED'
-            n_missed += 1
+            with profile.stage('classify'):
+                if store is not None:
+                    sig_counts = count_fn(sig)
+                    store.put(sig.md5sum(), sig.name(),
+                              sig.d.get('filename', ''), sig_counts)
+                    classified_as, why = classify_counts(sig_counts,
+                                                         args.threshold)
+                else:
+                    classified_as, why = classify_fn(sig, dblist,
+                                                     args.threshold)
 
-        w.writerow([rank, sig.name(), sig.d['filename'], sig.md5sum(), lineage])
+            if classified_as:
+                rank = classified_as[-1].rank
+                counts[rank] += 1
+                lineage = lca_utils.display_lineage(classified_as)
+            elif why == 'disagree':
+                rank = 'root'
+                lineage = ''
+            else:
+                rank = 'MISSED'
+                n_missed += 1
 
-        if rank not in ('genus', 'species', 'family', 'order'):
-            md5name = sig.md5sum()
-            with open('{}/{}.sig'.format(dirname, md5name), 'wt') as fp2:
-                sourmash.save_signatures([sig], fp2)
+            with profile.stage('write_output'):
+                w.writerow([rank, sig.name(), sig.d['filename'], sig.md5sum(), lineage])
 
-        if n % 1000 == 0 and n:
-            print('at', n, 'genomes...')
-            pprint.pprint(list(counts.items()))
-            print('missed:', n_missed, 'of', n)
+                if rank not in WELL_CLASSIFIED:
+                    md5name = sig.md5sum()
+                    with open('{}/{}.sig'.format(dirname, md5name), 'wt') as fp2:
+                        sourmash.save_signatures([sig], fp2)
+            metrics.classified(rank)
+            metrics.signature_done()
+
+            if n % 1000 == 0 and n:
+                print('at', n, 'genomes...')
+                pprint.pprint(list(counts.items()))
+                print('missed:', n_missed, 'of', n)
         
+    w.close()
     pprint.pprint(list(counts.items()))
     print('missed:', n_missed, 'of', n)
 
+    if tiered:
+        tiered.report()
+    if store is not None:
+        print('saved {} profiles to {}'.format(len(store), args.save_profiles))
+        store.close()
+    if cache:
+        cache.report()
+        cache.close()
+
+    profile.save()
+
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
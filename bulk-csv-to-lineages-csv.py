@@ -8,17 +8,34 @@ import pprint
 import sourmash
 from sourmash.lca import lca_utils
 
+from results_db import ResultsDB
+from csv_io import open_text
+
 
 def main():
     p = argparse.ArgumentParser()
-    p.add_argument('bulk_classify_csvs', nargs='+')
+    p.add_argument('bulk_classify_csvs', nargs='+',
+                   help='CSV files, or source prefixes with --results-db')
     p.add_argument('lineages_csv_out')
+    p.add_argument('--results-db',
+                   help='read from this ingest-bulk-classify.py database')
     p.add_argument('-v', '--verbose', action='store_true')
     args = p.parse_args()
 
     ident_to_tax = {}
+    if args.results_db:
+        results_db = ResultsDB(args.results_db)
+        n = 0
+        for ident, lineage in results_db.iter_names(args.bulk_classify_csvs):
+            if ident in ident_to_tax:
+                print('*** WARNING *** ident {} occurs more than once!?'.format(ident))
+            ident_to_tax[ident] = lineage.split(';')
+            n += 1
+        print('loaded {} rows from results db {}'.format(n, args.results_db))
+        args.bulk_classify_csvs = []
+
     for filename in args.bulk_classify_csvs:
-        with open(filename, 'rt') as fp:
+        with open_text(filename) as fp:
             r = csv.DictReader(fp)
             n = 0
             for n, row in enumerate(r):
@@ -1,42 +1,184 @@
 #! /usr/bin/env python
+"""
+Collect the unclassified signatures for the selected ranks from one or
+more bulk-classify-sbt-with-lca.py runs, for re-investigation.
+
+Signatures can be copied (with a thread pool, -j), hardlinked or
+symlinked into --sigdir, and/or written into one combined signature
+file with -o.
+
+With --results-db, the prefixes are looked up in a database made by
+ingest-bulk-classify.py instead of scanning the CSVs.
+"""
 import csv
+import sys
+import json
+import errno
 import argparse
 import shutil
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from results_db import ResultsDB
+from csv_io import open_text, find_csv
+
+DEFAULT_RANKS = ['superkingdom', 'root']
+
+
+def place_signature(sigfile, outfile, mode):
+    """
+    Copy, hardlink or symlink 'sigfile' to 'outfile'; return the mode
+    actually used (hardlinks fall back to copies across filesystems).
+    """
+    if mode != 'copy' and os.path.lexists(outfile):
+        os.unlink(outfile)
+
+    if mode == 'hardlink':
+        try:
+            os.link(sigfile, outfile)
+            return mode
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            mode = 'copy'
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(sigfile), outfile)
+        return mode
+
+    shutil.copyfile(sigfile, outfile)
+    return mode
+
+
+def read_signature_json(sigfile):
+    "Return the list of signature records in 'sigfile', as parsed JSON."
+    with open(sigfile, 'rt') as fp:
+        return json.load(fp)
+
+
+def write_combined(sigfiles, output, executor):
+    """
+    Write all the signatures in 'sigfiles' to one signature file, reading
+    them in parallel but writing one at a time; return the number written.
+    """
+    n = 0
+    with open(output, 'wt') as fp:
+        fp.write('[')
+        for records in executor.map(read_signature_json, sigfiles):
+            for record in records:
+                if n:
+                    fp.write(',\n')
+                json.dump(record, fp)
+                n += 1
+        fp.write(']\n')
+    return n
 
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('prefixes', nargs='+')
     p.add_argument('--sigdir', help='directory for signatures')
+    p.add_argument('-o', '--output', help='write all the signatures to this one file')
+    p.add_argument('--ranks', nargs='+', default=DEFAULT_RANKS,
+                   help='grab signatures classified at these ranks (default: %(default)s)')
+    p.add_argument('--rank-column', default='rank',
+                   help="CSV column to select on, e.g. 'rank_k31' for --multi-ksize output")
+    p.add_argument('--mode', choices=['copy', 'hardlink', 'symlink'],
+                   default='copy', help='how to put signatures in --sigdir')
+    p.add_argument('-j', '--threads', type=int, default=8,
+                   help='threads for copying and reading signatures')
+    p.add_argument('--results-db',
+                   help='select from this ingest-bulk-classify.py database')
     args = p.parse_args()
 
-    assert args.sigdir, "must supply --sigdir"
+    assert args.sigdir or args.output, "must supply --sigdir and/or -o/--output"
+
+    if args.sigdir:
+        try:
+            os.mkdir(args.sigdir)
+        except FileExistsError:
+            print('warning, sigdir {} already exists'.format(args.sigdir))
+            print('continuing...')
 
-    try:
-        os.mkdir(args.sigdir)
-    except FileExistsError:
-        print('warning, sigdir {} already exists'.format(args.sigdir))
-        print('continuing...')
+    ranks = set(args.ranks)
+    sigfiles = []
+    results_db = None
+    if args.results_db:
+        if args.rank_column != 'rank':
+            print('** --rank-column cannot be used with --results-db',
+                  file=sys.stderr)
+            sys.exit(-1)
+        results_db = ResultsDB(args.results_db)
 
     for prefix in args.prefixes:
-        csvname = prefix + '-bulk-classify.csv'
+        if results_db:
+            dirname = results_db.sigdir(prefix)
+            n = 0
+            for md5sum in results_db.md5sums_at_ranks(prefix, ranks):
+                sigfiles.append(os.path.join(dirname, md5sum + '.sig'))
+                n += 1
+            print(prefix, n)
+            continue
+
+        csvname = find_csv(prefix + '-bulk-classify.csv')
         dirname = prefix + '-unclassified-sigs'
 
-        with open(csvname, 'rt') as fp:
+        with open_text(csvname) as fp:
             n = 0
             r = csv.DictReader(fp)
+            if args.rank_column not in r.fieldnames:
+                print('** no column {} in {}'.format(args.rank_column, csvname),
+                      file=sys.stderr)
+                sys.exit(-1)
+
             for m, row in enumerate(r):
                 if m % 10000 == 0:
                     print(prefix, m, n)
-                if row['rank'] in ('superkingdom', 'root'):
+                if row[args.rank_column] in ranks:
                     n += 1
-                    sigfile = os.path.join(dirname, row['md5sum'] + '.sig')
-                    outfile = os.path.join(args.sigdir, row['md5sum'] + '.sig')
-                    shutil.copyfile(sigfile, outfile)
+                    sigfiles.append(os.path.join(dirname, row['md5sum'] + '.sig'))
 
             print(prefix, n)
-    
+
+    # bulk-classify only saves signatures that were not well classified;
+    # skip (and count) any that are not there, rather than failing midway.
+    missing = [ sigfile for sigfile in sigfiles if not os.path.exists(sigfile) ]
+    if missing:
+        print('warning, {} of {} signatures not found (e.g. {}); skipping them'.format(
+              len(missing), len(sigfiles), missing[0]), file=sys.stderr)
+        missing = set(missing)
+        sigfiles = [ sigfile for sigfile in sigfiles if sigfile not in missing ]
+
+    # the same md5sum can come from several prefixes, or several rows of
+    # one CSV; keep the first, so no two threads write the same outfile.
+    seen = set()
+    unique = []
+    for sigfile in sigfiles:
+        name = os.path.basename(sigfile)
+        if name not in seen:
+            seen.add(name)
+            unique.append(sigfile)
+    if len(unique) < len(sigfiles):
+        print('warning, skipping {} duplicate signatures'.format(
+              len(sigfiles) - len(unique)), file=sys.stderr)
+    sigfiles = unique
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        if args.sigdir:
+            outfiles = [ os.path.join(args.sigdir, os.path.basename(sigfile))
+                         for sigfile in sigfiles ]
+            modes = executor.map(place_signature, sigfiles, outfiles,
+                                 [args.mode] * len(sigfiles))
+            n_copied = sum([ 1 for mode in modes if mode == 'copy' ])
+            if args.mode == 'hardlink' and n_copied:
+                print('warning, copied {} signatures that could not be hardlinked'.format(n_copied))
+            print('placed {} signatures in {} ({})'.format(len(sigfiles),
+                                                           args.sigdir,
+                                                           args.mode))
+
+        if args.output:
+            n = write_combined(sigfiles, args.output, executor)
+            print('wrote {} signatures to {}'.format(n, args.output))
+
 
 if __name__ == '__main__':
     main()
@@ -10,13 +10,21 @@ import pprint
 import math
 from pickle import dump
 
+import numpy as np
+
 from sourmash import load_signatures
 from sourmash.logging import error, notify, set_quiet
 from sourmash.lca import lca_utils
-from sourmash.lca.command_summarize import summarize
-from sourmash.lca.command_classify import classify_signature
 from sourmash import sourmash_args
 
+from classify_cache import ClassifyCache, DEFAULT_MAX_SIZE
+from lca_service import (LCAClient, blame_lineages, summarize_counts,
+                         classify_hashvals)
+from lca_vector import LineageCodes, minhash_hashvals, remove_hashvals
+from instrument import Profile, add_profile_args
+from lca_stream import load_databases, LINEAGE_SECTIONS
+from metrics import add_metrics_args, start_metrics_from_args
+
 DEFAULT_THRESHOLD=5
 
 
@@ -29,10 +37,17 @@ def main():
                         help='load all signatures underneath directories.')
     p.add_argument('-o', '--output', help='output pickle file name')
     p.add_argument('--scaled', type=float)
+    p.add_argument('--cache', help='SQLite file for caching classifications')
+    p.add_argument('--cache-size', type=int, default=DEFAULT_MAX_SIZE,
+                   help='maximum number of cached classifications')
+    p.add_argument('--server',
+                   help='use the lca-server.py on this socket instead of loading databases')
     p.add_argument('-q', '--quiet', action='store_true',
                    help='suppress non-error output')
     p.add_argument('-d', '--debug', action='store_true',
                    help='output debugging output')
+    add_profile_args(p)
+    add_metrics_args(p)
 
     args = p.parse_args()
 
@@ -40,32 +55,66 @@ def main():
         error("must supply -o/--output pickle file")
         sys.exit(-1)
 
-    if not args.db:
+    if not args.db and not args.server:
         error('Error! must specify at least one LCA database with --db')
         sys.exit(-1)
 
+    if args.server and (args.db or args.cache):
+        error('Error! --server cannot be combined with --db or --cache')
+        sys.exit(-1)
+
     if not args.query:
         error('Error! must specify at least one query signature with --query')
         sys.exit(-1)
 
     set_quiet(args.quiet, args.debug)
+    profile = Profile.from_args(args)
+    metrics = start_metrics_from_args(args, 'bulk-investigate')
 
     if args.scaled:
         args.scaled = int(args.scaled)
 
     # flatten --db and --query
-    args.db = [item for sublist in args.db for item in sublist]
     args.query = [item for sublist in args.query for item in sublist]
 
-    # load all the databases
-    dblist, ksize, scaled = lca_utils.load_databases(args.db, args.scaled)
+    cache = None
+    if args.server:
+        client = LCAClient(args.server)
+        classify_fn = client.classify_signature
+        summarize_fn = lambda hashvals, dblist, threshold: \
+          client.summarize([hashvals], threshold)[0]
+        dblist, ksize, scaled = None, client.ksize, client.scaled
+    else:
+        args.db = [item for sublist in args.db for item in sublist]
+
+        # load all the databases
+        with profile.stage('load_databases'):
+            dblist, ksize, scaled = load_databases(args.db, args.scaled,
+                                                   sections=LINEAGE_SECTIONS)
+
+        # look up hash arrays with the vectorized LCA table.
+        with profile.stage('lineage_codes'):
+            lineage_codes = LineageCodes(dblist)
+        summarize_fn = lambda hashvals, dblist, threshold: \
+          summarize_counts(lineage_codes.lca_counts(hashvals), threshold)
+        classify_fn = lambda sig, dblist, threshold: \
+          classify_hashvals(minhash_hashvals(sig.minhash, scaled), dblist,
+                            threshold, lineage_codes)
+
+    if args.cache:
+        cache = ClassifyCache(args.cache, args.cache_size)
+        classify_fn = cache.classify_signature
 
     # find all the queries
     notify('finding query signatures...')
-    if args.traverse_directory:
-        inp_files = list(sourmash_args.traverse_find_sigs(args.query))
-    else:
-        inp_files = list(args.query)
+    with profile.stage('find_queries'):
+        if args.traverse_directory:
+            inp_files = list(sourmash_args.traverse_find_sigs(args.query))
+        else:
+            inp_files = list(args.query)
+
+    # usually one signature per query file, so this is a good estimate.
+    metrics.set_total(len(inp_files))
 
     combo_counts = defaultdict(list)
 
@@ -73,64 +122,65 @@ def main():
     total_count = 0
     n = 0
     total_n = len(inp_files)
-    for n, query_filename in enumerate(inp_files):
-        if n and n % 100 == 0:
-            print('...', n)
-
-        hashvals = defaultdict(int)
-        n += 1
-        for query_sig in load_signatures(query_filename, ksize=ksize):
-            total_count += 1
-
-            mh = query_sig.minhash.downsample_scaled(scaled)
-            for hashval in mh.get_mins():
-                hashvals[hashval] += 1
-
-            # get the full counted list of lineage counts in this signature
-            lineage_counts = summarize(hashvals, dblist, args.threshold)
-
-            if not lineage_counts:
-                continue
-
-            # also, separately, classify the signature, to get the lca:
-            lineage, status = classify_signature(query_sig, dblist,
-                                                 args.threshold)
-
-            # figure out the rank-after-classify => that's where it's confusing
-            lca_rank = 'root'
-            next_rank = 'superkingdom'
-            if lineage:
-                lca_rank = lineage[-1].rank
-                if lca_rank == 'superkingdom':
-                    next_rank = 'phylum'
-                elif lca_rank == 'phylum':
-                    next_rank = 'class'
-
-            print('---\nassigned at {} -- {}'.format(lca_rank, query_filename))
-            blame_lineages = []
-            track_lineages = [query_filename]
-            for (lineage, count) in lineage_counts.items():
-                this_rank = 'root'
-                if lineage:
-                    this_rank = lineage[-1].rank
-
-                if lca_rank in ('root', 'superkingdom', 'phylum') and \
-                   next_rank == this_rank:
-                    print(lca_utils.display_lineage(lineage), count)
-                    blame_lineages.append(lineage)
-                    track_lineages.append((lineage, count))
+    with profile.hot_loop():
+        for n, query_filename in enumerate(inp_files):
+            if n and n % 100 == 0:
+                print('...', n)
+
+            hashvals = np.zeros(0, dtype=np.uint64)
+            n += 1
+            query_sigs = load_signatures(query_filename, ksize=ksize)
+            for query_sig in profile.timed_iter('load_signature', query_sigs):
+                total_count += 1
+                profile.count('signatures')
+
+                # hashes accumulate across the signatures in a file.
+                sig_hashvals = minhash_hashvals(query_sig.minhash, scaled)
+                hashvals = np.concatenate([hashvals,
+                                           remove_hashvals(sig_hashvals,
+                                                           hashvals)])
+
+                # get the full counted list of lineage counts in this signature
+                with profile.stage('summarize'):
+                    lineage_counts = summarize_fn(hashvals, dblist, args.threshold)
+
+                if not lineage_counts:
+                    metrics.classified('MISSED')
+                    metrics.signature_done()
                     continue
 
-            if blame_lineages:
-                blame_lineages.sort()
-                blame_lineages = tuple(blame_lineages)
+                # also, separately, classify the signature, to get the lca:
+                with profile.stage('classify'):
+                    lineage, status = classify_fn(query_sig, dblist, args.threshold)
+
+                # figure out the rank-after-classify => that's where it's confusing
+                lca_rank, blamed = blame_lineages(lineage_counts, lineage)
+
+                metrics.classified('MISSED' if status == 'nomatch' else lca_rank)
+                metrics.signature_done()
+
+                print('---\nassigned at {} -- {}'.format(lca_rank, query_filename))
+                track_lineages = [query_filename]
+                for (lineage, count) in blamed:
+                    print(lca_utils.display_lineage(lineage), count)
+                    track_lineages.append((lineage, count))
 
-                combo_counts[blame_lineages].append(track_lineages)
+                if blamed:
+                    blamed_lineages = tuple(sorted([ lineage for lineage, count
+                                                     in blamed ]))
+                    combo_counts[blamed_lineages].append(track_lineages)
                 
 
 
-    with open(args.output, 'wb') as fp:
-        dump(combo_counts, fp)
+    with profile.stage('write_output'):
+        with open(args.output, 'wb') as fp:
+            dump(combo_counts, fp)
+
+    if cache:
+        cache.report()
+        cache.close()
+
+    profile.save()
 
     sys.exit(0)
     
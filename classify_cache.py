@@ -0,0 +1,193 @@
+"""
+A local SQLite cache of classification results, shared by the bulk scripts.
+
+Results are keyed by signature md5sum, a fingerprint of the LCA databases
+used, the database scaled value, the threshold, and the kind of result
+('classify' for `classify_signature`, other strings for script-specific
+summaries). The cache holds at most 'max_size' entries and evicts the
+least recently used ones beyond that.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+from sourmash.logging import notify
+from sourmash.lca import lca_utils
+from sourmash.lca.command_classify import classify_signature
+
+DEFAULT_MAX_SIZE = 10000000
+
+# commit (and evict) after this many insertions.
+COMMIT_EVERY = 1000
+
+
+def file_fingerprint(filename):
+    "Fingerprint a file by name, size and modification time."
+    st = os.stat(filename)
+    return '{} {} {}'.format(os.path.basename(filename), st.st_size,
+                             int(st.st_mtime))
+
+
+def database_fingerprint(dblist):
+    "Fingerprint a list of LCA databases by their files and ksize."
+    m = hashlib.md5()
+    for lca_db in sorted(dblist, key=lambda db: db.filename):
+        m.update(file_fingerprint(lca_db.filename).encode('utf-8'))
+        m.update(' k={}\n'.format(lca_db.ksize).encode('utf-8'))
+    return m.hexdigest()
+
+
+def lineage_to_json(lineage):
+    "Convert a tuple of LineagePairs into a JSON string."
+    return json.dumps([ list(pair) for pair in lineage ])
+
+
+def json_to_lineage(s):
+    "Convert a JSON string from lineage_to_json back into LineagePairs."
+    return tuple([ lca_utils.LineagePair(*pair) for pair in json.loads(s) ])
+
+
+def lineage_counts_to_json(lineage_counts):
+    "Convert a dictionary of {lineage: count} into a JSON string."
+    return json.dumps([ ([ list(pair) for pair in lineage ], count)
+                        for lineage, count in lineage_counts.items() ])
+
+
+def json_to_lineage_counts(s):
+    "Convert a JSON string from lineage_counts_to_json back into a dict."
+    d = {}
+    for lineage, count in json.loads(s):
+        lineage = tuple([ lca_utils.LineagePair(*pair) for pair in lineage ])
+        d[lineage] = count
+    return d
+
+
+class ClassifyCache(object):
+    """
+    SQLite-backed LRU cache of classification results.
+    """
+    def __init__(self, filename, max_size=DEFAULT_MAX_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._n_puts = 0
+        self._fingerprints = {}
+
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                md5 TEXT NOT NULL,
+                db_fingerprint TEXT NOT NULL,
+                scaled INTEGER NOT NULL,
+                threshold INTEGER NOT NULL,
+                method TEXT NOT NULL,
+                rank TEXT,
+                lineage TEXT,
+                status TEXT,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (md5, db_fingerprint, scaled, threshold, method)
+            )''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS results_last_used
+                             ON results (last_used)''')
+        self.conn.commit()
+
+    def _key(self, md5, dblist, threshold, method):
+        dbkey = tuple([ id(lca_db) for lca_db in dblist ])
+        fingerprint = self._fingerprints.get(dbkey)
+        if fingerprint is None:
+            fingerprint = database_fingerprint(dblist)
+            self._fingerprints[dbkey] = fingerprint
+
+        scaled = max([ lca_db.scaled for lca_db in dblist ])
+        return (md5, fingerprint, scaled, threshold, method)
+
+    def get(self, md5, dblist, threshold, method='classify'):
+        """
+        Look up a cached result; return (rank, lineage, status) or None.
+
+        'lineage' is returned as stored, i.e. as a string.
+        """
+        key = self._key(md5, dblist, threshold, method)
+        c = self.conn.execute('''SELECT rank, lineage, status FROM results
+                                 WHERE md5=? AND db_fingerprint=? AND scaled=?
+                                 AND threshold=? AND method=?''', key)
+        row = c.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.conn.execute('''UPDATE results SET last_used=?
+                             WHERE md5=? AND db_fingerprint=? AND scaled=?
+                             AND threshold=? AND method=?''',
+                          (time.time(),) + key)
+        return row
+
+    def put(self, md5, dblist, threshold, rank, lineage, status,
+            method='classify'):
+        "Store a result; 'lineage' must be a string."
+        key = self._key(md5, dblist, threshold, method)
+        self.conn.execute('''INSERT OR REPLACE INTO results
+                             (md5, db_fingerprint, scaled, threshold, method,
+                              rank, lineage, status, last_used)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                          key + (rank, lineage, status, time.time()))
+
+        self._n_puts += 1
+        if self._n_puts % COMMIT_EVERY == 0:
+            self.commit()
+
+    def classify_signature(self, sig, dblist, threshold):
+        """
+        Cached version of `classify_signature`; return (lineage, status).
+        """
+        md5 = sig.md5sum()
+        row = self.get(md5, dblist, threshold)
+        if row is not None:
+            rank, lineage, status = row
+            return json_to_lineage(lineage), status
+
+        lineage, status = classify_signature(sig, dblist, threshold)
+
+        rank = 'root'
+        if lineage:
+            rank = lineage[-1].rank
+        self.put(md5, dblist, threshold, rank, lineage_to_json(lineage),
+                 status)
+
+        return lineage, status
+
+    def evict(self):
+        "Remove least recently used entries beyond 'max_size'."
+        if not self.max_size:
+            return 0
+
+        (n,) = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()
+        n_remove = n - self.max_size
+        if n_remove <= 0:
+            return 0
+
+        self.conn.execute('''DELETE FROM results WHERE rowid IN
+                             (SELECT rowid FROM results
+                              ORDER BY last_used LIMIT ?)''', (n_remove,))
+        return n_remove
+
+    def commit(self):
+        self.evict()
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def report(self):
+        "Print the hit rate for this run."
+        total = self.hits + self.misses
+        rate = 0.
+        if total:
+            rate = self.hits / total * 100
+        notify('classification cache {}: {} hits of {} lookups ({:.1f}%)',
+               self.filename, self.hits, total, rate)
@@ -10,19 +10,50 @@ import sourmash
 from sourmash.lca import lca_utils
 from sourmash.lca.command_index import load_taxonomy_assignments
 
+from results_db import ResultsDB
+
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('gtdb_lineages')
-    p.add_argument('bulk_lineages')
+    p.add_argument('bulk_lineages', nargs='?')
+    p.add_argument('--results-db',
+                   help='look up bulk lineages in this ingest-bulk-classify.py database')
+    p.add_argument('--source', action='append',
+                   help='with --results-db, only use this source (may be repeated; default: all sources)')
     p.add_argument('-v', '--verbose', action='store_true')
     args = p.parse_args()
 
+    if not args.bulk_lineages and not args.results_db:
+        print('must supply bulk_lineages or --results-db', file=sys.stderr)
+        sys.exit(-1)
+    if args.source and not args.results_db:
+        print('--source needs --results-db', file=sys.stderr)
+        sys.exit(-1)
+
     gtdb_lineages, _ = load_taxonomy_assignments(args.gtdb_lineages, start_column=3)
-    bulk_lineages, _ = load_taxonomy_assignments(args.bulk_lineages)
+    if args.results_db:
+        # only look up the GTDB genomes, by index.
+        results_db = ResultsDB(args.results_db)
+        unknown = set(args.source or []) - set(results_db.sources())
+        if unknown:
+            print('no source(s) {} in {}'.format(', '.join(sorted(unknown)),
+                                                 args.results_db), file=sys.stderr)
+            sys.exit(-1)
+
+        try:
+            bulk_lineages = results_db.lineages_for_names(gtdb_lineages.keys(),
+                                                          args.source)
+        except ValueError as e:
+            print('{}; select one with --source'.format(e), file=sys.stderr)
+            sys.exit(-1)
+        n_bulk = results_db.count_names(args.source)
+    else:
+        bulk_lineages, _ = load_taxonomy_assignments(args.bulk_lineages)
+        n_bulk = len(bulk_lineages)
 
     print('gtdb only:', len(set(gtdb_lineages.keys()) - set(bulk_lineages.keys())))
-    print('bulk only:', len(set(bulk_lineages.keys()) - set(gtdb_lineages.keys())))
+    print('bulk only:', n_bulk - len(set(bulk_lineages.keys()).intersection(gtdb_lineages.keys())))
     print('common:', len(set(gtdb_lineages.keys()).intersection(bulk_lineages.keys())))
 
     common = set(gtdb_lineages.keys()).intersection(bulk_lineages.keys())
@@ -8,6 +8,9 @@ import pprint
 import sourmash
 from sourmash.lca import lca_utils
 
+from gtdbtk_compare import (genome_key, load_gtdbtk_rows, gtdbtk_lineage,
+                            classify_lineage, compare_lineages)
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -23,27 +26,14 @@ def main():
             lca_d[row['ID']] = row
     print('loaded {} rows from sourmash lca classify in {}'.format(len(lca_d), args.lca_classify_out))
 
-    tk_d = {}
-    bac_summary = os.path.join(args.gtdbtk_dir, 'gtdbtk.bac120.summary.tsv')
-    with open(bac_summary, 'rt') as fp:
-        r = csv.DictReader(fp, delimiter='\t')
-        for row in r:
-            tk_d[row['user_genome']] = row
-    ar_summary = os.path.join(args.gtdbtk_dir, 'gtdbtk.ar122.summary.tsv')
-    with open(ar_summary, 'rt') as fp:
-        r = csv.DictReader(fp, delimiter='\t')
-        for row in r:
-            tk_d[row['user_genome']] = row
+    tk_d = load_gtdbtk_rows(args.gtdbtk_dir)
 
     print('loaded {} rows from gtdbtk classify_wf in dir {}'.format(len(tk_d), args.gtdbtk_dir))
 
     # make keys match
     lca_d_2 = {}
     for k, v in lca_d.items():
-        k = os.path.basename(k)
-        if k.endswith('.gz'):
-            k = k[:-3]
-        lca_d_2[k] = v
+        lca_d_2[genome_key(k)] = v
     lca_d = lca_d_2
 
     lca_keys = set(lca_d.keys())
@@ -72,28 +62,11 @@ def main():
     lca_lineages = {}
     for k, row in lca_d.items():
         if row['status'] != 'nomatch':
-            lineage = []
-            for rank in lca_utils.taxlist(include_strain=False):
-                name = row[rank]
-                lineage.append(lca_utils.LineagePair(rank=rank, name=name))
-            lineage = tuple(lineage)
-            lca_lineages[k] = lineage
+            lca_lineages[k] = classify_lineage(row)
 
     tk_lineages = {}
     for k, row in tk_d.items():
-        classify = row['classification']
-        classify = classify.split(';')
-
-        idx = len(classify) - 1
-        while classify[idx].endswith('__'):
-            assert len(classify[idx]) == 3
-            idx -= 1
-        classify = classify[:idx + 1]
-        lineage = []
-        for rank, name in zip(lca_utils.taxlist(include_strain=False), classify):
-            lineage.append(lca_utils.LineagePair(rank=rank, name=name))
-
-        tk_lineages[k] = lineage
+        tk_lineages[k] = gtdbtk_lineage(row['classification'])
 
     both_lin = set(tk_lineages).union(set(lca_lineages))
     n_match1 = 0
@@ -114,23 +87,17 @@ def main():
 
         total += 1
 
-        tree = lca_utils.build_tree((tk_lin, lca_lin))
-        tree_lca, reason = lca_utils.find_lca(tree)
-
-        lca_lin2 = list(lca_lin)
-        while lca_lin2 and not lca_lin2[-1].name:
-            lca_lin2.pop()
+        match1, match2 = compare_lineages(tk_lin, lca_lin)
 
         display = False
-        tree_lca = list(tree_lca)
-        if tree_lca[:len(lca_lin2)] == lca_lin2:
+        if match1:
             n_match1 += 1
         else:
             if args.verbose:
                 print('** mismatch at sourmash lca classification level', k)
             display = True
 
-        if tree_lca == list(lca_lin):
+        if match2:
             n_match2 += 1
         else:
             display = True
@@ -0,0 +1,161 @@
+"""
+Compressed CSV output written on a background thread, and readers that
+accept compressed CSVs transparently.
+
+    add_compress_args(p)
+    ...
+    w = CSVWriter(compressed_name('{}-bulk-classify.csv'.format(prefix),
+                                  args.compress))
+    w.writerow(header)
+    for ...:
+        w.writerow(row)
+    w.close()
+
+    with open_text(find_csv('{}-bulk-classify.csv'.format(prefix))) as fp:
+        r = csv.DictReader(fp)
+
+The compression is chosen by file suffix: '.gz' for gzip, '.zst' for
+zstd (which needs the zstandard package). The hot loop only appends rows
+to a list; formatting, compression and writing happen on the writer's
+thread, a batch of rows at a time, and the file is flushed once per
+batch.
+"""
+import io
+import os
+import csv
+import gzip
+import queue
+import threading
+
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# hand rows to the writer thread, and flush the file, this many at a time.
+BATCH_ROWS = 1000
+
+# batches waiting for the writer thread before writerow blocks.
+QUEUE_BATCHES = 64
+
+# as in subset-lca-db.py; level 9 is much slower for little gain.
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def add_compress_args(p):
+    p.add_argument('--compress', choices=sorted(COMPRESSIONS),
+                   help='compress output CSVs, adding .gz or .zst to their names')
+
+
+def compressed_name(filename, compress=None):
+    "The output filename for 'filename' compressed with 'compress'."
+    if compress:
+        return filename + COMPRESSIONS[compress]
+    return filename
+
+
+def find_csv(filename):
+    """
+    Return 'filename', or its compressed form if only that exists; for
+    finding {prefix}-*.csv files written with or without --compress.
+    """
+    for suffix in [''] + sorted(COMPRESSIONS.values()):
+        if os.path.exists(filename + suffix):
+            return filename + suffix
+    return filename
+
+
+def strip_compression(filename):
+    "'filename' without a .gz or .zst suffix."
+    for suffix in COMPRESSIONS.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def open_text(filename, mode='rt'):
+    "Open a possibly compressed text file for reading ('rt') or writing ('wt')."
+    if filename.endswith(COMPRESSIONS['gzip']):
+        if mode == 'wt':
+            return gzip.open(filename, mode, compresslevel=GZIP_LEVEL)
+        return gzip.open(filename, mode)
+
+    if filename.endswith(COMPRESSIONS['zstd']):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("the zstandard package is needed for '{}'".format(filename))
+
+        if mode == 'wt':
+            fp = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(filename, 'wb'))
+        else:
+            fp = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+        return io.TextIOWrapper(fp)
+
+    return open(filename, mode)
+
+
+class CSVWriter(object):
+    """
+    A csv.writer whose rows are formatted, compressed and written by a
+    background thread. close() must be called to finish the file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open_text(filename, 'wt')
+        self.rows = []
+        self.queue = queue.Queue(QUEUE_BATCHES)
+        self.exception = None
+
+        self.thread = threading.Thread(target=self._write_batches,
+                                       daemon=True)
+        self.thread.start()
+
+    def _write_batches(self):
+        while True:
+            rows = self.queue.get()
+            if rows is None:
+                break
+            if self.exception:
+                continue                  # keep draining so writers don't block
+
+            try:
+                buf = io.StringIO()
+                csv.writer(buf).writerows(rows)
+                self.fp.write(buf.getvalue())
+                self.fp.flush()
+            except Exception as e:
+                self.exception = e
+
+    def _send(self):
+        if self.exception:
+            raise self.exception
+        if self.rows:
+            self.queue.put(self.rows)
+            self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= BATCH_ROWS:
+            self._send()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        if self.fp is None:
+            return
+        try:
+            self._send()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.fp.close()
+            self.fp = None
+        if self.exception:
+            raise self.exception
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,56 +1,161 @@
 #! /usr/bin/env python
 """
 Look for compositional + taxonomic oddities in an LCA database.
+
+With --shards and -p, the hash space is split into ranges that are
+processed by a pool of worker processes: the parent converts the
+databases into sorted arrays of hashvals and their lineage rows, drops
+the per-hash dictionaries, and forks; each worker only touches its own
+slice of the (shared, copy-on-write) arrays.
 """
 import sourmash
 import sys
 from collections import defaultdict
 import pprint
 import argparse
+import multiprocessing
+
+import numpy as np
 
 from sourmash.logging import error, debug, set_quiet, notify
 from sourmash.lca import lca_utils
 from sourmash.sourmash_args import SourmashArgumentParser
 
+from instrument import Profile, add_profile_args
+from lca_stream import load_databases, LINEAGE_SECTIONS
+from lca_vector import LineageCodes
+
+RANKS = ['root'] + list(lca_utils.taxlist())
+
+# set by make_hash_table() before the worker processes are forked.
+_table = None
 
-def make_lca_counts(dblist):
+
+def make_lca_counts(dblist, profile=None):
     """
     Collect counts of all the LCAs in the list of databases.
     """
+    if profile is None:
+        profile = Profile()
 
     # gather all hashvalue assignments from across all the databases
     assignments = defaultdict(set)
-    for lca_db in dblist:
-        for hashval, idx_list in lca_db.hashval_to_idx.items():
-            for idx in idx_list:
-                lid = lca_db.idx_to_lid.get(idx)
-                if lid is not None:
-                    lineage = lca_db.lid_to_lineage[lid]
-                    assignments[hashval].add(lineage)
+    with profile.stage('gather_assignments'):
+        for lca_db in dblist:
+            for hashval, idx_list in lca_db.hashval_to_idx.items():
+                for idx in idx_list:
+                    lid = lca_db.idx_to_lid.get(idx)
+                    if lid is not None:
+                        lineage = lca_db.lid_to_lineage[lid]
+                        assignments[hashval].add(lineage)
+    profile.count('hashes', len(assignments))
 
     # now convert to trees -> do LCA for each hashval
     counts = defaultdict(int)
     crossdict = defaultdict(set)
-    for hashval, lineages in assignments.items():
+    with profile.stage('lca'):
+        for hashval, lineages in assignments.items():
 
-        # for each list of tuple_info [(rank, name), ...] build
-        # a tree that lets us discover lowest-common-ancestor.
-        debug('lineages: {}', lineages)
-        tree = lca_utils.build_tree(lineages)
+            # for each list of tuple_info [(rank, name), ...] build
+            # a tree that lets us discover lowest-common-ancestor.
+            debug('lineages: {}', lineages)
+            tree = lca_utils.build_tree(lineages)
 
-        # now find either a leaf or the first node with multiple
-        # children; that's our lowest-common-ancestor node.
-        lca, reason = lca_utils.find_lca(tree)
+            # now find either a leaf or the first node with multiple
+            # children; that's our lowest-common-ancestor node.
+            lca, reason = lca_utils.find_lca(tree)
 
-        if lca:
-            rank = lca[-1].rank
-            crossdict[rank].add(hashval)
-        else:
-            crossdict['root'].add(hashval)
+            if lca:
+                rank = lca[-1].rank
+                crossdict[rank].add(hashval)
+            else:
+                crossdict['root'].add(hashval)
 
     return crossdict
 
 
+def make_hash_table(dblist):
+    """
+    Build the table used by count_shard: LineageCodes for 'dblist', the
+    sorted hashvals that have lineages, their lineage rows as CSR arrays,
+    and the rank of each LCA code.
+    """
+    global _table
+
+    lineage_codes = LineageCodes(dblist)
+
+    # the same arrays as gather() over all the sorted hashvals, built
+    # without Python sets or lists of every hash.
+    lineage_codes.hash_index = lineage_codes._make_hash_index()
+    hashvals, indptr, rows = lineage_codes.hash_index
+
+    code_ranks = np.array([ RANKS.index(lineage[-1].rank) if lineage else 0
+                            for lineage in lineage_codes.lineages ],
+                          dtype=np.int32)
+
+    _table = (lineage_codes, hashvals, indptr, rows, code_ranks)
+    return len(hashvals)
+
+
+def count_shard(shard):
+    """
+    Find the LCA rank of each hash in the range 'shard' = (start, end) of
+    the table; return (counts per rank, {rank: hashvals} for 'keep_ranks').
+    """
+    start, end, keep_ranks = shard
+    lineage_codes, hashvals, indptr, rows, code_ranks = _table
+
+    lca = lineage_codes.lca_ids(indptr[start:end + 1] - indptr[start],
+                                rows[indptr[start]:indptr[end]])
+    ranks = code_ranks[lca]
+
+    rank_counts = np.bincount(ranks, minlength=len(RANKS))
+    kept = {}
+    for rank in keep_ranks:
+        kept[rank] = hashvals[start:end][ranks == RANKS.index(rank)]
+
+    return rank_counts, kept
+
+
+def make_lca_counts_sharded(dblist, keep_ranks, n_shards, processes,
+                            profile):
+    """
+    Count LCA ranks across 'n_shards' hash ranges with a process pool.
+    Return ({rank: count}, {rank: sorted hashvals} for 'keep_ranks').
+    """
+    with profile.stage('hash_table'):
+        n_hashes = make_hash_table(dblist)
+
+        # the table has everything the workers need; free the dicts.
+        for lca_db in dblist:
+            lca_db.hashval_to_idx = {}
+    profile.count('hashes', n_hashes)
+
+    bounds = np.linspace(0, n_hashes, n_shards + 1).astype(int)
+    shards = [ (bounds[i], bounds[i + 1], keep_ranks)
+               for i in range(n_shards) if bounds[i] < bounds[i + 1] ]
+    notify('processing {} hashes in {} shards with {} processes',
+           n_hashes, len(shards), processes)
+
+    rank_counts = np.zeros(len(RANKS), dtype=np.int64)
+    kept = defaultdict(list)
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    for shard_counts, shard_kept in profile.timed_iter('lca',
+                                                        pool.imap(count_shard, shards)):
+        rank_counts += shard_counts
+        for rank, shard_hashvals in shard_kept.items():
+            kept[rank].append(shard_hashvals)
+    pool.close()
+    pool.join()
+
+    counts = dict([ (rank, int(count)) for rank, count in zip(RANKS, rank_counts)
+                    if count ])
+    for rank in keep_ranks:
+        kept[rank] = np.concatenate(kept[rank] or [np.zeros(0, dtype=np.uint64)])
+
+    return counts, kept
+
+
 def main(args):
     p = argparse.ArgumentParser(prog="sourmash lca rankinfo")
     p.add_argument('db', nargs='+')
@@ -61,6 +166,11 @@ def main(args):
                    help='output debugging output')
     p.add_argument('-o', '--output', type=str, help='output filename')
     p.add_argument('--lowest-rank', default='phylum')
+    p.add_argument('--shards', type=int, default=0,
+                   help='split the hash space into this many ranges, processed in parallel')
+    p.add_argument('-p', '--processes', type=int, default=1,
+                   help='number of worker processes for --shards')
+    add_profile_args(p)
     args = p.parse_args(args)
 
     if not args.db:
@@ -68,6 +178,7 @@ def main(args):
         sys.exit(-1)
 
     set_quiet(args.quiet, args.debug)
+    profile = Profile.from_args(args)
 
     if args.scaled:
         args.scaled = int(args.scaled)
@@ -85,31 +196,40 @@ def main(args):
     print('outputting hashvals at following ranks:', keep_ranks)
 
     # load all the databases
-    dblist, ksize, scaled = lca_utils.load_databases(args.db, args.scaled)
-    assert len(dblist) == 1
+    with profile.stage('load_databases'):
+        dblist, ksize, scaled = load_databases(args.db, args.scaled,
+                                               sections=LINEAGE_SECTIONS)
 
     # count all the LCAs across these databases
-    crossdict = make_lca_counts(dblist)
+    with profile.hot_loop():
+        if args.shards:
+            counts, crossdict = make_lca_counts_sharded(dblist, keep_ranks,
+                                                        args.shards,
+                                                        args.processes,
+                                                        profile)
+        else:
+            crossdict = make_lca_counts(dblist, profile)
+            counts = dict([ (rank, len(v)) for rank, v in crossdict.items() ])
 
     # output basic stats
-    for rank, v in crossdict.items():
-        print(rank, len(v))
+    for rank, count in counts.items():
+        print(rank, count)
 
     n = 0
-    all_hashvals = set()
     if args.output:
-        with open(args.output, 'wt') as fp:
+        with profile.stage('write_output'), open(args.output, 'wt') as fp:
             for rank in keep_ranks:
                 for hashval in crossdict[rank]:
                     fp.write("{}\n".format(hashval))
                     n += 1
-                all_hashvals.update(crossdict[rank])
     else:
         assert 0
 
-    total = sum([ len(v) for v in crossdict.values() ])
+    total = sum(counts.values())
     print('wrote {} confused hashvals, of {} total'.format(n, total))
 
+    profile.save()
+
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
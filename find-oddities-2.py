@@ -2,33 +2,127 @@
 """
 Look for compositional oddities that do not match ANI in an LCA.
 (Ignore taxonomy except for reporting.)
+
+Groups of genomes are counted by the hashes they share; on a large
+database there are a great many such groups, so --max-memory counts them
+approximately in a fixed-size count-min sketch first, and then exactly
+only for the groups that may reach --min-count.
 """
 import sourmash
 import sys
 from collections import defaultdict
 
+import numpy as np
+
 from sourmash.logging import error, debug, set_quiet, notify
 from sourmash.lca import lca_utils
 from sourmash.sourmash_args import SourmashArgumentParser
 
+from lca_stream import load_databases
 
-def make_assignment_counts(lca_db, min_num=0):
-    """
-    Collect counts of all the lineages in the database
+# rows in the count-min sketch used by --max-memory.
+SKETCH_DEPTH = 4
+
+# hash this many groups at a time into the sketch.
+SKETCH_BATCH = 100000
 
-    CTB this could usefully be converted to a generator function.
-    """
 
-    # gather all hashvalue assignments from across all the databases
-    assignments = defaultdict(set)
+def iter_idx_groups(lca_db, min_num=0):
+    """
+    Yield the sorted tuple of idx for every hash in more than one genome.
+    """
     for hashval, idx_list in lca_db.hashval_to_idx.items():
         if min_num and len(idx_list) < min_num:
             continue
 
-        for idx in idx_list:
-            assignments[hashval].add(idx)
+        idx_group = tuple(sorted(set(idx_list)))
+        if len(idx_group) >= 2:
+            yield idx_group
+
+
+def count_groups_exact(groups, min_count):
+    "Count every group in a dictionary; keep those seen 'min_count' times."
+    idx_groups = defaultdict(int)
+    for idx_group in groups:
+        idx_groups[idx_group] += 1
 
-    return assignments
+    return dict([ (g, n) for (g, n) in idx_groups.items() if n >= min_count ])
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of hashable items in a fixed SKETCH_DEPTH x width
+    table of counters; estimates never fall below the true count.
+    """
+    def __init__(self, width):
+        self.width = width
+        self.table = np.zeros((SKETCH_DEPTH, width), dtype=np.uint32)
+        self.seeds = np.arange(1, SKETCH_DEPTH + 1, dtype=np.uint64) * \
+          np.uint64(0x9E3779B97F4A7C15)
+
+    def _columns(self, items):
+        "Return the SKETCH_DEPTH x len(items) columns for 'items'."
+        h = np.array([ hash(item) & 0xFFFFFFFFFFFFFFFF for item in items ],
+                     dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            # splitmix64 finalizer, once per row seed.
+            x = h[None, :] ^ self.seeds[:, None]
+            x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            x = x ^ (x >> np.uint64(31))
+        return (x % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, items):
+        columns = self._columns(items)
+        for row in range(SKETCH_DEPTH):
+            np.add.at(self.table[row], columns[row], 1)
+
+    def estimate(self, items):
+        columns = self._columns(items)
+        return np.min([ self.table[row, columns[row]]
+                        for row in range(SKETCH_DEPTH) ], axis=0)
+
+
+def _batches(groups):
+    batch = []
+    for idx_group in groups:
+        batch.append(idx_group)
+        if len(batch) >= SKETCH_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def count_groups_bounded(make_groups, min_count, max_memory):
+    """
+    Count groups in about 'max_memory' bytes: a first pass over
+    make_groups() fills a count-min sketch, and a second pass counts
+    exactly only the groups whose estimate reaches 'min_count'. Since
+    estimates never undercount, the result is the same as
+    count_groups_exact.
+    """
+    width = max(1, int(max_memory // (SKETCH_DEPTH * 4)))
+    sketch = CountMinSketch(width)
+    notify('counting groups in a {} x {} count-min sketch', SKETCH_DEPTH,
+           width)
+
+    n = 0
+    for batch in _batches(make_groups()):
+        sketch.add(batch)
+        n += len(batch)
+
+    candidates = defaultdict(int)
+    for batch in _batches(make_groups()):
+        estimates = sketch.estimate(batch)
+        for idx_group, est in zip(batch, estimates):
+            if est >= min_count:
+                candidates[idx_group] += 1
+
+    notify('{} of {} hashes are in candidate groups; {} candidate groups',
+           sum(candidates.values()), n, len(candidates))
+
+    return dict([ (g, c) for (g, c) in candidates.items() if c >= min_count ])
 
 
 def main(args):
@@ -43,6 +137,10 @@ def main(args):
                    help='output debugging output')
     p.add_argument('--minimum-num', type=int, default=0,
                    help='Minimum number of different lineages a k-mer must be in to be counted')
+    p.add_argument('--min-count', type=int, default=5,
+                   help='Minimum number of k-mers a group of genomes must share (default: %(default)s)')
+    p.add_argument('--max-memory', type=float,
+                   help='count groups approximately in this many MB first, and exactly only above --min-count')
     args = p.parse_args(args)
 
     if not args.db:
@@ -55,25 +153,23 @@ def main(args):
         args.scaled = int(args.scaled)
 
     # load all the databases
-    dblist, ksize, scaled = lca_utils.load_databases(args.db, args.scaled)
+    # needs every section: _signatures, idx_to_ident and lineages.
+    dblist, ksize, scaled = load_databases(args.db, args.scaled)
     assert len(dblist) == 1
     lca_db = dblist[0]
 
-    # count all the LCAs across these databases
-    counts = make_assignment_counts(lca_db, args.minimum_num)
-
-    idx_groups = defaultdict(int)
-    for hashval, idx_list in counts.items():
-        if len(idx_list) >= 2:
-            idx_list = list(idx_list)
-            idx_list.sort()
-            idx_list = tuple(idx_list)
-            idx_groups[idx_list] += 1
+    # count the groups of genomes sharing each hash
+    make_groups = lambda: iter_idx_groups(lca_db, args.minimum_num)
+    if args.max_memory:
+        idx_groups = count_groups_bounded(make_groups, args.min_count,
+                                          args.max_memory * 1024 * 1024)
+    else:
+        idx_groups = count_groups_exact(make_groups(), args.min_count)
 
     n = 0
     sigd = lca_db._signatures
     for idx_group, count in idx_groups.items():
-        if count >= 5:
+        if count >= args.min_count:
             keep = False
             for idx in idx_group:
                 mh1 = sigd[idx]
@@ -15,7 +15,8 @@ cd /home/ctbrown/2019-sourmash-gtdb/gtdbtk
 
 conda activate sgc
 
-snakemake --use-conda -j 8
+# GTDB-Tk batches declare mem_mb; keep them within this allocation.
+snakemake --use-conda -j 8 --resources mem_mb=200000
 
 set -o nounset
 set -o errexit
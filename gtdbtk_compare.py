@@ -0,0 +1,86 @@
+"""
+Load GTDB-Tk classify_wf summaries and score sourmash lineages against
+them; shared by compare-lca-gtdbtk.py and sweep-lca-gtdbtk.py.
+"""
+import os
+import csv
+
+from sourmash.lca import lca_utils
+
+RANKS = list(lca_utils.taxlist(include_strain=False))
+
+SUMMARIES = ('gtdbtk.bac120.summary.tsv', 'gtdbtk.ar122.summary.tsv')
+
+
+def genome_key(name):
+    "The GTDB-Tk user_genome for a sourmash signature name or filename."
+    k = os.path.basename(name)
+    if k.endswith('.gz'):
+        k = k[:-3]
+    return k
+
+
+def load_gtdbtk_rows(gtdbtk_dir):
+    "Load the bac120 and ar122 summary rows, keyed by user_genome."
+    tk_d = {}
+    for summary in SUMMARIES:
+        with open(os.path.join(gtdbtk_dir, summary), 'rt') as fp:
+            r = csv.DictReader(fp, delimiter='\t')
+            for row in r:
+                tk_d[row['user_genome']] = row
+    return tk_d
+
+
+def gtdbtk_lineage(classification):
+    "Convert a GTDB-Tk classification string into a list of LineagePairs."
+    classify = classification.split(';')
+
+    idx = len(classify) - 1
+    while classify[idx].endswith('__'):
+        assert len(classify[idx]) == 3
+        idx -= 1
+    classify = classify[:idx + 1]
+
+    lineage = []
+    for rank, name in zip(RANKS, classify):
+        lineage.append(lca_utils.LineagePair(rank=rank, name=name))
+    return lineage
+
+
+def classify_lineage(names):
+    """
+    Build a lineage from per-rank names, e.g. a `sourmash lca classify`
+    CSV row; unassigned ranks are kept, with empty names.
+    """
+    return tuple([ lca_utils.LineagePair(rank=rank, name=names.get(rank, ''))
+                   for rank in RANKS ])
+
+
+def compare_lineages(tk_lin, lca_lin):
+    """
+    Compare a GTDB-Tk lineage with a sourmash lineage. Return (match at
+    full sourmash lineage, match at full GTDB-Tk lineage), as booleans.
+    """
+    tree = lca_utils.build_tree((tk_lin, lca_lin))
+    tree_lca, reason = lca_utils.find_lca(tree)
+
+    lca_lin2 = list(lca_lin)
+    while lca_lin2 and not lca_lin2[-1].name:
+        lca_lin2.pop()
+
+    tree_lca = list(tree_lca)
+    return tree_lca[:len(lca_lin2)] == lca_lin2, tree_lca == list(lca_lin)
+
+
+def rank_matches(tk_lin, lca_lin):
+    """
+    Return, for each rank, whether sourmash assigned a name at that rank
+    that agrees with GTDB-Tk all the way down to it.
+    """
+    matches = []
+    for i in range(len(RANKS)):
+        match = (i < len(tk_lin) and i < len(lca_lin) and
+                 lca_lin[i].name and
+                 list(lca_lin[:i + 1]) == list(tk_lin[:i + 1]))
+        matches.append(bool(match))
+    return matches
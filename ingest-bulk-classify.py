@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+"""
+Load {prefix}-bulk-classify.csv files into an indexed SQLite database;
+see results_db.py.
+
+CSVs already ingested and unchanged since are skipped (unless --force);
+changed ones are reloaded. Duplicate md5sums within a CSV are skipped,
+and md5sums or names that occur in several CSVs are reported.
+"""
+import sys
+import argparse
+
+from sourmash.logging import error, notify, set_quiet
+
+from results_db import ResultsDB
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('results_db', help='SQLite database (created if needed)')
+    p.add_argument('bulk_classify_csvs', nargs='+')
+    p.add_argument('--rank-column', default='rank',
+                   help="e.g. 'rank_k31' for --multi-ksize output")
+    p.add_argument('--lineage-column', default='lineage',
+                   help="e.g. 'lineage_k31' for --multi-ksize output")
+    p.add_argument('-f', '--force', action='store_true',
+                   help='reload CSVs even if they are unchanged')
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet)
+
+    db = ResultsDB(args.results_db, create=True)
+
+    for csvname in args.bulk_classify_csvs:
+        if not args.force and db.is_current(csvname):
+            notify('{} is unchanged; skipping', csvname)
+            continue
+
+        try:
+            n_rows, n_duplicates = db.ingest(csvname, args.rank_column,
+                                             args.lineage_column)
+        except KeyError as e:
+            error('Error! no column {} in {}', str(e), csvname)
+            sys.exit(-1)
+
+        notify('loaded {} rows from {}', n_rows, csvname)
+        if n_duplicates:
+            notify('*** WARNING *** skipped {} duplicate md5sums in {}',
+                   n_duplicates, csvname)
+
+    n_md5, n_name = db.duplicates()
+    if n_md5:
+        notify('*** WARNING *** {} md5sums occur in more than one CSV', n_md5)
+    if n_name:
+        notify('*** WARNING *** {} names occur with more than one md5sum',
+               n_name)
+
+    notify('{} sources in {}', len(db.sources()), args.results_db)
+    db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,152 @@
+"""
+Per-stage timing, counters and peak memory for the bulk scripts.
+
+    profile = Profile.from_args(args)
+    with profile.stage('load_databases'):
+        ...
+    for sig in profile.timed_iter('load_leaf', sbt.signatures()):
+        profile.count('signatures')
+        ...
+    profile.save()
+
+`add_profile_args` adds --profile (write a JSON profile of the run) and
+--cprofile (dump cProfile stats for the code inside `profile.hot_loop()`).
+"""
+import os
+import sys
+import json
+import time
+import resource
+import cProfile
+from contextlib import contextmanager
+from collections import defaultdict
+
+from sourmash.logging import notify
+
+
+def peak_rss_mb():
+    "Peak resident set size of this process so far, in MB."
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':          # bytes, not kilobytes
+        rss /= 1024.
+    return rss / 1024.
+
+
+def current_rss_mb():
+    "Current resident set size in MB, or None if we can't tell."
+    try:
+        with open('/proc/self/statm', 'rt') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024. / 1024.
+    except (OSError, ValueError):
+        return None
+
+
+def add_profile_args(p):
+    p.add_argument('--profile', metavar='FILE',
+                   help='write a JSON profile of per-stage time and memory')
+    p.add_argument('--cprofile', metavar='FILE',
+                   help='dump cProfile stats for the main loop')
+
+
+class Profile(object):
+    """
+    Collect per-stage wall time, call counts, counters and RSS samples.
+    """
+    def __init__(self, filename=None, cprofile_filename=None):
+        self.filename = filename
+        self.cprofile_filename = cprofile_filename
+        self.start = time.time()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.rss_after = {}
+        self.counters = defaultdict(int)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.profile, args.cprofile)
+
+    @contextmanager
+    def stage(self, name):
+        "Time the enclosed block as (one call of) stage 'name'."
+        # nothing is saved without a profile file, so don't bother timing.
+        if not self.filename:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+        # sampling RSS every call is too slow for per-signature stages.
+        if self.calls[name] == 1 or self.calls[name] % 1000 == 0:
+            self.rss_after[name] = current_rss_mb()
+
+    def timed_iter(self, name, iterable):
+        "Iterate over 'iterable', timing each step as stage 'name'."
+        if not self.filename:
+            yield from iterable
+            return
+
+        it = iter(iterable)
+        while 1:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextmanager
+    def hot_loop(self):
+        "Run the enclosed block under cProfile, if requested."
+        if not self.cprofile_filename:
+            yield
+            return
+
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(self.cprofile_filename)
+            notify('wrote cProfile stats to {}', self.cprofile_filename)
+
+    def as_dict(self):
+        stages = {}
+        for name in self.seconds:
+            stages[name] = dict(seconds=self.seconds[name],
+                                calls=self.calls[name],
+                                rss_mb_after=self.rss_after.get(name))
+
+        return dict(script=os.path.basename(sys.argv[0]),
+                    argv=sys.argv[1:],
+                    start=time.strftime('%Y-%m-%dT%H:%M:%S',
+                                        time.localtime(self.start)),
+                    total_seconds=time.time() - self.start,
+                    peak_rss_mb=peak_rss_mb(),
+                    stages=stages,
+                    counters=dict(self.counters))
+
+    def save(self):
+        "Write the profile to 'filename', if one was given."
+        if not self.filename:
+            return
+
+        d = self.as_dict()
+        with open(self.filename, 'wt') as fp:
+            json.dump(d, fp, indent=2)
+
+        notify('wrote profile to {}: {:.1f}s total, {:.0f} MB peak RSS',
+               self.filename, d['total_seconds'], d['peak_rss_mb'])
+        for name, stage in sorted(d['stages'].items(),
+                                  key=lambda x: -x[1]['seconds']):
+            notify('   {:20s} {:10.2f}s {:10d} calls', name,
+                   stage['seconds'], stage['calls'])
@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+"""
+Load LCA databases once and serve classify/summarize requests on a Unix
+socket; see lca_service.py for the protocol.
+
+Use with the --server option of bulk-classify-sbt-with-lca.py,
+bulk-classify-dig.py and bulk-investigate.py.
+"""
+import os
+import sys
+import argparse
+
+from sourmash.logging import error, notify, set_quiet
+
+from lca_service import LCAServer
+from lca_stream import load_databases, LINEAGE_SECTIONS
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('socket', help='path for the Unix socket')
+    p.add_argument('lca_db', nargs='+')
+    p.add_argument('--scaled', type=float)
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    p.add_argument('-d', '--debug', action='store_true',
+                   help='output debugging output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet, args.debug)
+
+    if args.scaled:
+        args.scaled = int(args.scaled)
+
+    # load all the databases
+    dblist, ksize, scaled = load_databases(args.lca_db, args.scaled,
+                                           sections=LINEAGE_SECTIONS)
+
+    server = LCAServer(args.socket, dblist, ksize, scaled)
+    notify('serving {} LCA databases (ksize={}, scaled={}) on {}',
+           len(dblist), ksize, scaled, args.socket)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+    notify('answered {} requests ({} queries)', server.n_requests,
+           server.n_queries)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
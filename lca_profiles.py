@@ -0,0 +1,126 @@
+"""
+A store of per-signature LCA count profiles.
+
+A profile is the Counter of hash-level LCA lineages for one signature,
+before any threshold is applied, i.e. what `lca_service.lca_counts`
+returns. Everything the bulk scripts derive from a signature (its
+classification, bulk-classify-dig.py's chimera call at any level, and
+bulk-investigate.py's blame lineages) depends only on the profile and
+the threshold, so rederive-from-profiles.py can redo them without any
+hash lookups.
+
+Profiles are kept in SQLite, keyed by signature md5sum; lineages are
+numbered once per store, and each profile is stored as two int32 arrays
+of lineage ids and counts.
+"""
+import os
+import sqlite3
+from collections import Counter
+
+import numpy as np
+
+from classify_cache import lineage_to_json, json_to_lineage
+
+# commit after this many profiles.
+COMMIT_EVERY = 1000
+
+
+class ProfileStore(object):
+    """
+    SQLite store of LCA count profiles, keyed by signature md5sum.
+    """
+    def __init__(self, filename, create=False):
+        if not create and not os.path.exists(filename):
+            raise ValueError("profile store '{}' does not exist".format(filename))
+
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS info (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS lineages (
+                id INTEGER PRIMARY KEY,
+                lineage TEXT UNIQUE NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS profiles (
+                md5 TEXT PRIMARY KEY,
+                name TEXT,
+                filename TEXT,
+                ids BLOB NOT NULL,
+                counts BLOB NOT NULL
+            );
+            ''')
+        self.conn.commit()
+
+        self._lineage_to_id = {}
+        self._id_to_lineage = {}
+        for lid, s in self.conn.execute('SELECT id, lineage FROM lineages'):
+            lineage = json_to_lineage(s)
+            self._lineage_to_id[lineage] = lid
+            self._id_to_lineage[lid] = lineage
+        self._n_puts = 0
+
+    def set_info(self, **info):
+        "Record where the profiles came from, e.g. ksize and databases."
+        for key, value in info.items():
+            self.conn.execute('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                              (key, str(value)))
+        self.conn.commit()
+
+    def info(self):
+        return dict(self.conn.execute('SELECT key, value FROM info'))
+
+    def _lineage_id(self, lineage):
+        lid = self._lineage_to_id.get(lineage)
+        if lid is None:
+            c = self.conn.execute('INSERT INTO lineages (lineage) VALUES (?)',
+                                  (lineage_to_json(lineage),))
+            lid = c.lastrowid
+            self._lineage_to_id[lineage] = lid
+            self._id_to_lineage[lid] = lineage
+        return lid
+
+    def put(self, md5, name, filename, counts):
+        "Store the profile 'counts', a Counter of LCA lineages."
+        # keep the Counter's order, so that ties sort the same way on reload.
+        ids = [ self._lineage_id(lineage) for lineage in counts ]
+        ids = np.array(ids, dtype=np.int32)
+        values = np.array(list(counts.values()), dtype=np.int32)
+        self.conn.execute('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?)',
+                          (md5, name, filename, ids.tobytes(),
+                           values.tobytes()))
+
+        self._n_puts += 1
+        if self._n_puts % COMMIT_EVERY == 0:
+            self.conn.commit()
+
+    def _to_counter(self, ids, counts):
+        ids = np.frombuffer(ids, dtype=np.int32)
+        counts = np.frombuffer(counts, dtype=np.int32)
+        return Counter(dict([ (self._id_to_lineage[lid], int(count))
+                              for lid, count in zip(ids, counts) ]))
+
+    def get(self, md5):
+        "Return the profile for 'md5', or None."
+        row = self.conn.execute('SELECT ids, counts FROM profiles WHERE md5=?',
+                                (md5,)).fetchone()
+        if row is None:
+            return None
+        return self._to_counter(*row)
+
+    def iter_profiles(self):
+        "Yield (md5, name, filename, profile) in the order they were stored."
+        c = self.conn.execute('''SELECT md5, name, filename, ids, counts
+                                 FROM profiles ORDER BY rowid''')
+        for md5, name, filename, ids, counts in c:
+            yield md5, name, filename, self._to_counter(ids, counts)
+
+    def __len__(self):
+        (n,) = self.conn.execute('SELECT COUNT(*) FROM profiles').fetchone()
+        return n
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,308 @@
+"""
+A resident LCA classification service, and a thin client for it.
+
+The server (see lca-server.py) loads LCA databases once and answers
+requests over a Unix socket. Requests and responses are single lines of
+JSON; each request carries a batch of queries, each query being a list of
+hash values:
+
+    {"op": "classify", "threshold": 5, "queries": [[hashval, ...], ...]}
+    {"op": "summarize", "threshold": 5, "queries": [...]}
+    {"op": "lca_counts", "queries": [...]}
+    {"op": "info"}
+
+and the response is {"results": [...]} or {"error": "message"}. Lineages
+are sent as lists of [rank, name] pairs.
+"""
+import os
+import json
+import socket
+import socketserver
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from sourmash.logging import notify, error
+from sourmash.lca import lca_utils
+
+from lca_vector import LineageCodes, LEVELS
+
+# ranks at or above each level, for aggregate_to_level.
+STOP_AT = dict([ (level, set(LEVELS[:i + 1]))
+                 for i, level in enumerate(LEVELS) ])
+
+
+def encode_lineage(lineage):
+    return [ list(pair) for pair in lineage ]
+
+
+def decode_lineage(lineage):
+    return tuple([ lca_utils.LineagePair(*pair) for pair in lineage ])
+
+
+def encode_lineage_counts(lineage_counts):
+    return [ (encode_lineage(lineage), count)
+             for lineage, count in lineage_counts.items() ]
+
+
+def decode_lineage_counts(pairs):
+    return Counter(dict([ (decode_lineage(lineage), count)
+                          for lineage, count in pairs ]))
+
+
+def lca_counts(hashvals, dblist, lineage_codes=None):
+    "Count the LCA lineages of 'hashvals', vectorized if we can."
+    if lineage_codes is not None:
+        return lineage_codes.lca_counts(hashvals)
+
+    assignments = lca_utils.gather_assignments(hashvals, dblist)
+    return lca_utils.count_lca_for_assignments(assignments)
+
+
+def summarize_counts(counts, threshold):
+    """
+    Aggregate LCA counts up to the root, ignoring lineages with fewer than
+    'threshold' counts; this is the second half of `summarize`.
+    """
+    aggregated_counts = defaultdict(int)
+    for lca, count in counts.most_common():
+        if count < threshold:
+            break
+
+        if not lca:
+            aggregated_counts[lca] += count
+
+        # climb from the lca to the root.
+        while lca:
+            aggregated_counts[lca] += count
+            lca = lca[:-1]
+
+    return aggregated_counts
+
+
+def aggregate_to_level(counts, threshold, level):
+    """
+    Aggregate a Counter of LCA lineages up to 'level', ignoring lineages
+    with fewer than 'threshold' counts; this is how bulk-classify-dig.py
+    finds chimeras.
+    """
+    stop_at = STOP_AT[level]
+
+    # ok, we now have the LCAs for each hashval, and their number
+    # of counts. Now aggregate counts across the tree, up 'til desired
+    # level; stop there.
+    aggregated_counts = defaultdict(int)
+    for lca, count in counts.most_common():
+        if count < threshold:
+            break
+
+        if not lca:
+            aggregated_counts[lca] += count
+            continue
+
+        if lca[-1].rank in stop_at:
+            aggregated_counts[lca] += count
+            continue
+
+        # climb from the lca to the root.
+        while lca:
+            lca = lca[:-1]
+            if lca and lca[-1].rank in stop_at:
+                aggregated_counts[lca] += count
+                break
+
+    return aggregated_counts
+
+
+def blame_lineages(lineage_counts, lineage):
+    """
+    Find the lineages that confuse a classification, as bulk-investigate.py
+    does: for a signature classified as 'lineage' at root, superkingdom or
+    phylum, the summarized lineages one rank below it.
+
+    Return (rank classified at, [(lineage, count), ...]).
+    """
+    lca_rank = 'root'
+    next_rank = 'superkingdom'
+    if lineage:
+        lca_rank = lineage[-1].rank
+        if lca_rank == 'superkingdom':
+            next_rank = 'phylum'
+        elif lca_rank == 'phylum':
+            next_rank = 'class'
+
+    blamed = []
+    for (lineage, count) in lineage_counts.items():
+        this_rank = 'root'
+        if lineage:
+            this_rank = lineage[-1].rank
+
+        if lca_rank in ('root', 'superkingdom', 'phylum') and \
+           next_rank == this_rank:
+            blamed.append((lineage, count))
+
+    return lca_rank, blamed
+
+
+def classify_counts(counts, threshold):
+    """
+    Classify from a Counter of LCA lineages, ignoring lineages with fewer
+    than 'threshold' counts; this is the second half of
+    `classify_signature`. Return (lineage, status).
+    """
+    tree = {}
+    for lca, count in counts.most_common():
+        if count < threshold:
+            break
+        lca_utils.build_tree([lca], tree)
+
+    if not tree:
+        return [], 'nomatch'
+
+    lca, reason = lca_utils.find_lca(tree)
+    if reason == 0:
+        return lca, 'found'
+    return lca, 'disagree'
+
+
+def classify_hashvals(hashvals, dblist, threshold, lineage_codes=None):
+    """
+    Classify a list of hashvals; this is `classify_signature` without the
+    signature. Return (lineage, status).
+    """
+    counts = lca_counts(hashvals, dblist, lineage_codes)
+    return classify_counts(counts, threshold)
+
+
+class LCARequestHandler(socketserver.StreamRequestHandler):
+    "Answer newline-delimited JSON requests until the client hangs up."
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = { 'results': self.server.dispatch(request) }
+            except Exception as e:
+                error('error handling request: {}', str(e))
+                response = { 'error': str(e) }
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class LCAServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serve classify/summarize requests against an in-memory list of LCA
+    databases.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, dblist, ksize, scaled):
+        self.dblist = dblist
+        self.lineage_codes = LineageCodes(dblist)
+        self.ksize = ksize
+        self.scaled = scaled
+        self.n_requests = 0
+        self.n_queries = 0
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               LCARequestHandler)
+
+    def dispatch(self, request):
+        op = request.get('op')
+        queries = request.get('queries', [])
+        threshold = request.get('threshold', 5)
+
+        self.n_requests += 1
+        self.n_queries += len(queries)
+
+        if op == 'info':
+            return { 'ksize': self.ksize, 'scaled': self.scaled,
+                     'databases': [ db.filename for db in self.dblist ],
+                     'n_requests': self.n_requests,
+                     'n_queries': self.n_queries }
+        elif op == 'classify':
+            results = []
+            for hashvals in queries:
+                lineage, status = classify_hashvals(hashvals, self.dblist,
+                                                    threshold,
+                                                    self.lineage_codes)
+                results.append((encode_lineage(lineage), status))
+            return results
+        elif op == 'summarize':
+            results = []
+            for hashvals in queries:
+                counts = lca_counts(hashvals, self.dblist, self.lineage_codes)
+                results.append(encode_lineage_counts(
+                    summarize_counts(counts, threshold)))
+            return results
+        elif op == 'lca_counts':
+            results = []
+            for hashvals in queries:
+                counts = lca_counts(hashvals, self.dblist, self.lineage_codes)
+                results.append(encode_lineage_counts(counts))
+            return results
+
+        raise ValueError("unknown op '{}'".format(op))
+
+
+class LCAClient(object):
+    """
+    Client for LCAServer. The batch methods take a list of hashval lists;
+    `classify_signature` can stand in for the sourmash function.
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.rfile = self.sock.makefile('rb')
+
+        info = self.info()
+        self.ksize = info['ksize']
+        self.scaled = info['scaled']
+
+    def request(self, op, queries=(), **kwargs):
+        request = dict(kwargs)
+        request['op'] = op
+        request['queries'] = [ hashvals.tolist() if isinstance(hashvals, np.ndarray)
+                               else list(hashvals) for hashvals in queries ]
+
+        self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        response = json.loads(self.rfile.readline().decode('utf-8'))
+        if 'error' in response:
+            raise ValueError('LCA server error: {}'.format(response['error']))
+        return response['results']
+
+    def info(self):
+        return self.request('info')
+
+    def classify(self, queries, threshold):
+        "Return a list of (lineage, status), one per query."
+        return [ (decode_lineage(lineage), status) for lineage, status in
+                 self.request('classify', queries, threshold=threshold) ]
+
+    def summarize(self, queries, threshold):
+        "Return a list of {lineage: count} dicts, one per query."
+        return [ decode_lineage_counts(x) for x in
+                 self.request('summarize', queries, threshold=threshold) ]
+
+    def lca_counts(self, queries):
+        "Return a list of Counters of LCA lineages, one per query."
+        return [ decode_lineage_counts(x) for x in
+                 self.request('lca_counts', queries) ]
+
+    def query_hashvals(self, minhash):
+        "Downsample 'minhash' to the server's scaled; return its hashvals."
+        if minhash.scaled and minhash.scaled < self.scaled:
+            minhash = minhash.downsample_scaled(self.scaled)
+        return minhash.get_mins()
+
+    def classify_signature(self, sig, dblist, threshold):
+        "Drop-in for `classify_signature`; 'dblist' is ignored."
+        return self.classify([self.query_hashvals(sig.minhash)],
+                             threshold)[0]
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
@@ -0,0 +1,227 @@
+"""
+Load LCA databases by streaming the JSON, instead of json.load-ing it all.
+
+`lca_utils.load_databases` decompresses and parses the entire file into
+one big dictionary before converting it, so peak memory during load is
+several times the size of the final database. Here the file is parsed
+incrementally with ijson and each section is converted as it is read;
+sections a script doesn't need are skipped entirely, and hashes above
+the requested scaled are dropped before they are ever stored.
+
+    dblist, ksize, scaled = load_databases(filenames, scaled,
+                                           sections=LINEAGE_SECTIONS)
+
+The result is an ordinary `LCA_Database`, except that skipped sections
+are empty dictionaries and the values of `hashval_to_idx` are tuples
+rather than lists, which is all read-only code needs.
+"""
+import sys
+import gzip
+
+import ijson
+
+from sourmash.logging import notify
+from sourmash.lca import lca_utils
+from sourmash._minhash import get_max_hash_for_scaled
+
+ALL_SECTIONS = ('hashval_to_idx', 'idx_to_lid', 'lid_to_lineage',
+                'ident_to_name', 'ident_to_idx')
+
+# what classify/summarize and hash-level LCA need: hashval -> lineages.
+LINEAGE_SECTIONS = ('hashval_to_idx', 'idx_to_lid', 'lid_to_lineage')
+
+
+def _value(event, value, events):
+    "Build the JSON value that starts with (event, value)."
+    if event == 'start_map':
+        return dict(_iter_map(events))
+    elif event == 'start_array':
+        return [ _value(ev, val, events) for ev, val in _iter_array(events) ]
+    return value
+
+
+def _iter_map(events):
+    "Yield (key, value) for the rest of an object whose start_map was read."
+    for event, key in events:
+        if event == 'end_map':
+            return
+        event, value = next(events)
+        yield key, _value(event, value, events)
+
+
+def _iter_array(events):
+    "Yield the (event, value) starting each item of an array."
+    for event, value in events:
+        if event == 'end_array':
+            return
+        yield event, value
+
+
+def _skip(event, events):
+    "Skip the JSON value that starts with 'event'."
+    if event not in ('start_map', 'start_array'):
+        return
+
+    depth = 1
+    for event, value in events:
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def _read_hashval_to_idx(events, max_hash):
+    hashval_to_idx = {}
+    for key, idx_list in _iter_map(events):
+        hashval = int(key)
+        if max_hash and hashval >= max_hash:
+            continue
+        hashval_to_idx[hashval] = tuple(idx_list)
+    return hashval_to_idx
+
+
+def _read_lid_to_lineage(events):
+    lid_to_lineage = {}
+    for key, lineage in _iter_map(events):
+        # saved as {rank: name} or as a list of [rank, name] pairs.
+        lineage = dict(lineage)
+        lid_to_lineage[int(key)] = tuple([
+            lca_utils.LineagePair(rank, lineage.get(rank, ''))
+            for rank in lca_utils.taxlist() ])
+    return lid_to_lineage
+
+
+def load_single_database(filename, scaled=None, sections=ALL_SECTIONS):
+    """
+    Stream-load one LCA database, keeping only 'sections' and, if 'scaled'
+    is given, only the hashes that survive downsampling to it. Raise
+    ValueError if 'scaled' is finer than the database's.
+    """
+    max_hash = None
+    if scaled:
+        max_hash = get_max_hash_for_scaled(scaled)
+
+    xopen = open
+    if filename.endswith('.gz'):
+        xopen = gzip.open
+
+    lca_db = lca_utils.LCA_Database()
+    for name in ALL_SECTIONS:
+        setattr(lca_db, name, {})
+    header = {}
+
+    with xopen(filename, 'rb') as fp:
+        events = ijson.basic_parse(fp)
+        try:
+            event, value = next(events)
+            if event != 'start_map':
+                raise ValueError("database file '{}' is not an LCA db.".format(filename))
+
+            for event, key in events:
+                if event == 'end_map':
+                    break
+                event, value = next(events)
+
+                if key not in sections:
+                    if key in ALL_SECTIONS or event in ('start_map', 'start_array'):
+                        _skip(event, events)
+                    else:
+                        header[key] = value
+
+                        # as LCA_Database.downsample_scaled; before the hashes.
+                        if key == 'scaled' and scaled and scaled < int(value):
+                            raise ValueError("cannot decrease scaled from {} to {}".format(value, scaled))
+                elif key == 'hashval_to_idx':
+                    lca_db.hashval_to_idx = _read_hashval_to_idx(events,
+                                                                 max_hash)
+                elif key == 'lid_to_lineage':
+                    lca_db.lid_to_lineage = _read_lid_to_lineage(events)
+                elif key == 'idx_to_lid':
+                    lca_db.idx_to_lid = dict([ (int(k), v) for (k, v)
+                                               in _iter_map(events) ])
+                else:
+                    setattr(lca_db, key, dict(_iter_map(events)))
+        except ijson.JSONError:
+            raise ValueError("cannot parse database file '{}' as JSON; invalid format.".format(filename))
+
+    if header.get('type') != 'sourmash_lca':
+        raise ValueError("database file '{}' is not an LCA db.".format(filename))
+    if header.get('version') != '2.0':
+        raise ValueError("Error! This is an old-style LCA DB. You'll need to build or download a newer one.")
+
+    lca_db.ksize = int(header['ksize'])
+    lca_db.scaled = int(header['scaled'])
+    if scaled and scaled > lca_db.scaled:
+        lca_db.scaled = scaled
+    lca_db.filename = filename
+
+    return lca_db, lca_db.ksize, lca_db.scaled
+
+
+def iter_hashval_to_idx(filename):
+    """
+    Stream (hashval, idx list) pairs from an LCA database file, one at a
+    time, without loading the rest of it.
+    """
+    xopen = open
+    if filename.endswith('.gz'):
+        xopen = gzip.open
+
+    with xopen(filename, 'rb') as fp:
+        events = ijson.basic_parse(fp)
+        event, value = next(events)
+        if event != 'start_map':
+            raise ValueError("database file '{}' is not an LCA db.".format(filename))
+
+        for event, key in events:
+            if event == 'end_map':
+                break
+            event, value = next(events)
+
+            if key != 'hashval_to_idx':
+                _skip(event, events)
+                continue
+
+            for key, idx_list in _iter_map(events):
+                yield int(key), idx_list
+            break
+
+
+def load_databases(filenames, scaled=None, sections=ALL_SECTIONS,
+                   verbose=True):
+    """
+    Stream-load multiple LCA databases; return (dblist, ksize, scaled).
+
+    A drop-in for `lca_utils.load_databases`.
+    """
+    ksize_vals = set()
+    scaled_vals = set()
+    dblist = []
+
+    for db_name in filenames:
+        if verbose:
+            notify(u'\r\033[K', end=u'', file=sys.stderr)
+            notify('... loading database {}'.format(db_name), end='\r',
+                  file=sys.stderr)
+
+        lca_db, ksize, db_scaled = load_single_database(db_name, scaled,
+                                                        sections)
+
+        ksize_vals.add(ksize)
+        if len(ksize_vals) > 1:
+            raise Exception('multiple ksizes, quitting')
+        scaled_vals.add(db_scaled)
+
+        dblist.append(lca_db)
+
+    ksize = ksize_vals.pop()
+    scaled = scaled_vals.pop()
+
+    if verbose:
+        notify(u'\r\033[K', end=u'')
+        notify('loaded {} LCA databases. ksize={}, scaled={}', len(dblist),
+               ksize, scaled)
+
+    return dblist, ksize, scaled
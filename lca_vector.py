@@ -0,0 +1,312 @@
+"""
+Batched, vectorized hash-level LCA.
+
+`lca_utils.count_lca_for_assignments` finds the LCA of each hash by
+building a dict tree of its lineages and walking it. Here, every distinct
+lineage in the databases becomes one row of a table of integer codes,
+one column per tree depth, where the code at depth d identifies the
+lineage's path from the root down to its d'th named rank. For a batch of
+hashes, given as CSR lists of lineage rows, the LCA of each hash is the
+deepest node above which all its lineages follow a single path, which
+is found with a few NumPy reductions per depth:
+
+    table = LineageCodes(dblist)
+    counts = table.lca_counts(hashvals)
+
+gives the same Counter as
+
+    assignments = lca_utils.gather_assignments(hashvals, dblist)
+    counts = lca_utils.count_lca_for_assignments(assignments)
+
+The table also holds, for every code, its ancestor at each rank, so that
+aggregating LCA counts up to a rank is one lookup per LCA.
+
+Signature hashes can also be kept as uint64 arrays throughout:
+
+    hashvals = minhash_hashvals(sig.minhash, scaled)
+    hashvals = remove_hashvals(hashvals, confused)
+    counts = table.lca_counts(hashvals)
+
+Given an array, the lineage rows are looked up with np.searchsorted in
+a sorted array of all the database hashes, built on first use, rather
+than with one dict lookup per hash; lists and dicts of hashvals still
+take the dict path.
+"""
+from itertools import chain
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from sourmash.lca import lca_utils
+from sourmash._minhash import get_max_hash_for_scaled
+
+NO_CODE = np.iinfo(np.int32).max
+
+# the ranks counts can be aggregated to.
+LEVELS = list(lca_utils.taxlist(include_strain=False))
+
+
+def minhash_hashvals(minhash, scaled=None):
+    """
+    Return the hashes of 'minhash' as a uint64 array, downsampled to
+    'scaled' if that is coarser; as minhash.downsample_scaled(scaled)
+    .get_mins(), without building a new MinHash.
+    """
+    hashvals = np.array(minhash.get_mins(), dtype=np.uint64)
+    if scaled and minhash.scaled < scaled:
+        max_hash = np.uint64(get_max_hash_for_scaled(scaled))
+        hashvals = hashvals[hashvals < max_hash]
+    return hashvals
+
+
+def remove_hashvals(hashvals, exclude):
+    "Drop the hashes in the uint64 array 'exclude' from 'hashvals'."
+    if not len(exclude):
+        return hashvals
+    return hashvals[~np.isin(hashvals, exclude)]
+
+
+def _take_segments(values, starts, lengths):
+    "Concatenate values[start:start + length] for each start and length."
+    ends = np.cumsum(lengths)
+    offsets = np.repeat(starts - (ends - lengths), lengths)
+    return values[np.arange(ends[-1] if len(ends) else 0) + offsets]
+
+
+class LineageCodes(object):
+    """
+    Per-depth path codes for every lineage in a list of LCA databases.
+
+    Code 0 is the root, i.e. the empty lineage; `lineages[code]` is the
+    lineage, as a tuple of the LineagePairs with names, for each code.
+    """
+    def __init__(self, dblist):
+        self.dblist = dblist
+        self.lineages = [()]
+        path_to_code = { (): 0 }
+        lineage_to_row = {}
+        rows = []
+
+        # per database, map each idx with a lineage to its lineage row.
+        self.idx_to_row = []
+        for lca_db in dblist:
+            idx_to_row = {}
+            for idx, lid in lca_db.idx_to_lid.items():
+                lineage = lca_db.lid_to_lineage[lid]
+                row = lineage_to_row.get(lineage)
+                if row is None:
+                    row = len(rows)
+                    lineage_to_row[lineage] = row
+
+                    # as in lca_utils.build_tree, unnamed ranks are skipped.
+                    path = tuple([ pair for pair in lineage if pair.name ])
+                    codes = []
+                    for depth in range(len(path)):
+                        prefix = path[:depth + 1]
+                        code = path_to_code.get(prefix)
+                        if code is None:
+                            code = len(self.lineages)
+                            path_to_code[prefix] = code
+                            self.lineages.append(prefix)
+                        codes.append(code)
+                    rows.append(codes)
+                idx_to_row[idx] = row
+            self.idx_to_row.append(idx_to_row)
+
+        self.depth = max([ len(codes) for codes in rows ] + [0])
+        self.codes = np.zeros((len(rows), self.depth), dtype=np.int32)
+        for row, codes in enumerate(rows):
+            self.codes[row, :len(codes)] = codes
+
+        self.ancestors = self._make_ancestors(path_to_code)
+        self.hash_index = None
+
+    def _make_ancestors(self, path_to_code):
+        """
+        Build the (code, level) -> code table used by aggregate_to_level:
+        the deepest prefix of each lineage that ends at or above the level,
+        or -1 if there is none. The root stays at the root.
+        """
+        ancestors = np.full((len(self.lineages), len(LEVELS)), -1,
+                            dtype=np.int32)
+        ancestors[0, :] = 0
+        for code, lineage in enumerate(self.lineages):
+            for i in range(len(LEVELS)):
+                stop_at = LEVELS[:i + 1]
+                for depth in range(len(lineage), 0, -1):
+                    if lineage[depth - 1].rank in stop_at:
+                        ancestors[code, i] = path_to_code[lineage[:depth]]
+                        break
+        return ancestors
+
+    def gather(self, hashvals, found=None):
+        """
+        Collect the lineage rows for each of 'hashvals' across all the
+        databases, as CSR arrays (indptr, rows). Hashes with no lineage
+        are left out, as in lca_utils.gather_assignments; if 'found' is a
+        list, the hashvals that are kept are appended to it.
+        """
+        rows = []
+        indptr = [0]
+        dbs = list(zip(self.dblist, self.idx_to_row))
+        for hashval in hashvals:
+            for lca_db, idx_to_row in dbs:
+                idx_list = lca_db.hashval_to_idx.get(hashval)
+                if idx_list:
+                    for idx in idx_list:
+                        row = idx_to_row.get(idx)
+                        if row is not None:
+                            rows.append(row)
+            if len(rows) != indptr[-1]:
+                indptr.append(len(rows))
+                if found is not None:
+                    found.append(hashval)
+
+        return (np.array(indptr, dtype=np.int64),
+                np.array(rows, dtype=np.int64))
+
+    def _make_hash_index(self):
+        """
+        Build (sorted hashvals, indptr, rows): the CSR lineage rows of every
+        hash in the databases, in the order gather would collect them.
+        The arrays are filled straight from the dictionaries, without
+        intermediate Python lists.
+        """
+        all_hashvals = []
+        all_n_rows = []
+        all_rows = []
+        for lca_db, idx_to_row in zip(self.dblist, self.idx_to_row):
+            hashval_to_idx = lca_db.hashval_to_idx
+            n_hashes = len(hashval_to_idx)
+            hashvals = np.fromiter(hashval_to_idx.keys(), dtype=np.uint64,
+                                   count=n_hashes)
+            n_idx = np.fromiter(map(len, hashval_to_idx.values()),
+                                dtype=np.int64, count=n_hashes)
+            idx = np.fromiter(chain.from_iterable(hashval_to_idx.values()),
+                              dtype=np.int64, count=int(n_idx.sum()))
+
+            # map idx to lineage rows, -1 for idx without a lineage.
+            size = max([ int(idx.max()) + 1 if len(idx) else 0,
+                         max(idx_to_row, default=-1) + 1 ])
+            idx_rows = np.full(size, -1, dtype=np.int64)
+            idx_rows[np.fromiter(idx_to_row.keys(), dtype=np.int64,
+                                 count=len(idx_to_row))] = \
+              np.fromiter(idx_to_row.values(), dtype=np.int64,
+                          count=len(idx_to_row))
+            rows = idx_rows[idx]
+            has_row = rows >= 0
+
+            n_rows = np.bincount(np.repeat(np.arange(n_hashes), n_idx)[has_row],
+                                 minlength=n_hashes)
+            keep = n_rows > 0
+            all_hashvals.append(hashvals[keep])
+            all_n_rows.append(n_rows[keep])
+            all_rows.append(rows[has_row])
+
+        hashvals = np.concatenate(all_hashvals + [np.zeros(0, dtype=np.uint64)])
+        n_rows = np.concatenate(all_n_rows + [np.zeros(0, dtype=np.int64)])
+        rows = np.concatenate(all_rows + [np.zeros(0, dtype=np.int64)])
+        del all_hashvals, all_n_rows, all_rows
+        starts = np.cumsum(n_rows) - n_rows
+
+        # a stable sort keeps the databases in order for shared hashes,
+        # whose rows are then merged.
+        order = np.argsort(hashvals, kind='stable')
+        rows = _take_segments(rows, starts[order], n_rows[order])
+        hashvals, n_rows = hashvals[order], n_rows[order]
+        hashvals, first = np.unique(hashvals, return_index=True)
+        n_rows = np.add.reduceat(n_rows, first) if len(first) else n_rows
+
+        indptr = np.zeros(len(hashvals) + 1, dtype=np.int64)
+        np.cumsum(n_rows, out=indptr[1:])
+        return hashvals, indptr, rows
+
+    def gather_array(self, hashvals, found=None):
+        """
+        gather() for a uint64 array of hashvals, by binary search in an
+        index of all the database hashes.
+        """
+        if self.hash_index is None:
+            self.hash_index = self._make_hash_index()
+        index_hashvals, index_indptr, index_rows = self.hash_index
+
+        pos = np.searchsorted(index_hashvals, hashvals)
+        pos[pos == len(index_hashvals)] = 0
+        hit = index_hashvals[pos] == hashvals if len(index_hashvals) else \
+          np.zeros(len(hashvals), dtype=bool)
+        pos = pos[hit]
+        if found is not None:
+            found.extend(hashvals[hit].tolist())
+
+        starts = index_indptr[pos]
+        lengths = index_indptr[pos + 1] - starts
+        indptr = np.zeros(len(pos) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        return indptr, _take_segments(index_rows, starts, lengths)
+
+    def lca_ids(self, indptr, rows):
+        """
+        Return the LCA code for each hash in the CSR lists (indptr, rows);
+        every hash must have at least one row.
+        """
+        n = len(indptr) - 1
+        lca = np.zeros(n, dtype=np.int32)
+        if not n:
+            return lca
+
+        starts = indptr[:-1]
+        codes = self.codes[rows]
+        alive = np.ones(n, dtype=bool)
+        for depth in range(self.depth):
+            col = codes[:, depth]
+
+            # descend while all the lineages that go this deep agree,
+            # i.e. the node has exactly one child.
+            hi = np.maximum.reduceat(col, starts)
+            lo = np.minimum.reduceat(np.where(col == 0, NO_CODE, col), starts)
+            alive &= (hi > 0) & (lo == hi)
+            if not alive.any():
+                break
+            lca[alive] = hi[alive]
+
+        return lca
+
+    def lca_id_counts(self, hashvals):
+        """
+        Return (LCA codes, number of hashes) for 'hashvals', in one call.
+
+        Codes are in order of first appearance, like the keys of the
+        Counter from count_lca_for_assignments.
+        """
+        if isinstance(hashvals, np.ndarray):
+            indptr, rows = self.gather_array(hashvals)
+        else:
+            indptr, rows = self.gather(hashvals)
+        ids, first, counts = np.unique(self.lca_ids(indptr, rows),
+                                       return_index=True, return_counts=True)
+        order = np.argsort(first)
+        return ids[order], counts[order]
+
+    def aggregate_to_level(self, ids, counts, threshold, level):
+        """
+        Aggregate LCA codes and their counts (from lca_id_counts) up to
+        'level', ignoring LCAs with fewer than 'threshold' counts. Return
+        {lineage: count}, as lca_service.aggregate_to_level does.
+        """
+        # visit in Counter.most_common() order, so the output is too.
+        order = np.argsort(-counts, kind='stable')
+        ids, counts = ids[order], counts[order]
+        keep = counts >= threshold
+        ancestors = self.ancestors[ids[keep], LEVELS.index(level)]
+
+        aggregated_counts = defaultdict(int)
+        for code, count in zip(ancestors, counts[keep]):
+            if code >= 0:
+                aggregated_counts[self.lineages[code]] += int(count)
+        return aggregated_counts
+
+    def lca_counts(self, hashvals):
+        "Return a Counter of LCA lineages, like count_lca_for_assignments."
+        ids, counts = self.lca_id_counts(hashvals)
+        return Counter(dict([ (self.lineages[code], int(count))
+                              for code, count in zip(ids, counts) ]))
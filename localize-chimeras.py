@@ -0,0 +1,282 @@
+#! /usr/bin/env python
+"""
+Localize contamination in the genomes flagged as chimeras by
+bulk-classify-dig.py, without pairwise alignments.
+
+For each 'chimera' row in {prefix}-dig.csv, stream the genome FASTA,
+sketch each contig (or each --window bp of it), and classify the sketches
+against the LCA database. The genome's main lineage (at --level) is the
+one with the most classified bp; contigs whose classified bp mostly
+disagree with it are called contaminants.
+
+Outputs, in --output-dir (default {prefix}-chimera-contigs):
+* contigs.csv - a lineage for every contig or window;
+* genomes.csv - per genome, its main lineage and clean/contaminant bp;
+* {genome}.kept.fa / {genome}.removed.fa - the suggested split, named
+  as by align-genomes.py.
+
+Genomes are processed in parallel with -p; the databases are loaded
+once, before forking.
+"""
+import os
+import sys
+import csv
+import argparse
+import multiprocessing
+from collections import defaultdict
+
+import screed
+import sourmash
+from sourmash.logging import error, notify, set_quiet
+from sourmash.lca import lca_utils
+
+from lca_stream import load_databases, LINEAGE_SECTIONS
+from lca_vector import LineageCodes, LEVELS
+from lca_service import classify_hashvals
+from csv_io import open_text, find_csv
+
+CONTIG_FIELDS = ['genome', 'contig', 'start', 'end', 'n_hashes', 'status',
+                 'rank', 'lineage', 'call']
+GENOME_FIELDS = ['genome', 'filename', 'main_lineage', 'n_contigs',
+                 'clean_bp', 'contaminant_bp', 'unclassified_bp',
+                 'contaminant_contigs']
+
+# set in main() before the worker processes are forked.
+_dblist = None
+_lineage_codes = None
+
+
+def truncate_lineage(lineage, level):
+    "Cut 'lineage' back to the ranks at or above 'level'."
+    stop_at = LEVELS[:LEVELS.index(level) + 1]
+    return tuple([ pair for pair in lineage if pair.rank in stop_at ])
+
+
+def compatible(lineage1, lineage2):
+    "Is one of these lineages an ancestor of (or the same as) the other?"
+    n = min(len(lineage1), len(lineage2))
+    return lineage1[:n] == lineage2[:n]
+
+
+def iter_windows(sequence, window):
+    "Yield (start, end) for each window of 'sequence', or all of it."
+    if not window:
+        yield 0, len(sequence)
+        return
+
+    for start in range(0, len(sequence), window):
+        yield start, min(start + window, len(sequence))
+
+
+def classify_windows(genome, filename, args, template_mh):
+    "Sketch and classify each contig/window of one genome; return rows."
+    rows = []
+    for record in screed.open(filename):
+        contig = record.name.split(' ')[0]
+        sequence = record.sequence
+        for start, end in iter_windows(sequence, args.window):
+            # overlap windows by ksize-1 bases, so no k-mer is lost.
+            mh = template_mh.copy_and_clear()
+            mh.add_sequence(sequence[start:end + args.ksize - 1], True)
+            hashvals = mh.get_mins()
+
+            lineage, status = [], 'nomatch'
+            if hashvals:
+                lineage, status = classify_hashvals(hashvals, _dblist,
+                                                    args.threshold,
+                                                    _lineage_codes)
+            rank = lineage[-1].rank if lineage else ''
+            rows.append(dict(genome=genome, contig=contig, start=start,
+                             end=end, n_hashes=len(hashvals), status=status,
+                             rank=rank, lineage=tuple(lineage)))
+
+    return rows
+
+
+def call_contigs(rows, level):
+    """
+    Pick the main lineage at 'level' by classified bp, and call each
+    contig 'clean', 'contaminant' or 'unclassified'. Fill in 'call' on
+    each row; return (main lineage, {contig: call}).
+    """
+    bp_by_lineage = defaultdict(int)
+    for row in rows:
+        if row['lineage']:
+            lineage = truncate_lineage(row['lineage'], level)
+            bp_by_lineage[lineage] += row['end'] - row['start']
+
+    main_lineage = ()
+    if bp_by_lineage:
+        main_lineage = max(bp_by_lineage.items(), key=lambda x: x[1])[0]
+
+    agree_bp = defaultdict(int)
+    disagree_bp = defaultdict(int)
+    for row in rows:
+        if not row['lineage']:
+            row['call'] = 'unclassified'
+            continue
+
+        lineage = truncate_lineage(row['lineage'], level)
+        if compatible(lineage, main_lineage):
+            row['call'] = 'clean'
+            agree_bp[row['contig']] += row['end'] - row['start']
+        else:
+            row['call'] = 'contaminant'
+            disagree_bp[row['contig']] += row['end'] - row['start']
+
+    calls = {}
+    for row in rows:
+        contig = row['contig']
+        if disagree_bp[contig] > agree_bp[contig]:
+            calls[contig] = 'contaminant'
+        elif agree_bp[contig]:
+            calls[contig] = 'clean'
+        else:
+            calls[contig] = 'unclassified'
+
+    return main_lineage, calls
+
+
+def split_genome(filename, calls, outprefix):
+    """
+    Write contaminant contigs to outprefix + '.removed.fa' and the rest
+    to outprefix + '.kept.fa'; return bp per call.
+    """
+    bp = defaultdict(int)
+    with open(outprefix + '.kept.fa', 'wt') as kept_fp, \
+         open(outprefix + '.removed.fa', 'wt') as removed_fp:
+        for record in screed.open(filename):
+            call = calls.get(record.name.split(' ')[0], 'unclassified')
+            bp[call] += len(record.sequence)
+
+            fp = removed_fp if call == 'contaminant' else kept_fp
+            fp.write('>{}\n{}\n'.format(record.name, record.sequence))
+
+    return bp
+
+
+def localize(job):
+    "Process one genome; run in a worker process."
+    genome, filename, args = job
+
+    template_mh = sourmash.MinHash(n=0, ksize=args.ksize, scaled=args.scaled)
+    rows = classify_windows(genome, filename, args, template_mh)
+    main_lineage, calls = call_contigs(rows, args.level)
+
+    outprefix = os.path.join(args.output_dir, genome)
+    bp = split_genome(filename, calls, outprefix)
+
+    summary = dict(genome=genome, filename=filename,
+                   main_lineage=lca_utils.display_lineage(main_lineage),
+                   n_contigs=len(calls),
+                   clean_bp=bp['clean'], contaminant_bp=bp['contaminant'],
+                   unclassified_bp=bp['unclassified'],
+                   contaminant_contigs=sum([ 1 for call in calls.values()
+                                             if call == 'contaminant' ]))
+    for row in rows:
+        row['lineage'] = lca_utils.display_lineage(row['lineage'])
+
+    return rows, summary
+
+
+def find_genome(filename, genome_dir):
+    "Find a genome file, by its recorded path or by name in 'genome_dir'."
+    if genome_dir:
+        candidate = os.path.join(genome_dir, os.path.basename(filename))
+        if os.path.exists(candidate):
+            return candidate
+    if os.path.exists(filename):
+        return filename
+    return None
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('prefix', help='prefix used for bulk-classify-dig.py')
+    p.add_argument('lca_db', nargs='+')
+    p.add_argument('--genome-dir',
+                   help='look for genome files by name in this directory')
+    p.add_argument('--output-dir', help='default: {prefix}-chimera-contigs')
+    p.add_argument('--window', type=int, default=0,
+                   help='classify windows of this many bp instead of whole contigs')
+    p.add_argument('--scaled', type=float,
+                   help='sketch at this scaled (default: the database scaled)')
+    p.add_argument('--threshold', type=int, default=2,
+                   help='minimum hashes for a lineage to count in a contig')
+    p.add_argument('--level', default='order', choices=LEVELS,
+                   help='rank at which to call contamination (default: %(default)s)')
+    p.add_argument('-p', '--processes', type=int, default=1)
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    p.add_argument('-d', '--debug', action='store_true',
+                   help='output debugging output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet, args.debug)
+
+    global _dblist, _lineage_codes
+    if args.scaled:
+        args.scaled = int(args.scaled)
+    _dblist, args.ksize, args.scaled = load_databases(args.lca_db,
+                                                      args.scaled,
+                                                      sections=LINEAGE_SECTIONS)
+    _lineage_codes = LineageCodes(_dblist)
+
+    if not args.output_dir:
+        args.output_dir = '{}-chimera-contigs'.format(args.prefix)
+    if not os.path.isdir(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    jobs = []
+    with open_text(find_csv('{}-dig.csv'.format(args.prefix))) as fp:
+        r = csv.DictReader(fp, fieldnames=['status', 'name', 'filename', 'md5sum'])
+        for row in r:
+            if row['status'] != 'chimera':
+                continue
+            filename = find_genome(row['filename'], args.genome_dir)
+            if not filename:
+                error('WARNING: cannot find genome file {} for {}; skipping',
+                      row['filename'], row['name'])
+                continue
+            genome = os.path.basename(filename)
+            jobs.append((genome, filename, args))
+
+    if not jobs:
+        error('Error! no chimeric genomes found in {}-dig.csv', args.prefix)
+        sys.exit(-1)
+    notify('localizing contamination in {} genomes', len(jobs))
+
+    if args.processes > 1:
+        pool = multiprocessing.get_context('fork').Pool(args.processes)
+        results = pool.imap_unordered(localize, jobs)
+    else:
+        pool = None
+        results = map(localize, jobs)
+
+    contigs_fp = open(os.path.join(args.output_dir, 'contigs.csv'), 'wt')
+    contigs_w = csv.DictWriter(contigs_fp, fieldnames=CONTIG_FIELDS)
+    contigs_w.writeheader()
+    genomes_fp = open(os.path.join(args.output_dir, 'genomes.csv'), 'wt')
+    genomes_w = csv.DictWriter(genomes_fp, fieldnames=GENOME_FIELDS)
+    genomes_w.writeheader()
+
+    n_contaminated = 0
+    for rows, summary in results:
+        contigs_w.writerows(rows)
+        genomes_w.writerow(summary)
+        if summary['contaminant_bp']:
+            n_contaminated += 1
+        print('{}: {:.0f}kb clean, {:.0f}kb contaminant in {} contigs, {:.0f}kb unclassified'.format(summary['genome'], summary['clean_bp'] / 1000, summary['contaminant_bp'] / 1000, summary['contaminant_contigs'], summary['unclassified_bp'] / 1000))
+
+    if pool:
+        pool.close()
+        pool.join()
+    contigs_fp.close()
+    genomes_fp.close()
+
+    notify('found contaminant contigs in {} of {} genomes; results in {}',
+           n_contaminated, len(jobs), args.output_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,185 @@
+"""
+An opt-in HTTP endpoint exposing live progress of the bulk scripts in
+the Prometheus text format.
+
+    metrics = start_metrics_from_args(args, 'my-script', total=n_leaves)
+    for sig in ...:
+        ...
+        metrics.classified(rank)
+        metrics.signature_done()
+
+`add_metrics_args` adds --metrics-port (and --metrics-host); without
+--metrics-port nothing is served and the Metrics object is just a set
+of counters.
+"""
+import time
+import threading
+import socketserver
+from collections import defaultdict, deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from sourmash.logging import notify
+
+from instrument import current_rss_mb, peak_rss_mb
+
+PREFIX = 'sourmash_bulk_'
+RATE_WINDOW = 60                     # seconds used for signatures/sec
+
+
+def add_metrics_args(p):
+    p.add_argument('--metrics-port', type=int,
+                   help='serve Prometheus metrics over HTTP on this port')
+    p.add_argument('--metrics-host', default='127.0.0.1',
+                   help='address for --metrics-port (default: %(default)s)')
+
+
+class Metrics(object):
+    """
+    Progress counters for one run; safe to read from the HTTP thread.
+    """
+    def __init__(self, script, total=None):
+        self.script = script
+        self.total = total
+        self.start = time.time()
+        self.last_progress = self.start
+        self.n_processed = 0
+        self.n_missed = defaultdict(int)
+        self.rank_counts = defaultdict(int)
+        self.samples = deque([(self.start, 0)])
+        self.lock = threading.Lock()
+
+    def set_total(self, total):
+        with self.lock:
+            self.total = total
+
+    def signature_done(self, n=1):
+        now = time.time()
+        with self.lock:
+            self.n_processed += n
+            self.last_progress = now
+
+            # keep about one sample per second across the rate window.
+            if now - self.samples[-1][0] >= 1:
+                self.samples.append((now, self.n_processed))
+                while now - self.samples[0][0] > RATE_WINDOW:
+                    self.samples.popleft()
+
+    def classified(self, rank, ksize=None):
+        "Record a classification at 'rank'; 'MISSED' counts as missed."
+        with self.lock:
+            if rank == 'MISSED':
+                self.n_missed[ksize] += 1
+            else:
+                self.rank_counts[(rank, ksize)] += 1
+
+    def rate(self):
+        "Signatures/sec over (about) the last RATE_WINDOW seconds."
+        now = time.time()
+        then, n_then = self.samples[0]
+        if now - then < 1e-6:
+            return 0.
+        return (self.n_processed - n_then) / (now - then)
+
+    def render(self):
+        "Return all the metrics in the Prometheus text format."
+        with self.lock:
+            rate = self.rate()
+            eta = None
+            if self.total is not None and rate > 0:
+                eta = max(self.total - self.n_processed, 0) / rate
+
+            lines = []
+            def add(name, kind, help, values):
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, help))
+                lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+                for labels, value in values:
+                    labels = dict(labels, script=self.script)
+                    labels = ','.join([ '{}="{}"'.format(k, v)
+                                        for k, v in sorted(labels.items()) ])
+                    lines.append('{}{}{{{}}} {}'.format(PREFIX, name,
+                                                        labels, value))
+
+            add('signatures_processed_total', 'counter',
+                'Signatures processed so far.', [({}, self.n_processed)])
+            add('signatures_per_second', 'gauge',
+                'Signatures processed per second, over the last {}s.'.format(RATE_WINDOW),
+                [({}, rate)])
+            if self.total is not None:
+                add('signatures_expected', 'gauge',
+                    'Signatures to process in this run.', [({}, self.total)])
+            if eta is not None:
+                add('eta_seconds', 'gauge',
+                    'Estimated seconds until the run finishes.', [({}, eta)])
+
+            def ksize_labels(ksize, **labels):
+                if ksize is not None:
+                    labels['ksize'] = ksize
+                return labels
+
+            add('classified_total', 'counter',
+                'Signatures classified, by rank.',
+                [ (ksize_labels(ksize, rank=rank), count)
+                  for (rank, ksize), count in sorted(self.rank_counts.items(),
+                                                     key=str) ])
+            add('missed_total', 'counter',
+                'Signatures with no classification.',
+                [ (ksize_labels(ksize), count)
+                  for ksize, count in sorted(self.n_missed.items(), key=str) ]
+                or [({}, 0)])
+            add('last_progress_timestamp_seconds', 'gauge',
+                'Unix time at which the last signature finished.',
+                [({}, self.last_progress)])
+            add('start_time_seconds', 'gauge',
+                'Unix time at which the run started.', [({}, self.start)])
+
+        rss = current_rss_mb()
+        if rss is not None:
+            add('resident_memory_bytes', 'gauge',
+                'Current resident set size.', [({}, int(rss * 1024 * 1024))])
+        add('peak_resident_memory_bytes', 'gauge',
+            'Peak resident set size.',
+            [({}, int(peak_rss_mb() * 1024 * 1024))])
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass                             # don't clutter the job's output
+
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        HTTPServer.__init__(self, address, MetricsRequestHandler)
+        self.metrics = metrics
+
+
+def start_metrics_server(metrics, port, host='127.0.0.1'):
+    "Serve 'metrics' on host:port from a daemon thread."
+    server = MetricsServer((host, port), metrics)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    notify('serving metrics on http://{}:{}/metrics', host, port)
+    return server
+
+
+def start_metrics_from_args(args, script, total=None):
+    "Create a Metrics object, serving it if --metrics-port was given."
+    metrics = Metrics(script, total)
+    if args.metrics_port:
+        start_metrics_server(metrics, args.metrics_port, args.metrics_host)
+    return metrics
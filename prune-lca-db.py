@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+"""
+Shrink an LCA database by keeping only the most informative hashes of
+each genome.
+
+A hash is as informative as its LCA is deep: a species-specific hash
+says more than one shared across a phylum, and one whose LCA is the root
+says nothing to classify. Each genome keeps its --budget deepest hashes
+(ties going to the smallest hashvals, which also survive downsampling);
+a hash kept by any genome is kept with all of its assignments, so the
+LCA of every remaining hash is unchanged.
+
+With --holdout, the signatures given are classified against both the
+full and the pruned database, and their agreement is reported.
+"""
+import os
+import sys
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+import sourmash
+from sourmash.logging import error, notify, set_quiet
+from sourmash.lca import lca_utils
+
+from lca_stream import load_single_database
+from lca_vector import LineageCodes
+from lca_service import classify_hashvals
+
+
+def hash_depths(lca_db, hashvals):
+    """
+    Return the depth (number of named ranks) of the LCA of each of the
+    sorted 'hashvals', or -1 for hashes with no lineage at all.
+    """
+    lineage_codes = LineageCodes([lca_db])
+    found = []
+    indptr, rows = lineage_codes.gather(hashvals.tolist(), found)
+    lca = lineage_codes.lca_ids(indptr, rows)
+
+    code_depth = np.array([ len(lineage) for lineage in lineage_codes.lineages ],
+                          dtype=np.int32)
+    depths = np.full(len(hashvals), -1, dtype=np.int32)
+    depths[np.searchsorted(hashvals, np.array(found, dtype=np.uint64))] = \
+      code_depth[lca]
+    return depths
+
+
+def select_hashes(lca_db, budget):
+    """
+    Pick the hashvals to keep: the 'budget' deepest-LCA hashes of every
+    genome. Return (sorted hashvals, depths, boolean keep array).
+    """
+    hashvals = np.array(sorted(lca_db.hashval_to_idx), dtype=np.uint64)
+    depths = hash_depths(lca_db, hashvals)
+
+    # one (hash position, idx) pair per assignment.
+    n_pairs = [ len(lca_db.hashval_to_idx[int(h)]) for h in hashvals ]
+    pair_pos = np.repeat(np.arange(len(hashvals)), n_pairs)
+    pair_idx = np.fromiter((idx for h in hashvals
+                            for idx in lca_db.hashval_to_idx[int(h)]),
+                           dtype=np.int64, count=len(pair_pos))
+
+    # per genome, deepest first, then smallest hashval.
+    order = np.lexsort((pair_pos, -depths[pair_pos], pair_idx))
+    pair_pos, pair_idx = pair_pos[order], pair_idx[order]
+
+    group_start = np.r_[0, np.flatnonzero(np.diff(pair_idx)) + 1]
+    group_len = np.diff(np.r_[group_start, len(pair_idx)])
+    rank_in_genome = np.arange(len(pair_idx)) - np.repeat(group_start, group_len)
+
+    keep = np.zeros(len(hashvals), dtype=bool)
+    keep[pair_pos[rank_in_genome < budget]] = True
+    return hashvals, depths, keep
+
+
+def compare_classifications(full_db, pruned_db, filenames, threshold):
+    "Classify holdout signatures against both databases; count agreement."
+    full_codes = LineageCodes([full_db])
+    pruned_codes = LineageCodes([pruned_db])
+
+    results = defaultdict(int)
+    for filename in filenames:
+        for sig in sourmash.load_signatures(filename, ksize=full_db.ksize):
+            mh = sig.minhash
+            if mh.scaled < full_db.scaled:
+                mh = mh.downsample_scaled(full_db.scaled)
+            hashvals = mh.get_mins()
+
+            full_lin, _ = classify_hashvals(hashvals, [full_db], threshold,
+                                            full_codes)
+            pruned_lin, _ = classify_hashvals(hashvals, [pruned_db],
+                                              threshold, pruned_codes)
+            full_lin, pruned_lin = tuple(full_lin), tuple(pruned_lin)
+
+            if full_lin == pruned_lin:
+                results['same'] += 1
+            elif full_lin[:len(pruned_lin)] == pruned_lin:
+                results['less specific'] += 1
+            elif pruned_lin[:len(full_lin)] == full_lin:
+                results['more specific'] += 1
+            else:
+                results['different'] += 1
+
+    return results
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('lca_db')
+    p.add_argument('-o', '--output', required=True,
+                   help='pruned LCA database')
+    p.add_argument('--budget', type=int, default=1000,
+                   help='most informative hashes to keep per genome (default: %(default)s)')
+    p.add_argument('--holdout', nargs='+',
+                   help='signatures to compare classifications on')
+    p.add_argument('--threshold', type=int, default=5,
+                   help='classification threshold for --holdout')
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet)
+
+    lca_db, ksize, scaled = load_single_database(args.lca_db)
+    notify('loaded {} hashes for {} genomes from {}', len(lca_db.hashval_to_idx),
+           len(lca_db.ident_to_idx), args.lca_db)
+
+    hashvals, depths, keep = select_hashes(lca_db, args.budget)
+
+    pruned_db = lca_utils.LCA_Database()
+    pruned_db.__dict__.update(lca_db.__dict__)
+    pruned_db.hashval_to_idx = dict([ (int(h), lca_db.hashval_to_idx[int(h)])
+                                      for h in hashvals[keep] ])
+
+    n_assign = sum([ len(x) for x in lca_db.hashval_to_idx.values() ])
+    n_assign_pruned = sum([ len(x) for x in pruned_db.hashval_to_idx.values() ])
+    print('kept {} of {} hashes ({:.1f}%), {} of {} assignments'.format(
+          keep.sum(), len(hashvals), keep.sum() / len(hashvals) * 100,
+          n_assign_pruned, n_assign))
+
+    print('hashes kept, by LCA rank:')
+    ranks = ['none', 'root'] + list(lca_utils.taxlist())
+    for depth in range(-1, len(ranks) - 1):
+        at_depth = depths == depth
+        if at_depth.any():
+            print('   {}: {} of {}'.format(ranks[depth + 1],
+                                           keep[at_depth].sum(),
+                                           at_depth.sum()))
+
+    pruned_db.save(args.output)
+    print('wrote {}: {:.1f} MB, from {:.1f} MB'.format(args.output,
+          os.path.getsize(args.output) / 1e6,
+          os.path.getsize(args.lca_db) / 1e6))
+
+    if args.holdout:
+        results = compare_classifications(lca_db, pruned_db, args.holdout,
+                                          args.threshold)
+        total = sum(results.values())
+        if not total:
+            error('no holdout signatures at k={}', ksize)
+            sys.exit(-1)
+        print('holdout classifications vs the full database, threshold {}:'.format(args.threshold))
+        for what in ('same', 'less specific', 'more specific', 'different'):
+            print('   {}: {} of {} ({:.1f}%)'.format(what, results[what], total,
+                                                     results[what] / total * 100))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
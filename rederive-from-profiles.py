@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+"""
+Redo the bulk classification, dig and investigate steps at a new
+threshold from the LCA count profiles saved by
+`bulk-classify-sbt-with-lca.py --save-profiles`, without loading any
+databases or signatures.
+
+Outputs, for the selected --outputs:
+* classify - {prefix}-bulk-classify.csv, as bulk-classify-sbt-with-lca.py;
+* dig - {prefix}-dig.csv (and {prefix}-dig-{level}.csv for each further
+  --level), as bulk-classify-dig.py, for the signatures classified above
+  order; --confused-hashvals cannot be applied after the fact;
+* investigate - {prefix}-investigate.pickle, as bulk-investigate.py, for
+  the same signatures.
+"""
+import sys
+import argparse
+from collections import defaultdict
+import pickle
+import pprint
+
+from sourmash.logging import error, notify, set_quiet
+from sourmash.lca import lca_utils
+
+from lca_profiles import ProfileStore
+from lca_service import (classify_counts, summarize_counts,
+                         aggregate_to_level, blame_lineages)
+from lca_vector import LEVELS
+from csv_io import CSVWriter, add_compress_args, compressed_name
+
+OUTPUTS = ('classify', 'dig', 'investigate')
+
+# bulk-classify-dig.py (and so bulk-investigate.py) skips these.
+DIG_SKIP = ('MISSED', 'species', 'genus', 'family', 'order')
+
+
+def classified_rank(classified_as, why):
+    "The rank column of a bulk-classify CSV, as bulk-classify-sbt-with-lca.py."
+    if classified_as:
+        return classified_as[-1].rank
+    elif why == 'disagree':
+        return 'root'
+    return 'MISSED'
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('profiles', help='profile store from --save-profiles')
+    p.add_argument('prefix', help='prefix for output files')
+    p.add_argument('--threshold', type=int, default=5)
+    p.add_argument('--level', action='append', choices=LEVELS,
+                   help='rank for the dig step to aggregate to (default: order); may be repeated')
+    p.add_argument('--outputs', nargs='+', choices=OUTPUTS, default=OUTPUTS,
+                   help='what to rederive (default: all)')
+    add_compress_args(p)
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet)
+
+    levels = args.level or ['order']
+    if len(set(levels)) != len(levels):
+        error('Error! --level given more than once for the same rank')
+        sys.exit(-1)
+    suffixes = dict([ (level, '-' + level) for level in levels[1:] ])
+    suffixes[levels[0]] = ''
+
+    try:
+        store = ProfileStore(args.profiles)
+    except ValueError as e:
+        error('Error! {}', str(e))
+        sys.exit(-1)
+
+    info = store.info()
+    notify('loaded {} profiles from {}; ksize={}, scaled={}', len(store),
+           args.profiles, info.get('ksize'), info.get('scaled'))
+
+    classify_w = None
+    if 'classify' in args.outputs:
+        classify_w = CSVWriter(compressed_name('{}-bulk-classify.csv'.format(args.prefix),
+                                               args.compress))
+        classify_w.writerow(["rank", "name", "filename", "md5sum", "lineage"])
+
+    dig_w = {}
+    if 'dig' in args.outputs:
+        for level in levels:
+            filename = '{}-dig{}.csv'.format(args.prefix, suffixes[level])
+            dig_w[level] = CSVWriter(compressed_name(filename, args.compress))
+
+    combo_counts = defaultdict(list)
+
+    rank_counts = defaultdict(int)
+    n_chimera = defaultdict(int)
+    n_other = defaultdict(int)
+    for md5, name, filename, counts in store.iter_profiles():
+        classified_as, why = classify_counts(counts, args.threshold)
+        rank = classified_rank(classified_as, why)
+        rank_counts[rank] += 1
+
+        if classify_w:
+            classify_w.writerow([rank, name, filename, md5,
+                                 lca_utils.display_lineage(classified_as)])
+
+        if rank in DIG_SKIP:
+            continue
+
+        for level in dig_w:
+            lineage_counts = aggregate_to_level(counts, args.threshold, level)
+            if len(lineage_counts) >= 2:
+                status = 'chimera'
+                n_chimera[level] += 1
+            else:
+                status = 'other'
+                n_other[level] += 1
+            dig_w[level].writerow([status, name, filename, md5])
+
+        if 'investigate' in args.outputs:
+            lineage_counts = summarize_counts(counts, args.threshold)
+            if not lineage_counts:
+                continue
+
+            lca_rank, blamed = blame_lineages(lineage_counts, classified_as)
+            if blamed:
+                blamed_lineages = tuple(sorted([ lineage for lineage, count
+                                                 in blamed ]))
+                combo_counts[blamed_lineages].append([name] + blamed)
+
+    store.close()
+
+    print('classified at threshold {}:'.format(args.threshold))
+    pprint.pprint(list(rank_counts.items()))
+
+    if classify_w:
+        classify_w.close()
+    for level, w in dig_w.items():
+        w.close()
+        print('dig at {}: {} chimera, {} other'.format(level, n_chimera[level],
+                                                       n_other[level]))
+
+    if 'investigate' in args.outputs:
+        with open('{}-investigate.pickle'.format(args.prefix), 'wb') as fp:
+            pickle.dump(combo_counts, fp)
+        print('investigate: {} blame clusters'.format(len(combo_counts)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,244 @@
+"""
+An indexed SQLite store of bulk-classify-sbt-with-lca.py results.
+
+ingest-bulk-classify.py loads {prefix}-bulk-classify.csv files into it;
+bulk-grab-sigs.py, bulk-csv-to-lineages-csv.py and
+compare-bulk-lca-to-gtdb-entire.py can read from it with --results-db
+instead of re-scanning the CSVs.
+
+Each CSV is a 'source', named by its prefix. A row is keyed by
+(source, md5); its lineage is stored both as the display string and
+split into one column per rank, so selecting by rank or taxon, or
+looking up genomes by name, is an index lookup.
+"""
+import os
+import csv
+import sqlite3
+
+from sourmash.lca import lca_utils
+
+from csv_io import open_text, strip_compression
+
+RANKS = list(lca_utils.taxlist(include_strain=False))
+
+# look up this many names per query.
+LOOKUP_BATCH = 500
+
+
+def source_name(csvname):
+    "The source name for a CSV: its prefix, or its path."
+    csvname = strip_compression(csvname)
+    if csvname.endswith('-bulk-classify.csv'):
+        return csvname[:-len('-bulk-classify.csv')]
+    return csvname
+
+
+def split_lineage(lineage):
+    "Split a display lineage into one name per rank, padded with ''."
+    names = lineage.split(';') if lineage else []
+    names = names[:len(RANKS)]
+    return names + [''] * (len(RANKS) - len(names))
+
+
+def to_lineage_pairs(names):
+    """
+    Convert per-rank names into a lineage tuple, the way
+    load_taxonomy_assignments does: nulls become 'unassigned', and
+    trailing unassigned ranks are removed.
+    """
+    lineage = [ lca_utils.LineagePair(rank, lca_utils.filter_null(name))
+                for rank, name in zip(RANKS, names) ]
+    while lineage and lineage[-1].name == 'unassigned':
+        lineage = lineage[:-1]
+    return tuple(lineage)
+
+
+class ResultsDB(object):
+    """
+    SQLite store of classification results from many bulk-classify CSVs.
+    """
+    def __init__(self, filename, create=False):
+        if not create and not os.path.exists(filename):
+            raise ValueError("results database '{}' does not exist".format(filename))
+
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        rank_columns = ''.join([ '    "{}" TEXT,\n'.format(rank)
+                                 for rank in RANKS ])
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS sources (
+                source TEXT PRIMARY KEY,
+                csv TEXT NOT NULL,
+                sigdir TEXT,
+                size INTEGER,
+                mtime INTEGER,
+                n_rows INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS classifications (
+                source TEXT NOT NULL,
+                md5 TEXT NOT NULL,
+                name TEXT,
+                filename TEXT,
+                rank TEXT,
+                lineage TEXT,
+            {}    PRIMARY KEY (source, md5)
+            );
+            CREATE INDEX IF NOT EXISTS classifications_md5
+                ON classifications (md5);
+            CREATE INDEX IF NOT EXISTS classifications_name
+                ON classifications (name);
+            CREATE INDEX IF NOT EXISTS classifications_rank
+                ON classifications (source, rank);
+            '''.format(rank_columns))
+        self.conn.commit()
+
+    def is_current(self, csvname):
+        "Has this CSV been ingested, unchanged since?"
+        st = os.stat(csvname)
+        row = self.conn.execute('''SELECT size, mtime FROM sources
+                                   WHERE source=?''',
+                                (source_name(csvname),)).fetchone()
+        return row == (st.st_size, int(st.st_mtime))
+
+    def ingest(self, csvname, rank_column='rank', lineage_column='lineage'):
+        """
+        Load (or reload) one bulk-classify CSV. Return (rows stored,
+        duplicate md5sums skipped).
+        """
+        source = source_name(csvname)
+        sigdir = os.path.abspath(source + '-unclassified-sigs')
+        st = os.stat(csvname)
+
+        self.conn.execute('DELETE FROM classifications WHERE source=?',
+                          (source,))
+
+        placeholders = ','.join(['?'] * (6 + len(RANKS)))
+        n_rows = 0
+        n_duplicates = 0
+        with open_text(csvname) as fp:
+            r = csv.DictReader(fp)
+            for row in r:
+                lineage = row.get(lineage_column, '')
+                values = [source, row['md5sum'], row['name'],
+                          row.get('filename'), row[rank_column], lineage]
+                values += split_lineage(lineage)
+
+                c = self.conn.execute('''INSERT OR IGNORE INTO classifications
+                                         VALUES ({})'''.format(placeholders),
+                                      values)
+                if c.rowcount:
+                    n_rows += 1
+                else:
+                    n_duplicates += 1
+
+        self.conn.execute('''INSERT OR REPLACE INTO sources
+                             (source, csv, sigdir, size, mtime, n_rows)
+                             VALUES (?, ?, ?, ?, ?, ?)''',
+                          (source, os.path.abspath(csvname), sigdir,
+                           st.st_size, int(st.st_mtime), n_rows))
+        self.conn.commit()
+
+        return n_rows, n_duplicates
+
+    def sources(self):
+        return [ source for (source,) in
+                 self.conn.execute('SELECT source FROM sources ORDER BY source') ]
+
+    def sigdir(self, source):
+        row = self.conn.execute('SELECT sigdir FROM sources WHERE source=?',
+                                (source,)).fetchone()
+        if row is None:
+            raise ValueError("no source '{}' in {}".format(source, self.filename))
+        return row[0]
+
+    def duplicates(self):
+        """
+        Return (md5sums found in more than one source, names found with
+        more than one md5sum).
+        """
+        (n_md5,) = self.conn.execute('''SELECT COUNT(*) FROM
+                                        (SELECT md5 FROM classifications
+                                         GROUP BY md5
+                                         HAVING COUNT(*) > 1)''').fetchone()
+        (n_name,) = self.conn.execute('''SELECT COUNT(*) FROM
+                                         (SELECT name FROM classifications
+                                          GROUP BY name
+                                          HAVING COUNT(DISTINCT md5) > 1)''').fetchone()
+        return n_md5, n_name
+
+    def md5sums_at_ranks(self, source, ranks):
+        "Yield the md5sums from 'source' classified at any of 'ranks'."
+        ranks = list(ranks)
+        c = self.conn.execute('''SELECT md5 FROM classifications
+                                 WHERE source=? AND rank IN ({})'''.format(
+                                     ','.join(['?'] * len(ranks))),
+                              [source] + ranks)
+        for (md5,) in c:
+            yield md5
+
+    def iter_names(self, sources=None):
+        """
+        Yield (name, display lineage) for every row in 'sources' (or all
+        sources).
+        """
+        query = 'SELECT name, lineage FROM classifications'
+        args = []
+        if sources:
+            query += ' WHERE source IN ({})'.format(','.join(['?'] * len(sources)))
+            args = list(sources)
+        query += ' ORDER BY rowid'
+
+        for row in self.conn.execute(query, args):
+            yield row
+
+    def count_names(self, sources=None):
+        "Count the distinct names that have a lineage, in 'sources' (or all)."
+        query = """SELECT COUNT(DISTINCT name) FROM classifications
+                   WHERE lineage != ''"""
+        args = []
+        if sources:
+            query += ' AND source IN ({})'.format(','.join(['?'] * len(sources)))
+            args = list(sources)
+
+        (n,) = self.conn.execute(query, args).fetchone()
+        return n
+
+    def lineages_for_names(self, names, sources=None):
+        """
+        Look up the lineages of 'names' in 'sources' (or all sources) by
+        index; return a dictionary of name -> lineage tuple, as from
+        load_taxonomy_assignments. Raise ValueError if a name has
+        different lineages in different rows.
+        """
+        names = list(names)
+        columns = ','.join([ '"{}"'.format(rank) for rank in RANKS ])
+        source_clause = ''
+        if sources:
+            source_clause = ' AND source IN ({})'.format(','.join(['?'] * len(sources)))
+            sources = list(sources)
+
+        assignments = {}
+        conflicts = []
+        for start in range(0, len(names), LOOKUP_BATCH):
+            batch = names[start:start + LOOKUP_BATCH]
+            c = self.conn.execute('''SELECT name, {} FROM classifications
+                                     WHERE name IN ({}){}'''.format(columns,
+                                         ','.join(['?'] * len(batch)),
+                                         source_clause),
+                                  batch + (sources or []))
+            for row in c:
+                name = row[0]
+                lineage = to_lineage_pairs(row[1:])
+                if not lineage:
+                    continue
+                if name in assignments and assignments[name] != lineage:
+                    conflicts.append(name)
+                assignments[name] = lineage
+
+        if conflicts:
+            raise ValueError("{} names have conflicting lineages in {}, e.g. '{}'".format(
+                             len(set(conflicts)), self.filename, conflicts[0]))
+        return assignments
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+"""
+Run any of the scripts in this directory as a subcommand, or a whole
+batch of them in one process.
+
+    run-script.py align-genomes genome1.fa genome2.fa
+    run-script.py --batch commands.txt
+
+Each subcommand is a script name minus '.py'; its arguments are passed on
+unchanged. Only the chosen script is imported, so sourmash, screed and
+pymummer are loaded only by the subcommands that use them. With --batch,
+each line of the file is one subcommand invocation (blank lines and
+'#' comments are skipped), and every script is imported at most once, so
+a driver loop pays the import cost once instead of once per call.
+"""
+import os
+import sys
+import ast
+import time
+import shlex
+import argparse
+import importlib.util
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# loaded script modules, by subcommand.
+_modules = {}
+
+
+def find_scripts():
+    "Return {subcommand: script path} for the scripts in SCRIPTS_DIR."
+    this = os.path.basename(__file__)
+    scripts = {}
+    for filename in sorted(os.listdir(SCRIPTS_DIR)):
+        if filename.endswith('.py') and '-' in filename and filename != this:
+            scripts[filename[:-3]] = os.path.join(SCRIPTS_DIR, filename)
+    return scripts
+
+
+def describe(path):
+    "The first line of a script's docstring, read without importing it."
+    with open(path, 'rt') as fp:
+        doc = ast.get_docstring(ast.parse(fp.read()))
+    if not doc:
+        return ''
+    return doc.strip().splitlines()[0]
+
+
+def load_script(name, path):
+    "Import the script at 'path' once, as module 'name'."
+    module = _modules.get(name)
+    if module is None:
+        if SCRIPTS_DIR not in sys.path:
+            sys.path.insert(0, SCRIPTS_DIR)
+        spec = importlib.util.spec_from_file_location(name.replace('-', '_'),
+                                                      path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[name] = module
+    return module
+
+
+def run_script(name, path, args):
+    """
+    Run the script's main() on 'args' as if it were invoked directly;
+    return its exit status.
+    """
+    module = load_script(name, path)
+
+    # some scripts take their arguments, others parse sys.argv.
+    saved_argv = sys.argv
+    sys.argv = [path] + list(args)
+    try:
+        if module.main.__code__.co_argcount:
+            status = module.main(list(args))
+        else:
+            status = module.main()
+    except SystemExit as e:
+        status = e.code
+    finally:
+        sys.argv = saved_argv
+
+        # scripts set sourmash's quiet flag globally; don't let it leak.
+        if 'sourmash.logging' in sys.modules:
+            sys.modules['sourmash.logging'].set_quiet(False)
+
+    if status is None or status is True:
+        return 0
+    if isinstance(status, int):
+        return status
+    print(status, file=sys.stderr)
+    return 1
+
+
+def read_batch(filename):
+    "Yield (line number, [subcommand, arg, ...]) from a batch file."
+    with open(filename, 'rt') as fp:
+        for lineno, line in enumerate(fp, 1):
+            words = shlex.split(line, comments=True)
+            if words:
+                yield lineno, words
+
+
+def main(args):
+    scripts = find_scripts()
+
+    # reading every docstring is slow-ish; only do it for --help.
+    epilog = None
+    if not args or args[0] in ('-h', '--help'):
+        epilog = 'subcommands:\n' + '\n'.join([ '  {:32} {}'.format(name,
+                                                                   describe(path))
+                                                for name, path in scripts.items() ])
+
+    p = argparse.ArgumentParser(epilog=epilog,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('command', nargs='?', help='script to run')
+    p.add_argument('args', nargs=argparse.REMAINDER,
+                   help='arguments for the script')
+    p.add_argument('--batch',
+                   help='run each line of this file as a subcommand')
+    p.add_argument('-k', '--keep-going', action='store_true',
+                   help='with --batch, continue after a command fails')
+    args = p.parse_args(args)
+
+    if bool(args.command) == bool(args.batch):
+        print('Error! give either a subcommand or --batch', file=sys.stderr)
+        sys.exit(-1)
+
+    if args.command:
+        if args.command not in scripts:
+            print('Error! unknown subcommand {}'.format(args.command),
+                  file=sys.stderr)
+            sys.exit(-1)
+        return run_script(args.command, scripts[args.command], args.args)
+
+    commands = list(read_batch(args.batch))
+    for lineno, words in commands:
+        if words[0] not in scripts:
+            print('Error! {}:{}: unknown subcommand {}'.format(args.batch,
+                  lineno, words[0]), file=sys.stderr)
+            sys.exit(-1)
+
+    start = time.time()
+    n_failed = 0
+    for lineno, (name, *script_args) in commands:
+        status = run_script(name, scripts[name], script_args)
+        if status:
+            n_failed += 1
+            print('Error! {}:{}: {} exited with status {}'.format(args.batch,
+                  lineno, name, status), file=sys.stderr)
+            if not args.keep_going:
+                return status
+
+    print('ran {} commands ({} failed) in {:.1f}s'.format(len(commands),
+          n_failed, time.time() - start), file=sys.stderr)
+    if n_failed:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+"""
+Write per-prefix LCA databases by subsetting one master LCA database.
+
+Each --subset gives a lineages CSV and an output database; the output
+holds the master's identifiers that appear in that CSV, with their
+lineages and hashes. This is what you would get by indexing just those
+genomes at the master's ksize and scaled, but no signatures are read.
+
+The master is read twice: first for its small sections, skipping the
+hashes, and then for the hashes alone, which are streamed and split
+between all of the outputs. The hashes come before the identifier
+sections that say which outputs they belong to, and spilling them to a
+temporary file to avoid the second read was measured to be slower.
+
+    subset-lca-db.py all.lca.json.gz \\
+        --subset TOBG-lineages.csv TOBG.lca.json.gz \\
+        --subset TARA-lineages.csv TARA.lca.json.gz
+"""
+import sys
+import gzip
+import json
+import argparse
+
+from sourmash.logging import error, notify, set_quiet
+from sourmash.lca.command_index import load_taxonomy_assignments
+
+from lca_stream import load_single_database, iter_hashval_to_idx
+
+# everything but the hashes.
+INDEX_SECTIONS = ('ident_to_name', 'ident_to_idx', 'idx_to_lid',
+                  'lid_to_lineage')
+
+# write hashes in batches of this many.
+WRITE_EVERY = 100000
+
+# level 9, the gzip module default, is much slower for little gain.
+GZIP_LEVEL = 6
+
+
+class SubsetWriter(object):
+    """
+    Write one LCA database in the layout of LCA_Database.save, with the
+    hashes added one at a time.
+    """
+    def __init__(self, filename, master, idents):
+        self.filename = filename
+        self.ident_to_idx = dict([ (ident, master.ident_to_idx[ident])
+                                   for ident in idents ])
+        self.ident_to_name = dict([ (ident, master.ident_to_name[ident])
+                                    for ident in idents ])
+        self.idx_to_lid = {}
+        for idx in self.ident_to_idx.values():
+            if idx in master.idx_to_lid:
+                self.idx_to_lid[idx] = master.idx_to_lid[idx]
+        lids = set(self.idx_to_lid.values())
+        self.lid_to_lineage = dict([ (lid, master.lid_to_lineage[lid])
+                                     for lid in lids ])
+        self.keep_idx = set(self.ident_to_idx.values())
+        self.n_hashes = 0
+        self.buf = []
+
+        if filename.endswith('.gz'):
+            self.fp = gzip.open(filename, 'wt', compresslevel=GZIP_LEVEL)
+        else:
+            self.fp = open(filename, 'wt')
+
+        header = json.dumps(dict(version='2.0', type='sourmash_lca',
+                                 license='CC0', ksize=master.ksize,
+                                 scaled=master.scaled))
+        lid_to_lineage = dict([ (lid, [ list(pair) for pair in lineage
+                                        if pair.name ])
+                                for lid, lineage in self.lid_to_lineage.items() ])
+        self.fp.write(header[:-1])
+        self.fp.write(', "lid_to_lineage": {}'.format(json.dumps(lid_to_lineage)))
+        self.fp.write(', "hashval_to_idx": {')
+
+    def add(self, hashval, idx_list):
+        idx_list = [ str(idx) for idx in idx_list if idx in self.keep_idx ]
+        if not idx_list:
+            return
+
+        self.buf.append('"{}": [{}]'.format(hashval, ', '.join(idx_list)))
+        self.n_hashes += 1
+        if len(self.buf) >= WRITE_EVERY:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            if self.n_hashes > len(self.buf):
+                self.fp.write(', ')
+            self.fp.write(', '.join(self.buf))
+            self.buf = []
+
+    def close(self):
+        self.flush()
+        self.fp.write('}')
+        for key in ('ident_to_name', 'ident_to_idx', 'idx_to_lid'):
+            self.fp.write(', "{}": {}'.format(key,
+                                               json.dumps(getattr(self, key))))
+        self.fp.write('}')
+        self.fp.close()
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('master_db', help='LCA database of all genomes')
+    p.add_argument('--subset', nargs=2, action='append', required=True,
+                   metavar=('LINEAGES_CSV', 'OUTPUT'),
+                   help='write the genomes in LINEAGES_CSV to OUTPUT; may be repeated')
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet)
+
+    master, ksize, scaled = load_single_database(args.master_db,
+                                                 sections=INDEX_SECTIONS)
+    notify('loaded {} identifiers from {}; ksize={}, scaled={}',
+           len(master.ident_to_idx), args.master_db, ksize, scaled)
+
+    writers = []
+    for lineages_csv, output in args.subset:
+        assignments, num_rows = load_taxonomy_assignments(lineages_csv)
+        idents = [ ident for ident in assignments
+                   if ident in master.ident_to_idx ]
+        if len(idents) < len(assignments):
+            notify('{} of {} identifiers in {} are not in {}',
+                   len(assignments) - len(idents), len(assignments),
+                   lineages_csv, args.master_db)
+        if not idents:
+            error('Error! no identifiers from {} in {}', lineages_csv,
+                  args.master_db)
+            sys.exit(-1)
+        writers.append(SubsetWriter(output, master, idents))
+
+    # hashes belonging to none of the subsets are skipped cheaply.
+    keep_idx = set()
+    for w in writers:
+        keep_idx.update(w.keep_idx)
+
+    n = 0
+    for hashval, idx_list in iter_hashval_to_idx(args.master_db):
+        n += 1
+        if n % 1000000 == 0:
+            notify('... {} hashes', n, end='\r')
+        if not keep_idx.intersection(idx_list):
+            continue
+        for w in writers:
+            w.add(hashval, idx_list)
+
+    notify(u'\r\033[K', end=u'')
+    notify('read {} hashes from {}', n, args.master_db)
+    for w in writers:
+        w.close()
+        notify('wrote {}: {} identifiers, {} hashes', w.filename,
+               len(w.ident_to_idx), w.n_hashes)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,219 @@
+#! /usr/bin/env python
+"""
+Evaluate many `sourmash lca classify` parameter combinations against
+GTDB-Tk in one pass.
+
+Equivalent to running `sourmash lca classify --threshold T --scaled S`
+and then compare-lca-gtdbtk.py for every ksize/threshold/scaled
+combination, but the GTDB-Tk summaries are parsed once, and each
+genome's hashes are looked up and reduced to per-hash LCAs once per
+ksize, at the smallest --scaled; larger --scaled values are evaluated by
+downsampling those LCAs in memory, and thresholds by re-cutting the
+counts.
+
+Writes one row per combination with the same "match at full sourmash
+lca" and "match at full GTDB-Tk lineage" figures as compare-lca-gtdbtk.py,
+plus the percent of genomes matching GTDB-Tk down to each rank.
+"""
+import sys
+import csv
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+import sourmash
+from sourmash.logging import error, notify, set_quiet
+from sourmash.lca import lca_utils
+from sourmash._minhash import get_max_hash_for_scaled
+
+from lca_stream import load_single_database, LINEAGE_SECTIONS
+from lca_vector import LineageCodes
+from gtdbtk_compare import (RANKS, genome_key, load_gtdbtk_rows,
+                            gtdbtk_lineage, compare_lineages, rank_matches)
+
+DEFAULT_THRESHOLD = 5
+
+
+def classify_counts(lineage_codes, ids, counts, threshold):
+    """
+    Classify from LCA codes and counts, as classify_signature does from
+    its Counter; return (lineage, status).
+    """
+    tree = {}
+    for code, count in zip(ids, counts):
+        if count >= threshold:
+            lca_utils.build_tree([lineage_codes.lineages[code]], tree)
+
+    if not tree:
+        return [], 'nomatch'
+
+    lca, reason = lca_utils.find_lca(tree)
+    if reason == 0:
+        return lca, 'found'
+    return lca, 'disagree'
+
+
+def pad_lineage(lineage):
+    "Fill in empty names for the ranks below 'lineage', as classify CSVs do."
+    names = dict(zip(RANKS, lca_utils.zip_lineage(lineage, include_strain=False)))
+    return tuple([ lca_utils.LineagePair(rank=rank, name=names[rank])
+                   for rank in RANKS ])
+
+
+class Tally(object):
+    "Match counts for one ksize/scaled/threshold combination."
+    def __init__(self):
+        self.n_genomes = 0
+        self.n_nomatch = 0
+        self.n_no_species = 0
+        self.n_compared = 0
+        self.n_match1 = 0
+        self.n_match2 = 0
+        self.n_rank = [0] * len(RANKS)
+
+    def add(self, tk_lin, lineage, status):
+        self.n_genomes += 1
+        if status == 'nomatch':
+            self.n_nomatch += 1
+            self.n_no_species += 1
+            return
+
+        lca_lin = pad_lineage(lineage)
+        if not lca_lin[-1].name:
+            self.n_no_species += 1
+        if not tk_lin:
+            return
+
+        self.n_compared += 1
+        match1, match2 = compare_lineages(tk_lin, lca_lin)
+        self.n_match1 += match1
+        self.n_match2 += match2
+        for i, match in enumerate(rank_matches(tk_lin, lca_lin)):
+            self.n_rank[i] += match
+
+    def row(self):
+        def percent(n):
+            if not self.n_compared:
+                return ''
+            return '{:.1f}'.format(n / self.n_compared * 100)
+
+        row = dict(n_genomes=self.n_genomes, nomatch=self.n_nomatch,
+                   no_species=self.n_no_species, compared=self.n_compared,
+                   match_sourmash=percent(self.n_match1),
+                   match_gtdbtk=percent(self.n_match2))
+        for rank, n in zip(RANKS, self.n_rank):
+            row['match_' + rank] = percent(n)
+        return row
+
+
+def load_databases_by_ksize(filenames):
+    "Stream-load LCA databases; return {ksize: (dblist, scaled)}."
+    by_ksize = defaultdict(list)
+    for filename in filenames:
+        notify('... loading database {}'.format(filename), end='\r')
+        lca_db, ksize, scaled = load_single_database(filename,
+                                                     sections=LINEAGE_SECTIONS)
+        by_ksize[ksize].append(lca_db)
+
+    databases = {}
+    for ksize, dblist in by_ksize.items():
+        databases[ksize] = (dblist, max([ db.scaled for db in dblist ]))
+    notify(u'\r\033[K', end=u'')
+    notify('loaded {} LCA databases; ksizes {}', len(filenames),
+           ", ".join(map(str, sorted(databases))))
+    return databases
+
+
+def sweep_ksize(ksize, dblist, db_scaled, args, tk_lineages, tallies):
+    "Classify every query at one ksize, for all scaled/threshold values."
+    scaled_vals = sorted(set(args.scaled or [db_scaled]))
+    if scaled_vals[0] < db_scaled:
+        error('Error! --scaled {} is below the scaled {} of the k={} databases',
+              scaled_vals[0], db_scaled, ksize)
+        sys.exit(-1)
+    max_hashes = [ np.uint64(get_max_hash_for_scaled(scaled))
+                   for scaled in scaled_vals ]
+
+    lineage_codes = LineageCodes(dblist)
+
+    n = 0
+    for query_filename in args.query:
+        for query_sig in sourmash.load_signatures(query_filename, ksize=ksize):
+            n += 1
+            notify(u'\r\033[K', end=u'')
+            notify('... k={} classifying {} ({})', ksize, query_sig.name(),
+                   n, end='\r')
+            tk_lin = tk_lineages.get(genome_key(query_sig.name()), ())
+
+            # one lookup and LCA per hash, at the smallest scaled.
+            mh = query_sig.minhash.downsample_scaled(scaled_vals[0])
+            found = []
+            indptr, rows = lineage_codes.gather(mh.get_mins(), found)
+            lca = lineage_codes.lca_ids(indptr, rows)
+            found = np.array(found, dtype=np.uint64)
+
+            for scaled, max_hash in zip(scaled_vals, max_hashes):
+                ids, counts = np.unique(lca[found < max_hash],
+                                        return_counts=True)
+                for threshold in args.threshold:
+                    lineage, status = classify_counts(lineage_codes, ids,
+                                                      counts, threshold)
+                    tallies[(ksize, scaled, threshold)].add(tk_lin, lineage,
+                                                            status)
+
+    notify(u'\r\033[K', end=u'')
+    notify('classified {} signatures at k={}', n, ksize)
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('gtdbtk_dir')
+    p.add_argument('--db', nargs='+', required=True,
+                   help='LCA databases; several ksizes may be given')
+    p.add_argument('--query', nargs='+', required=True,
+                   help='query signature files')
+    p.add_argument('--threshold', type=int, nargs='+',
+                   default=[DEFAULT_THRESHOLD],
+                   help='thresholds to evaluate (default: %(default)s)')
+    p.add_argument('--scaled', type=float, nargs='+',
+                   help='scaled values to evaluate (default: the database scaled)')
+    p.add_argument('-o', '--output', required=True,
+                   help='CSV of match rates per combination')
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet)
+    if args.scaled:
+        args.scaled = [ int(scaled) for scaled in args.scaled ]
+
+    tk_d = load_gtdbtk_rows(args.gtdbtk_dir)
+    tk_lineages = dict([ (k, gtdbtk_lineage(row['classification']))
+                         for k, row in tk_d.items() ])
+    notify('loaded {} rows from gtdbtk classify_wf in dir {}', len(tk_d),
+           args.gtdbtk_dir)
+
+    databases = load_databases_by_ksize(args.db)
+
+    tallies = defaultdict(Tally)
+    for ksize in sorted(databases):
+        dblist, db_scaled = databases.pop(ksize)
+        sweep_ksize(ksize, dblist, db_scaled, args, tk_lineages, tallies)
+
+    fieldnames = ['ksize', 'scaled', 'threshold', 'n_genomes', 'nomatch',
+                  'no_species', 'compared', 'match_sourmash', 'match_gtdbtk']
+    fieldnames += [ 'match_' + rank for rank in RANKS ]
+    with open(args.output, 'wt') as fp:
+        w = csv.DictWriter(fp, fieldnames=fieldnames)
+        w.writeheader()
+        for (ksize, scaled, threshold) in sorted(tallies):
+            row = tallies[(ksize, scaled, threshold)].row()
+            row.update(ksize=ksize, scaled=scaled, threshold=threshold)
+            w.writerow(row)
+
+    notify('wrote {} parameter combinations to {}', len(tallies), args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
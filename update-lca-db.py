@@ -0,0 +1,280 @@
+#! /usr/bin/env python
+"""
+Incrementally update an LCA database from a directory of signatures.
+
+A manifest CSV records, for each signature file that went into the
+database, its size/mtime, the md5sum of the signature used, its identifier
+and lineage. On each run, only signature files that are new, changed (or
+whose lineage changed) are loaded and merged in; identifiers whose
+signature files have disappeared are removed. If the input database does
+not exist yet, an empty one is started, so this also does the first
+build.
+
+Signatures left out by --require-taxonomy are recorded in the manifest as
+skipped, so that they are not read again until they or their lineage
+change. The database and then the manifest are written to temporary
+files and renamed into place, so the output database can also be the
+input, and an interrupted run leaves both as they were.
+"""
+import os
+import csv
+import sys
+import argparse
+
+import sourmash
+from sourmash.logging import error, notify, set_quiet
+from sourmash.lca import lca_utils
+from sourmash.lca.command_index import load_taxonomy_assignments
+from sourmash import sourmash_args
+
+MANIFEST_FIELDS = ['filename', 'size', 'mtime', 'md5sum', 'ident', 'lineage',
+                   'skipped']
+
+
+def empty_database(ksize, scaled):
+    "Create an LCA database with no contents."
+    lca_db = lca_utils.LCA_Database()
+    lca_db.ksize = ksize
+    lca_db.scaled = scaled
+    lca_db.ident_to_name = {}
+    lca_db.ident_to_idx = {}
+    lca_db.idx_to_lid = {}
+    lca_db.lid_to_lineage = {}
+    lca_db.hashval_to_idx = {}
+    return lca_db
+
+
+def normalize_lineage(lineage):
+    "Expand a lineage to every rank, as LCA_Database.load does."
+    d = dict(lineage)
+    return tuple([ lca_utils.LineagePair(rank, d.get(rank, ''))
+                   for rank in lca_utils.taxlist() ])
+
+
+def load_manifest(filename):
+    "Load the manifest into a dictionary keyed by signature filename."
+    manifest = {}
+    if not os.path.exists(filename):
+        return manifest
+
+    with open(filename, 'rt') as fp:
+        r = csv.DictReader(fp)
+        for row in r:
+            manifest[row['filename']] = row
+
+    return manifest
+
+
+def temporary_name(filename):
+    "A name next to 'filename' to write it under before renaming it."
+    dirname, basename = os.path.split(filename)
+    # keep the suffix, which picks the compression for LCA_Database.save.
+    return os.path.join(dirname, '.tmp{}-{}'.format(os.getpid(), basename))
+
+
+def save_manifest(filename, manifest):
+    tmpname = temporary_name(filename)
+    with open(tmpname, 'wt') as fp:
+        w = csv.DictWriter(fp, fieldnames=MANIFEST_FIELDS)
+        w.writeheader()
+        for sigfile in sorted(manifest):
+            w.writerow(manifest[sigfile])
+    os.replace(tmpname, filename)
+
+
+def remove_idents(lca_db, idents):
+    """
+    Remove 'idents' and all of their hashes from 'lca_db'.
+
+    This needs one pass across all the hashvals in the database.
+    """
+    remove_idx = set()
+    for ident in idents:
+        idx = lca_db.ident_to_idx.pop(ident, None)
+        lca_db.ident_to_name.pop(ident, None)
+        if idx is not None:
+            lca_db.idx_to_lid.pop(idx, None)
+            remove_idx.add(idx)
+
+    if not remove_idx:
+        return 0
+
+    n_removed = 0
+    hashval_to_idx = {}
+    for hashval, idx_list in lca_db.hashval_to_idx.items():
+        idx_list = [ idx for idx in idx_list if idx not in remove_idx ]
+        if idx_list:
+            hashval_to_idx[hashval] = idx_list
+        else:
+            n_removed += 1
+    lca_db.hashval_to_idx = hashval_to_idx
+
+    return n_removed
+
+
+def insert_signature(lca_db, sig, idx, lid=None):
+    "Add 'sig' to 'lca_db' at index 'idx', with an optional lineage id."
+    if lid is not None:
+        lca_db.idx_to_lid[idx] = lid
+
+    minhash = sig.minhash.downsample_scaled(lca_db.scaled)
+    for hashval in minhash.get_mins():
+        lca_db.hashval_to_idx.setdefault(hashval, []).append(idx)
+
+    return len(minhash)
+
+
+def main(args):
+    p = argparse.ArgumentParser()
+    p.add_argument('lca_db', help='existing LCA database (need not exist)')
+    p.add_argument('lineages_csv')
+    p.add_argument('output', help='updated LCA database')
+    p.add_argument('signatures', nargs='+',
+                   help='signature files or directories')
+    p.add_argument('--manifest', required=True,
+                   help='manifest CSV of signatures already in lca_db')
+    p.add_argument('-k', '--ksize', type=int, default=31)
+    p.add_argument('--scaled', type=float, default=10000)
+    p.add_argument('--require-taxonomy', action='store_true',
+                   help='ignore signatures with no lineage assignment')
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help='suppress non-error output')
+    p.add_argument('-d', '--debug', action='store_true',
+                   help='output debugging output')
+    args = p.parse_args(args)
+
+    set_quiet(args.quiet, args.debug)
+    args.scaled = int(args.scaled)
+
+    manifest = load_manifest(args.manifest)
+    if not args.require_taxonomy:
+        # signatures skipped by an earlier --require-taxonomy run are new now.
+        manifest = dict([ (sigfile, row) for sigfile, row in manifest.items()
+                          if not row.get('skipped') ])
+    if os.path.exists(args.lca_db):
+        lca_db, ksize, scaled = lca_utils.load_single_database(args.lca_db)
+        if ksize != args.ksize or scaled != args.scaled:
+            error('Error! {} has ksize={} scaled={}, not ksize={} scaled={}',
+                  args.lca_db, ksize, scaled, args.ksize, args.scaled)
+            sys.exit(-1)
+    else:
+        if manifest:
+            error('Error! manifest {} given, but no database {}',
+                  args.manifest, args.lca_db)
+            sys.exit(-1)
+        notify('starting new LCA database {}', args.lca_db)
+        lca_db = empty_database(args.ksize, args.scaled)
+
+    lineage_to_lid = {}
+    for lid, lineage in lca_db.lid_to_lineage.items():
+        lineage_to_lid[normalize_lineage(lineage)] = lid
+
+    assignments, num_rows = load_taxonomy_assignments(args.lineages_csv)
+    notify('loaded {} lineages from {}', len(assignments), args.lineages_csv)
+
+    sigfiles = set(sourmash_args.traverse_find_sigs(args.signatures))
+
+    # which signature files went away?
+    remove = set()
+    for sigfile in list(manifest):
+        if sigfile not in sigfiles:
+            old = manifest.pop(sigfile)
+            if not old.get('skipped'):
+                remove.add(old['ident'])
+
+    # which signature files are new, or changed?
+    n_unchanged = 0
+    n_new = 0
+    n_changed = 0
+    n_skipped = 0
+    n_hashes = 0
+    updates = []
+    for sigfile in sorted(sigfiles):
+        st = os.stat(sigfile)
+        size, mtime = str(st.st_size), str(int(st.st_mtime))
+        old = manifest.get(sigfile)
+
+        if old and old['size'] == size and old['mtime'] == mtime:
+            lineage = assignments.get(old['ident'], ())
+            if lca_utils.display_lineage(lineage) == old['lineage']:
+                n_unchanged += 1
+                continue
+
+        for sig in sourmash.load_signatures(sigfile, ksize=args.ksize):
+            ident = sig.name()
+            lineage = assignments.get(ident)
+            md5sum = sig.md5sum()
+
+            if old:
+                if old['md5sum'] == md5sum and \
+                   old['lineage'] == lca_utils.display_lineage(lineage or ()):
+                    old['size'], old['mtime'] = size, mtime
+                    n_unchanged += 1
+                    continue
+                if not old.get('skipped'):
+                    remove.add(old['ident'])
+                n_changed += 1
+            else:
+                n_new += 1
+
+            manifest[sigfile] = dict(filename=sigfile, size=size,
+                                     mtime=mtime, md5sum=md5sum, ident=ident,
+                                     lineage=lca_utils.display_lineage(lineage or ()))
+
+            if lineage is None and args.require_taxonomy:
+                n_skipped += 1
+                manifest[sigfile]['skipped'] = 1
+                continue
+
+            updates.append((sig, ident, lineage))
+
+    notify('{} unchanged, {} new, {} changed, {} removed signatures',
+           n_unchanged, n_new, n_changed, len(remove))
+
+    # remove changed and deleted idents, then (re)insert.
+    n_removed_hashes = remove_idents(lca_db, remove)
+
+    next_idx = max(list(lca_db.ident_to_idx.values()) + [-1]) + 1
+    next_lid = max(list(lca_db.lid_to_lineage) + [-1]) + 1
+    for sig, ident, lineage in updates:
+        if ident in lca_db.ident_to_idx:
+            error('WARNING: signature {} is already in the LCA db; skipping',
+                  ident)
+            continue
+
+        lid = None
+        if lineage:
+            lineage = normalize_lineage(lineage)
+            lid = lineage_to_lid.get(lineage)
+            if lid is None:
+                lid = next_lid
+                next_lid += 1
+                lca_db.lid_to_lineage[lid] = lineage
+                lineage_to_lid[lineage] = lid
+
+        lca_db.ident_to_idx[ident] = next_idx
+        lca_db.ident_to_name[ident] = sig.name()
+        n_hashes += insert_signature(lca_db, sig, next_idx, lid)
+        next_idx += 1
+
+    notify('removed {} hashvals; added {} hashes from {} signatures',
+           n_removed_hashes, n_hashes, len(updates))
+    if n_skipped:
+        notify('skipped {} signatures with no lineage (--require-taxonomy)',
+               n_skipped)
+
+    # database first, manifest last: a manifest never describes a
+    # database that was not completely written.
+    notify('saving LCA database to {}', args.output)
+    tmpname = temporary_name(args.output)
+    try:
+        lca_db.save(tmpname)
+        os.replace(tmpname, args.output)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+    save_manifest(args.manifest, manifest)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))